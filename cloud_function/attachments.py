@@ -0,0 +1,229 @@
+"""
+Attachment contents, sent once per distinct file.
+
+By default attachments are forwarded as metadata stubs (see extract_body). With
+EMAIL_ATTACHMENTS=content their bytes are fetched with messages.attachments.get
+and hashed, and each stub gets a `sha256`. Newsletters and automated reports keep
+sending the same logos and PDFs, so the blobs the backend already received are
+kept in a hash index: a known blob is only sent as its hash, a new one also
+carries its `content` (Gmail's base64url data, as fetched).
+
+    {"filename": "logo.png", "size": 5120, "sha256": "9f86...", "content": "iVBORw0..."}
+    {"filename": "logo.png", "size": 5120, "sha256": "9f86..."}
+
+A hash only enters the index once the email carrying its content was delivered,
+so a failed delivery never leaves the backend with a reference it can't resolve.
+Attachments bigger than EMAIL_ATTACHMENT_MAX_BYTES stay plain stubs. The others
+are fetched one at a time and looked up as soon as they are hashed, so only new
+contents are kept, and at most EMAIL_ATTACHMENT_BUDGET_BYTES of them per email:
+the attachments past it stay plain stubs too. Across the emails being delivered
+at once, the contents held are bounded by EMAIL_ATTACHMENT_INFLIGHT_BYTES (see
+get_inflight_budget): the sync waits for deliveries to finish before handing
+over more. Emails handed to the spool lose their contents (see
+without_contents), they are sent as plain stubs later.
+
+ATTACHMENT_INDEX selects where the hashes are kept (see backends.py):
+    firestore (default)   one document per hash in the `attachment_blobs` collection
+    sqlite:<path>         a local SQLite file, for tests and local runs
+    memory                an in-memory set, lost when the instance goes away
+    off                   no index, every email carries the contents of its attachments
+
+The index is shared by every mailbox: it describes what the backend holds.
+"""
+
+import base64
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import backends
+import metrics
+import streaming
+
+DEFAULT_INDEX_COLLECTION = 'attachment_blobs'
+DEFAULT_ATTACHMENT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_ATTACHMENT_BUDGET_BYTES = 10 * 1024 * 1024
+# Counted as held, in base64 text. A POST holds a second copy in its JSON body,
+# so about twice this stays well within a 256Mi function.
+DEFAULT_ATTACHMENT_INFLIGHT_BYTES = 24 * 1024 * 1024
+
+
+def contents_enabled():
+    """True when attachment bodies are fetched and forwarded (EMAIL_ATTACHMENTS=content)."""
+    return os.environ.get('EMAIL_ATTACHMENTS', 'stubs').strip().lower() == 'content'
+
+
+def get_max_bytes():
+    return int(os.environ.get('EMAIL_ATTACHMENT_MAX_BYTES', DEFAULT_ATTACHMENT_MAX_BYTES))
+
+
+def get_budget_bytes():
+    """Bytes of new attachment contents one email carries at most."""
+    return int(os.environ.get('EMAIL_ATTACHMENT_BUDGET_BYTES', DEFAULT_ATTACHMENT_BUDGET_BYTES))
+
+
+_inflight_budget = None
+_inflight_budget_lock = threading.Lock()
+
+
+def get_inflight_budget():
+    """The instance wide budget of EMAIL_ATTACHMENT_INFLIGHT_BYTES, replaced when the setting changes."""
+    global _inflight_budget
+    limit = max(1, int(os.environ.get('EMAIL_ATTACHMENT_INFLIGHT_BYTES', DEFAULT_ATTACHMENT_INFLIGHT_BYTES)))
+    if _inflight_budget is None or _inflight_budget.limit != limit:
+        with _inflight_budget_lock:
+            if _inflight_budget is None or _inflight_budget.limit != limit:
+                _inflight_budget = streaming.ByteBudget(limit)
+    return _inflight_budget
+
+
+def blob_hash(data):
+    """sha256 of the decoded bytes of Gmail's base64url `data`."""
+    return hashlib.sha256(base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))).hexdigest()
+
+
+def sent_hashes(email_data):
+    """Hashes whose content `email_data` carries, to be indexed once it is delivered."""
+    body = email_data.get('body')
+    if not isinstance(body, dict):
+        return set()
+    return {stub['sha256'] for stub in body.get('attachments', []) if 'content' in stub}
+
+
+def attach_contents(email_data, fetch, index=None, max_bytes=None, budget=None):
+    """
+        Adds `sha256` (and `content` unless the index knows it) to the attachment
+        stubs of `email_data`. `fetch(attachment_id)` returns Gmail's base64url data,
+        or None when the attachment is gone. New contents past `budget` bytes are
+        left out, with their hash, so those attachments stay plain stubs.
+    """
+    body = email_data.get('body')
+    if not isinstance(body, dict) or not body.get('attachments'):
+        return
+    max_bytes = get_max_bytes() if max_bytes is None else max_bytes
+    budget = get_budget_bytes() if budget is None else budget
+
+    sent = set()
+    for stub in body['attachments']:
+        if not stub.get('attachment_id') or stub.get('size', 0) > max_bytes:
+            continue
+        data = fetch(stub['attachment_id'])
+        if data is None:
+            continue
+        metrics.add('attachments.fetched')
+        metrics.add('attachments.bytes_fetched', len(data))
+        sha256 = blob_hash(data)
+        # The same file twice in one email only travels once, a known one not at all
+        if sha256 in sent or (index is not None and index.known([sha256])):
+            stub['sha256'] = sha256
+            metrics.add('attachments.deduplicated')
+            continue
+        # Counted in decoded bytes, like EMAIL_ATTACHMENT_MAX_BYTES
+        size = len(data) * 3 // 4
+        if size > budget:
+            metrics.add('attachments.over_budget')
+            continue
+        stub['sha256'] = sha256
+        stub['content'] = data
+        sent.add(sha256)
+        budget -= size
+
+
+def content_bytes(email_data):
+    """Bytes of attachment contents `email_data` holds, as base64 text."""
+    body = email_data.get('body')
+    if not isinstance(body, dict):
+        return 0
+    return sum(len(stub['content']) for stub in body.get('attachments', []) if 'content' in stub)
+
+
+def drop_contents(email_data):
+    """without_contents(), in place: for an email that is sent or failed and only kept for the spool."""
+    body = email_data.get('body')
+    if not isinstance(body, dict):
+        return
+    for stub in body.get('attachments', []):
+        if 'content' in stub:
+            del stub['content']
+            stub.pop('sha256', None)
+
+
+def without_contents(email_data):
+    """
+        A copy of `email_data` whose attachments are plain stubs again. A stub that
+        lost its content also loses its hash: the backend may never have received it.
+    """
+    body = email_data.get('body')
+    if not isinstance(body, dict) or not any('content' in stub for stub in body.get('attachments', [])):
+        return email_data
+    stubs = [
+        {key: value for key, value in stub.items() if key not in ('content', 'sha256')} if 'content' in stub else stub
+        for stub in body['attachments']
+    ]
+    return dict(email_data, body=dict(body, attachments=stubs))
+
+
+class MemoryIndex:
+    def __init__(self):
+        self._hashes = set()
+        self._lock = threading.Lock()
+
+    def known(self, hashes):
+        with self._lock:
+            return {sha256 for sha256 in hashes if sha256 in self._hashes}
+
+    def add(self, hashes):
+        with self._lock:
+            self._hashes.update(hashes)
+
+
+class SqliteIndex:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, stored_at REAL NOT NULL)")
+        self._conn.commit()
+
+    def known(self, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return set()
+        placeholders = ','.join('?' * len(hashes))
+        with self._lock:
+            rows = self._conn.execute(f"SELECT sha256 FROM blobs WHERE sha256 IN ({placeholders})", hashes)
+            return {row[0] for row in rows}
+
+    def add(self, hashes):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO blobs VALUES (?, ?)", [(sha256, now) for sha256 in hashes])
+            self._conn.commit()
+
+
+class FirestoreIndex:
+    def __init__(self, db, collection=None):
+        self.db = db
+        self.collection = db.collection(collection or DEFAULT_INDEX_COLLECTION)
+
+    def known(self, hashes):
+        return backends.existing_ids(self.db, self.collection, hashes)
+
+    def add(self, hashes):
+        backends.write_in_batches(
+            self.db, hashes, lambda batch, sha256: batch.set(self.collection.document(sha256), {'stored_at': time.time()}),
+        )
+
+
+_indexes = backends.Backends('ATTACHMENT_INDEX', 'firestore')
+
+
+def get_index(db=None):
+    """Returns the index selected by ATTACHMENT_INDEX, or None when it is off."""
+    return _indexes.get(
+        (id(db),),
+        memory=MemoryIndex,
+        sqlite=SqliteIndex,
+        firestore=lambda: FirestoreIndex(db),
+    )
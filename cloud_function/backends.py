@@ -0,0 +1,78 @@
+"""
+Storage backends picked by a setting, shared by the delivery ledger, the
+delivery spool and the attachment index.
+
+Each of them comes in three kinds, selected by its environment variable:
+    firestore        Firestore collections
+    sqlite:<path>    a local SQLite file, for tests and local runs
+    memory           in-memory, lost when the instance goes away
+    off              none, get() returns None
+
+A `Backends` keeps the instances it built for warm invocations (the SQLite ones
+keep their connection), one per setting and key: every mailbox gets its own.
+"""
+
+import os
+import threading
+
+# Firestore caps a batched write at 500 operations
+FIRESTORE_BATCH_LIMIT = 500
+
+
+class Backends:
+    def __init__(self, variable, default):
+        self.variable = variable
+        self.default = default
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, memory, sqlite, firestore):
+        """
+            The backend selected by the variable for `key`, built on first use by
+            memory(), sqlite(path) or firestore(). None when the setting is off.
+        """
+        setting = os.environ.get(self.variable, self.default).strip()
+        key = (setting,) + tuple(key)
+        if key in self._instances:
+            return self._instances[key]
+
+        if setting == 'off':
+            backend = None
+        elif setting == 'memory':
+            backend = memory()
+        elif setting.startswith('sqlite:'):
+            backend = sqlite(setting[len('sqlite:'):])
+        elif setting == 'firestore':
+            backend = firestore()
+        else:
+            raise ValueError(f"Unknown {self.variable} {setting!r}")
+
+        with self._lock:
+            return self._instances.setdefault(key, backend)
+
+    def clear(self):
+        with self._lock:
+            self._instances.clear()
+
+
+def sqlite_prefix(namespace):
+    """Prefix of the rows of one mailbox, so several can share a SQLite file."""
+    return f"{namespace}/" if namespace else ''
+
+
+def existing_ids(db, collection, ids):
+    """The IDs in `ids` that have a document in `collection`, in one round trip."""
+    refs = [collection.document(doc_id) for doc_id in ids]
+    if not refs:
+        return set()
+    return {snapshot.id for snapshot in db.get_all(refs) if snapshot.exists}
+
+
+def write_in_batches(db, items, write):
+    """Calls write(batch, item) for each of `items`, committed in as few batched writes as Firestore allows."""
+    items = list(items)
+    for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for item in items[start:start + FIRESTORE_BATCH_LIMIT]:
+            write(batch, item)
+        batch.commit()
@@ -0,0 +1,150 @@
+"""
+Backfill: recovering when the stored historyId is too old for history.list.
+
+Gmail only keeps about a week of history. When the function has been down (or
+the watch expired) for longer, history.list answers 404 for the last_id stored
+in Firestore and nothing can be synced from it. Instead of failing every event
+until somebody re-seeds Firestore, the sync falls back to a backfill:
+
+1. The missed period, from the last successful sync (`synced_at` next to
+   last_id) to now, is cut into windows of BACKFILL_WINDOW_HOURS.
+2. Every window is listed with messages.list (`after:<start> before:<end>` and
+   the label) and its messages are forwarded, up to BACKFILL_CONCURRENCY windows
+   at a time.
+3. Finished windows are recorded in the `gmail_backfill` document, so a backfill
+   cut short by the function timeout resumes where it stopped on the next event.
+4. Once every window is done, last_id is re-seeded with the mailbox historyId
+   taken when the backfill started, and the normal history sync takes over.
+
+The delivery ledger keeps the overlap between windows (and with the messages
+already synced before the outage) from being forwarded twice.
+"""
+
+import os
+import threading
+import time
+
+# Messages of a window are listed in pages of up to 500 IDs
+MESSAGES_PAGE_SIZE = 500
+DEFAULT_WINDOW_HOURS = 6
+DEFAULT_CONCURRENCY = 4
+# How far back to go when the last sync time is unknown
+DEFAULT_MAX_DAYS = 30
+# Messages can reach a label a little after their date, look a bit before the last sync
+OVERLAP_SECONDS = 60 * 60
+
+
+def get_window_seconds():
+    return max(1, int(float(os.environ.get('BACKFILL_WINDOW_HOURS', DEFAULT_WINDOW_HOURS)) * 3600))
+
+
+def get_concurrency():
+    return max(1, int(os.environ.get('BACKFILL_CONCURRENCY', DEFAULT_CONCURRENCY)))
+
+
+def get_max_days():
+    return float(os.environ.get('BACKFILL_MAX_DAYS', DEFAULT_MAX_DAYS))
+
+
+class HistoryExpired(Exception):
+    """history.list has nothing since the given startHistoryId anymore, a backfill is needed."""
+
+
+def is_history_expired(exception):
+    """True for the 404 history.list returns when startHistoryId is too old."""
+    from googleapiclient.errors import HttpError
+    return isinstance(exception, HttpError) and exception.resp.status == 404
+
+
+def backfill_start(synced_at, now):
+    """Epoch seconds the backfill starts from, given the last sync time (None when unknown)."""
+    earliest = now - get_max_days() * 86400
+    if not synced_at:
+        return int(earliest)
+    return int(max(float(synced_at) - OVERLAP_SECONDS, earliest))
+
+
+def plan_windows(after, before, window_seconds=None):
+    """[(start, end)] epoch second windows covering [after, before), oldest first."""
+    window_seconds = window_seconds or get_window_seconds()
+    return [(start, min(start + window_seconds, before)) for start in range(int(after), int(before), window_seconds)]
+
+
+def window_query(window):
+    """Gmail search query for the messages received during `window`."""
+    start, end = window
+    return f"after:{start} before:{end}"
+
+
+def iter_window_message_ids(service, window, label_id=None, page_size=MESSAGES_PAGE_SIZE, execute=None):
+    """
+        Walks every page of messages.list for `window` (and `label_id`), yields
+        message IDs. `execute(request)` runs the requests (request.execute() by default).
+    """
+    execute = execute or (lambda request: request.execute())
+    page_token = None
+    while True:
+        response = execute(service.users().messages().list(
+            userId='me',
+            q=window_query(window),
+            labelIds=[label_id] if label_id else None,
+            maxResults=page_size,
+            pageToken=page_token,
+            fields='messages(id),nextPageToken',
+        ))
+        for message in response.get('messages', []):
+            yield message['id']
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+
+class Checkpoint:
+    """
+        Progress of a backfill in its Firestore document:
+            {'after': ..., 'before': ..., 'window_seconds': ..., 'history_id': ..., 'done': [window starts]}
+        `history_id` is the mailbox historyId when the backfill started, last_id
+        is re-seeded with it at the end.
+    """
+
+    def __init__(self, doc_ref, state):
+        self.doc_ref = doc_ref
+        self.after = int(state['after'])
+        self.before = int(state['before'])
+        self.window_seconds = int(state['window_seconds'])
+        self.history_id = int(state['history_id'])
+        self.done = set(int(start) for start in state.get('done', []))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load_or_start(cls, doc_ref, synced_at, history_id_fn):
+        """The saved checkpoint, or a new one from `synced_at` to now (history_id_fn() gives the historyId)."""
+        snapshot = doc_ref.get()
+        if snapshot.exists:
+            return cls(doc_ref, snapshot.to_dict()), True
+        # historyId first: whatever arrives after it is left to the history sync,
+        # what arrives before `now` is also covered by the windows
+        history_id = int(history_id_fn())
+        now = time.time()
+        state = {
+            'after': backfill_start(synced_at, now),
+            'before': int(now) + 1,
+            'window_seconds': get_window_seconds(),
+            'history_id': history_id,
+            'done': [],
+        }
+        doc_ref.set({**state, 'started_at': now})
+        return cls(doc_ref, state), False
+
+    def pending_windows(self):
+        windows = plan_windows(self.after, self.before, self.window_seconds)
+        return [window for window in windows if window[0] not in self.done]
+
+    def mark_done(self, window):
+        # Windows finish on several threads, the document always gets the whole list
+        with self._lock:
+            self.done.add(window[0])
+            self.doc_ref.set({'done': sorted(self.done)}, merge=True)
+
+    def clear(self):
+        self.doc_ref.delete()
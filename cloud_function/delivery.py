@@ -0,0 +1,377 @@
+"""
+Delivery of parsed emails to the backend.
+
+A single keep-alive `requests.Session` is shared by every invocation of a warm
+instance, so consecutive POSTs reuse the same TCP/TLS connection instead of
+paying a new handshake each time. `BackendDelivery` sends emails from a bounded
+thread pool so one slow response doesn't hold up the rest of the batch.
+
+With BACKEND_BATCH_MODE set, `BatchDelivery` sends all the emails of a sync run
+in a few gzip compressed NDJSON (or JSON array) requests instead.
+
+Every POST goes through the backend rate limiter (see ratelimit.py): a 429, a 5xx
+or a connection error is retried on its own after its Retry-After or a backoff,
+and the requests in flight shrink while the backend is struggling. Once
+BACKEND_FAIL_FAST_AFTER emails (or batches) in a row have failed, the rest of
+the run fails right away instead of waiting on a backend that is down, and
+`undelivered` keeps their payloads for the delivery spool (see spool.py).
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for a single POST, the remaining function budget can make it shorter
+DEFAULT_BACKEND_TIMEOUT_SECONDS = 10
+DEFAULT_BACKEND_MAX_CONCURRENCY = 8
+# Backend answers worth sending the request again for
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Failures in a row after which the backend is taken for down until the next run
+DEFAULT_FAIL_FAST_AFTER = 10
+
+# Batch mode: one request carries up to this many emails / uncompressed bytes
+BATCH_MODES = ('ndjson', 'json')
+DEFAULT_BATCH_MAX_MESSAGES = 100
+DEFAULT_BATCH_MAX_BYTES = 5 * 1024 * 1024
+# Serialized batches waiting to be sent, beyond that the sync waits for the backend
+MAX_PENDING_BATCHES = 2
+
+
+class DeadlineExceeded(Exception):
+    """Raised when there is no function budget left to send a request."""
+
+
+class BackendUnavailable(Exception):
+    """Raised without sending anything once the backend failed too many times in a row."""
+
+
+def get_max_concurrency():
+    return max(1, int(os.environ.get('BACKEND_MAX_CONCURRENCY', DEFAULT_BACKEND_MAX_CONCURRENCY)))
+
+
+def get_fail_fast_after():
+    """Failures in a row before the rest of a run is failed without trying, 0 to always try."""
+    return max(0, int(os.environ.get('BACKEND_FAIL_FAST_AFTER', DEFAULT_FAIL_FAST_AFTER)))
+
+
+# Global variables to hold the pooled session and its threads between invocations
+_session = None
+_executor = None
+_init_lock = threading.Lock()
+
+
+def get_backend_session():
+    """One pooled keep-alive session per instance, sized for the delivery threads."""
+    global _session
+    if _session is None:
+        with _init_lock:
+            if _session is None:
+                # Imported on first use, so it doesn't slow down the cold start
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=get_max_concurrency())
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _init_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_max_concurrency(),
+                    thread_name_prefix='backend-delivery',
+                )
+    return _executor
+
+
+def request_timeout(deadline=None):
+    """
+        Seconds a request may take: BACKEND_TIMEOUT_SECONDS, or less when the
+        function is about to run out of time (`deadline` is a time.monotonic() value).
+    """
+    timeout = float(os.environ.get('BACKEND_TIMEOUT_SECONDS', DEFAULT_BACKEND_TIMEOUT_SECONDS))
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("No time left in the function budget")
+        timeout = min(timeout, remaining)
+    return timeout
+
+
+def is_retryable_error(exception):
+    """True for backend failures that are likely to succeed when sent again."""
+    import requests
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(exception, 'response', None)
+    return isinstance(exception, requests.HTTPError) and response is not None \
+        and response.status_code in RETRYABLE_STATUSES
+
+
+def get_backend_limiter():
+    """Rate (BACKEND_RATE_LIMIT requests per second, none by default), concurrency and retries of the POSTs."""
+    return ratelimit.get_limiter(
+        'backend', is_retryable_error,
+        units_per_second=float(os.environ.get('BACKEND_RATE_LIMIT', 0)),
+        max_concurrency=get_max_concurrency(),
+        max_attempts=int(os.environ.get('BACKEND_MAX_ATTEMPTS', ratelimit.DEFAULT_BACKEND_MAX_ATTEMPTS)),
+    )
+
+
+def _post_once(url, deadline, **kwargs):
+    response = get_backend_session().post(url, timeout=request_timeout(deadline), **kwargs)
+    if response.status_code in RETRYABLE_STATUSES:
+        # Raised here so the limiter retries it, other errors are left to the caller
+        response.raise_for_status()
+    return response
+
+
+def post(url, deadline=None, **kwargs):
+    """POSTs on the pooled session through the backend limiter, retrying throttled and failed attempts."""
+    return get_backend_limiter().call(lambda: _post_once(url, deadline, **kwargs), deadline=deadline)
+
+
+def post_json(url, payload, deadline=None, headers=None):
+    """POSTs `payload` as JSON on the pooled session."""
+    return post(url, deadline, json=payload, headers=headers)
+
+
+def post_stream(url, open_body, deadline=None, headers=None):
+    """
+        POSTs the chunks open_body() yields with chunked transfer encoding, so the
+        body is never held whole. open_body() is called again for every attempt.
+    """
+    return get_backend_limiter().call(
+        lambda: _post_once(url, deadline, data=open_body(), headers=headers), deadline=deadline,
+    )
+
+
+class BackendDelivery:
+    """
+        Sends emails to the backend concurrently.
+
+        `send(email_data, deadline)` does the actual request (main.forward_to_backend).
+        At most `max_in_flight` emails are queued or being sent at once, submit()
+        blocks beyond that so a fast history sync can't pile up parsed emails in memory.
+        wait() returns {message_id: exception} for the ones that failed, and
+        pop_delivered() the IDs that made it. `undelivered` keeps the emails that
+        failed, by message ID. The `on_done` callback given to submit() runs once
+        the email was sent or failed.
+    """
+
+    def __init__(self, send, deadline=None, max_in_flight=None):
+        self.send = send
+        self.deadline = deadline
+        self.max_in_flight = max_in_flight or get_max_concurrency() * 2
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._futures = {}
+        self.delivered = 0
+        self.undelivered = {}
+        self.fail_fast_after = get_fail_fast_after()
+        self._failures_in_a_row = 0
+        self._done_ids = []
+        self._done_lock = threading.Lock()
+
+    def _run(self, email_data, on_done=None):
+        try:
+            if self.fail_fast_after and self._failures_in_a_row >= self.fail_fast_after:
+                raise BackendUnavailable(f"Backend failed {self._failures_in_a_row} times in a row")
+            self.send(email_data, self.deadline)
+        except Exception:
+            with self._done_lock:
+                self._failures_in_a_row += 1
+                self.undelivered[email_data['message_id']] = email_data
+            raise
+        else:
+            with self._done_lock:
+                self._failures_in_a_row = 0
+                self._done_ids.append(email_data['message_id'])
+        finally:
+            self._slots.release()
+            if on_done is not None:
+                on_done()
+
+    def pop_delivered(self):
+        """IDs delivered since the last call, so they can be recorded as we go."""
+        with self._done_lock:
+            done, self._done_ids = self._done_ids, []
+        return done
+
+    def submit(self, email_data, on_done=None):
+        self._slots.acquire()
+        try:
+            # The thread records into the metrics of the invocation that submitted it
+            future = metrics.submit_in_context(get_executor(), self._run, email_data, on_done)
+        except Exception:
+            self._slots.release()
+            if on_done is not None:
+                on_done()
+            raise
+        self._futures[email_data['message_id']] = future
+
+    def wait(self):
+        failed = {}
+        for message_id, future in self._futures.items():
+            exception = future.exception()
+            if exception is None:
+                self.delivered += 1
+            else:
+                logger.error(f"❌ Could not forward {message_id}: {exception}")
+                failed[message_id] = exception
+        self._futures = {}
+        return failed
+
+
+def get_batch_mode():
+    """'ndjson', 'json', or None when every email gets its own request."""
+    mode = os.environ.get('BACKEND_BATCH_MODE', '').strip().lower()
+    if not mode or mode == 'off':
+        return None
+    if mode not in BATCH_MODES:
+        raise ValueError(f"BACKEND_BATCH_MODE must be one of {BATCH_MODES} or empty, got {mode!r}")
+    return mode
+
+
+class BatchDelivery:
+    """
+        Gathers the emails of a sync run into a few bulk requests.
+
+        Emails are serialized as they are submitted and flushed as one request when
+        the next one would go over `max_messages` or `max_bytes` (a single email
+        bigger than `max_bytes` is sent alone). Requests are sent one after another
+        in submission order, so the backend receives emails in history order, but
+        off the sync thread so fetching continues meanwhile.
+
+        The backend answers with an acknowledgement per email:
+            {"results": [{"message_id": "...", "status": "ok"}, ...]}
+        Emails that are not acknowledged with "ok" are reported as failed by wait(),
+        and kept in `undelivered`.
+    """
+
+    def __init__(self, url, deadline=None, mode='ndjson', max_messages=None, max_bytes=None, compress=None):
+        self.url = url
+        self.deadline = deadline
+        self.mode = mode
+        self.max_messages = max_messages or int(os.environ.get('BACKEND_BATCH_MAX_MESSAGES', DEFAULT_BATCH_MAX_MESSAGES))
+        self.max_bytes = max_bytes or int(os.environ.get('BACKEND_BATCH_MAX_BYTES', DEFAULT_BATCH_MAX_BYTES))
+        if compress is None:
+            compress = os.environ.get('BACKEND_BATCH_GZIP', 'true').lower() != 'false'
+        self.compress = compress
+        self.delivered = 0
+        self.requests_sent = 0
+        self.undelivered = {}
+        self.fail_fast_after = get_fail_fast_after()
+        self._failures_in_a_row = 0
+        self._ids = []
+        self._lines = []
+        self._size = 0
+        self._futures = []
+        self._previous = None
+        self._done_ids = []
+        self._done_lock = threading.Lock()
+
+    def pop_delivered(self):
+        """IDs acknowledged since the last call, so they can be recorded as we go."""
+        with self._done_lock:
+            done, self._done_ids = self._done_ids, []
+        return done
+
+    def submit(self, email_data, on_done=None):
+        line = json.dumps(email_data, separators=(',', ':')).encode('utf-8')
+        # The line is all that is kept of the email, bounded by max_bytes per batch
+        if on_done is not None:
+            on_done()
+        if self._lines and (len(self._lines) >= self.max_messages or self._size + len(line) > self.max_bytes):
+            self.flush()
+        self._ids.append(email_data['message_id'])
+        self._lines.append(line)
+        self._size += len(line)
+
+    def _encode(self, lines):
+        if self.mode == 'json':
+            body = b'[' + b','.join(lines) + b']'
+            content_type = 'application/json'
+        else:
+            body = b'\n'.join(lines) + b'\n'
+            content_type = 'application/x-ndjson'
+        headers = {'Content-Type': content_type}
+        if self.compress:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    def _keep_undelivered(self, message_ids, lines, keep):
+        with self._done_lock:
+            for message_id, line in zip(message_ids, lines):
+                if message_id in keep:
+                    self.undelivered[message_id] = json.loads(line)
+
+    def _send(self, previous, message_ids, lines):
+        # Keep the backend's view in order: wait for the batch before this one
+        if previous is not None:
+            previous.exception()
+        try:
+            if self.fail_fast_after and self._failures_in_a_row >= self.fail_fast_after:
+                raise BackendUnavailable(f"Backend failed {self._failures_in_a_row} batches in a row")
+            body, headers = self._encode(lines)
+            with metrics.span('backend.batch_post'):
+                response = post(self.url, self.deadline, data=body, headers=headers)
+            metrics.add('backend.bytes_sent', len(body))
+            response.raise_for_status()
+            results = response.json().get('results', [])
+        except Exception:
+            self._failures_in_a_row += 1
+            self._keep_undelivered(message_ids, lines, set(message_ids))
+            raise
+        self._failures_in_a_row = 0
+        acked = {item.get('message_id') for item in results if item.get('status') == 'ok'}
+        with self._done_lock:
+            self._done_ids.extend(message_id for message_id in message_ids if message_id in acked)
+        not_acked = {message_id for message_id in message_ids if message_id not in acked}
+        self._keep_undelivered(message_ids, lines, not_acked)
+        return not_acked
+
+    def flush(self):
+        if not self._lines:
+            return
+        message_ids, lines = self._ids, self._lines
+        self._ids, self._lines, self._size = [], [], 0
+        pending = sum(1 for _, future in self._futures if not future.done())
+        if pending >= MAX_PENDING_BATCHES:
+            self._previous.exception()
+        future = metrics.submit_in_context(get_executor(), self._send, self._previous, message_ids, lines)
+        self._futures.append((message_ids, future))
+        self._previous = future
+        self.requests_sent += 1
+
+    def wait(self):
+        self.flush()
+        failed = {}
+        for message_ids, future in self._futures:
+            exception = future.exception()
+            if exception is not None:
+                logger.error(f"❌ Could not forward a batch of {len(message_ids)} emails: {exception}")
+                failed.update({message_id: exception for message_id in message_ids})
+                continue
+            not_acked = future.result()
+            for message_id in not_acked:
+                failed[message_id] = RuntimeError("Backend did not acknowledge the email")
+            self.delivered += len(message_ids) - len(not_acked)
+        self._futures = []
+        self._previous = None
+        return failed
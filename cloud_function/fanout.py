@@ -0,0 +1,130 @@
+"""
+Fan-out mode: the sync stage only walks the history and hands message IDs to workers.
+
+With PIPELINE_MODE=fanout, process_gmail_notification doesn't fetch anything.
+It publishes the wanted message IDs, in chunks of WORKER_BATCH_SIZE, to the
+WORKER_TOPIC Pub/Sub topic and advances last_id once they are all published.
+Every chunk triggers process_message_batch, which fetches, parses and forwards
+it. Workers run on as many instances as Cloud Functions allows, so a burst of
+thousands of emails scales out instead of timing out a single invocation.
+
+A work message is JSON:
+    {"message_ids": ["18c...", ...], "email_address": "...", "history_id": 12345}
+"""
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_MODES = ('inline', 'fanout')
+# One Gmail batch request per worker invocation
+DEFAULT_WORKER_BATCH_SIZE = 100
+
+
+def get_pipeline_mode():
+    """'inline' (sync and forward in one invocation, the default) or 'fanout'."""
+    mode = os.environ.get('PIPELINE_MODE', '').strip().lower() or 'inline'
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"PIPELINE_MODE must be one of {PIPELINE_MODES}, got {mode!r}")
+    return mode
+
+
+def get_worker_topic():
+    """Full topic path of WORKER_TOPIC, a bare topic name is completed with the project."""
+    topic = os.environ.get('WORKER_TOPIC', '').strip()
+    if not topic:
+        raise ValueError("PIPELINE_MODE=fanout needs WORKER_TOPIC")
+    if topic.startswith('projects/'):
+        return topic
+    project = os.environ.get('GOOGLE_CLOUD_PROJECT') or os.environ.get('GCP_PROJECT')
+    if not project:
+        raise ValueError(f"Set WORKER_TOPIC to projects/<project>/topics/{topic} or set GOOGLE_CLOUD_PROJECT")
+    return f"projects/{project}/topics/{topic}"
+
+
+def get_worker_batch_size():
+    return max(1, int(os.environ.get('WORKER_BATCH_SIZE', DEFAULT_WORKER_BATCH_SIZE)))
+
+
+# Global publisher reused by warm invocations, it keeps its gRPC channel open
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                # Only the fan-out mode needs the Pub/Sub client
+                from google.cloud import pubsub_v1
+                _publisher = pubsub_v1.PublisherClient()
+    return _publisher
+
+
+def encode_work(message_ids, email_address=None, history_id=None):
+    work = {'message_ids': list(message_ids)}
+    if email_address:
+        work['email_address'] = email_address
+    if history_id:
+        work['history_id'] = history_id
+    return json.dumps(work, separators=(',', ':')).encode('utf-8')
+
+
+def decode_work(data):
+    """The work message carried by a Pub/Sub `data` payload (already base64 decoded)."""
+    work = json.loads(data)
+    if not isinstance(work.get('message_ids'), list):
+        raise ValueError("Work message has no message_ids")
+    return work
+
+
+class WorkPublisher:
+    """
+        Publishes message IDs to the worker topic in chunks of `batch_size`.
+
+        add() buffers IDs and publishes a chunk as soon as it is full, the client
+        sends it in the background. wait() publishes the rest and returns
+        {message_id: exception} for the IDs whose chunk could not be published.
+    """
+
+    def __init__(self, topic, publisher=None, batch_size=None, email_address=None, history_id=None):
+        self.topic = topic
+        self.publisher = publisher or get_publisher()
+        self.batch_size = batch_size or get_worker_batch_size()
+        self.email_address = email_address
+        self.history_id = history_id
+        self.published = 0
+        self.messages_sent = 0
+        self._pending = []
+        self._futures = []
+
+    def add(self, msg_id):
+        self._pending.append(msg_id)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        message_ids, self._pending = self._pending, []
+        data = encode_work(message_ids, self.email_address, self.history_id)
+        self._futures.append((message_ids, self.publisher.publish(self.topic, data)))
+        self.messages_sent += 1
+
+    def wait(self):
+        self.flush()
+        failed = {}
+        for message_ids, future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"❌ Could not publish {len(message_ids)} message IDs: {e}")
+                failed.update({message_id: e for message_id in message_ids})
+            else:
+                self.published += len(message_ids)
+        self._futures = []
+        return failed
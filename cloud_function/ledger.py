@@ -0,0 +1,110 @@
+"""
+Delivery ledger: which messages already reached the backend.
+
+When part of an event fails, Pub/Sub redelivers the whole event and the sync runs
+over the same history range again. The ledger lets that retry skip every message
+that was already forwarded, so it only costs the work that actually failed.
+
+Reads and writes are batched: one `get_all` round trip tells which IDs of a chunk
+were delivered, and delivered IDs are written with batched writes. Each message
+costs one document read and one document write.
+
+DELIVERY_LEDGER selects the backend (see backends.py):
+    firestore (default)   one document per message in the `delivered_messages` collection
+    sqlite:<path>         a local SQLite file, for tests and local runs
+    memory                an in-memory set, lost when the instance goes away
+    off                   no ledger
+
+Each watched mailbox (see mailboxes.py) gets its own ledger: a `collection`
+under its Firestore document, or a prefix on its rows in SQLite.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import backends
+
+DEFAULT_LEDGER_COLLECTION = 'delivered_messages'
+# Ledger entries only need to outlive Pub/Sub retries, a TTL policy removes them afterwards
+DEFAULT_LEDGER_RETENTION_DAYS = 30
+
+
+class MemoryLedger:
+    def __init__(self):
+        self._delivered = set()
+        self._lock = threading.Lock()
+
+    def delivered_ids(self, msg_ids):
+        with self._lock:
+            return {msg_id for msg_id in msg_ids if msg_id in self._delivered}
+
+    def record_delivered(self, msg_ids):
+        with self._lock:
+            self._delivered.update(msg_ids)
+
+
+class SqliteLedger:
+    def __init__(self, path, namespace=None):
+        self.prefix = backends.sqlite_prefix(namespace)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS delivered (message_id TEXT PRIMARY KEY, delivered_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def delivered_ids(self, msg_ids):
+        msg_ids = [self.prefix + msg_id for msg_id in msg_ids]
+        found = set()
+        with self._lock:
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(msg_ids), 500):
+                chunk = msg_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT message_id FROM delivered WHERE message_id IN ({placeholders})", chunk,
+                )
+                found.update(row[0][len(self.prefix):] for row in rows)
+        return found
+
+    def record_delivered(self, msg_ids):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO delivered (message_id, delivered_at) VALUES (?, ?)",
+                [(self.prefix + msg_id, now) for msg_id in msg_ids],
+            )
+            self._conn.commit()
+
+
+class FirestoreLedger:
+    def __init__(self, db, collection=None):
+        self.db = db
+        self.collection = db.collection(collection or DEFAULT_LEDGER_COLLECTION)
+
+    def delivered_ids(self, msg_ids):
+        return backends.existing_ids(self.db, self.collection, msg_ids)
+
+    def record_delivered(self, msg_ids):
+        retention = int(os.environ.get('LEDGER_RETENTION_DAYS', DEFAULT_LEDGER_RETENTION_DAYS))
+        now = datetime.now(timezone.utc)
+        entry = {'delivered_at': now, 'expire_at': now + timedelta(days=retention)}
+        backends.write_in_batches(
+            self.db, msg_ids, lambda batch, msg_id: batch.set(self.collection.document(msg_id), entry),
+        )
+
+
+_ledgers = backends.Backends('DELIVERY_LEDGER', 'firestore')
+
+
+def get_ledger(db=None, collection=None):
+    """Returns the ledger selected by DELIVERY_LEDGER, or None when it is off."""
+    return _ledgers.get(
+        (id(db), collection),
+        memory=MemoryLedger,
+        sqlite=lambda path: SqliteLedger(path, namespace=collection),
+        firestore=lambda: FirestoreLedger(db, collection),
+    )
@@ -0,0 +1,148 @@
+"""
+Mailboxes watched by this deployment.
+
+By default there is a single mailbox, authorized with the GMAIL_* environment
+variables, and its state lives in the `state` collection as it always did.
+
+With GMAIL_ACCOUNTS set (a JSON secret), one deployment serves many mailboxes:
+
+    {
+        "alice@example.com": {"refresh_token": "1//...", "labels": "Banks,Receipts"},
+        "bob@example.com": {"refresh_token": "1//...", "client_id": "...", "client_secret": "..."}
+    }
+
+`client_id` and `client_secret` default to GMAIL_CLIENT_ID and
+GMAIL_CLIENT_SECRET, `labels` to EMAIL_FETCHING_LABELS. Notifications are routed
+by their `emailAddress`. Every mailbox keeps its documents under
+`mailboxes/<email address>/`, so no single document is written by every
+notification of every account.
+"""
+
+import json
+import os
+import threading
+
+
+class UnknownMailboxError(ValueError):
+    """Raised for a notification about a mailbox that isn't in GMAIL_ACCOUNTS."""
+
+
+def normalize_address(email_address):
+    return (email_address or '').strip().lower()
+
+
+def parse_labels(raw):
+    """Label names from a comma separated string (or a list)."""
+    if isinstance(raw, (list, tuple)):
+        return tuple(label.strip() for label in raw if label.strip())
+    return tuple(label.strip() for label in (raw or '').split(",") if label.strip())
+
+
+class Mailbox:
+    """
+        One watched Gmail account. `key` is None for the single mailbox configured
+        with the GMAIL_* variables, and the normalized address otherwise.
+    """
+
+    def __init__(self, email_address, refresh_token, client_id, client_secret, labels=None, key=None):
+        self.email_address = email_address
+        self.refresh_token = refresh_token
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # None means EMAIL_FETCHING_LABELS
+        self.labels = labels
+        self.key = key
+
+    def fetching_labels(self):
+        if self.labels is not None:
+            return self.labels
+        return parse_labels(os.environ.get('EMAIL_FETCHING_LABELS', ''))
+
+    def document(self, db, name):
+        """The mailbox's state document `name` (gmail_sync, gmail_sync_lease, gmail_labels...)."""
+        if self.key is None:
+            return db.collection('state').document(name)
+        return db.collection('mailboxes').document(self.key).collection('state').document(name)
+
+    def ledger_collection(self):
+        """Collection of the delivery ledger, None for the default one."""
+        if self.key is None:
+            return None
+        return f"mailboxes/{self.key}/delivered_messages"
+
+    def spool_collection(self):
+        """Collection of the delivery spool, None for the default one."""
+        if self.key is None:
+            return None
+        return f"mailboxes/{self.key}/delivery_spool"
+
+    def dead_letter_collection(self):
+        """Collection of the emails the spool gave up on, None for the default one."""
+        if self.key is None:
+            return None
+        return f"mailboxes/{self.key}/dead_letters"
+
+
+# GMAIL_ACCOUNTS parsed once per instance (and again if the secret changes)
+_accounts_cache = {'raw': None, 'mailboxes': {}}
+_accounts_lock = threading.Lock()
+
+
+def load_accounts():
+    """{normalized address: Mailbox} from GMAIL_ACCOUNTS, empty when it isn't set."""
+    global _accounts_cache
+    raw = os.environ.get('GMAIL_ACCOUNTS', '').strip()
+    cached = _accounts_cache
+    if cached['raw'] == raw:
+        return cached['mailboxes']
+
+    with _accounts_lock:
+        mailboxes = {}
+        if raw:
+            accounts = json.loads(raw)
+            if not isinstance(accounts, dict):
+                raise ValueError("GMAIL_ACCOUNTS must be a JSON object keyed by email address")
+            for email_address, account in accounts.items():
+                if not account.get('refresh_token'):
+                    raise ValueError(f"GMAIL_ACCOUNTS[{email_address!r}] has no refresh_token")
+                key = normalize_address(email_address)
+                mailboxes[key] = Mailbox(
+                    email_address,
+                    account['refresh_token'],
+                    account.get('client_id') or os.environ.get('GMAIL_CLIENT_ID'),
+                    account.get('client_secret') or os.environ.get('GMAIL_CLIENT_SECRET'),
+                    labels=parse_labels(account['labels']) if 'labels' in account else None,
+                    key=key,
+                )
+        _accounts_cache = {'raw': raw, 'mailboxes': mailboxes}
+    return mailboxes
+
+
+def is_multi_mailbox():
+    return bool(load_accounts())
+
+
+def default_mailbox(email_address=None):
+    """The single mailbox of the GMAIL_* variables."""
+    return Mailbox(
+        email_address,
+        os.environ.get('GMAIL_REFRESH_TOKEN'),
+        os.environ.get('GMAIL_CLIENT_ID'),
+        os.environ.get('GMAIL_CLIENT_SECRET'),
+    )
+
+
+def get_mailbox(email_address=None):
+    """The Mailbox a notification (or work message) for `email_address` belongs to."""
+    accounts = load_accounts()
+    if not accounts:
+        return default_mailbox(email_address)
+    mailbox = accounts.get(normalize_address(email_address))
+    if mailbox is None:
+        raise UnknownMailboxError(f"{email_address!r} is not in GMAIL_ACCOUNTS")
+    return mailbox
+
+
+def all_mailboxes():
+    """Every configured mailbox, for scripts that set up or renew the watches."""
+    return list(load_accounts().values()) or [default_mailbox(os.environ.get('GMAIL_USER_EMAIL'))]
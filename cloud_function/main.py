@@ -1,16 +1,32 @@
 import base64
+import functools
 import json
 import logging
 import os
-import requests
 import re
 import html
-from datetime import datetime
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+# The runtime has already loaded functions_framework to serve us, importing it is free.
+# The Google client libraries (Firestore, Gmail, google-auth) take hundreds of
+# milliseconds to import, so they are imported where they are first needed, or in
+# the background while the instance starts (see _warm_up at the end of this file).
 import functions_framework
-from google.cloud import firestore
+
+import attachments
+import backfill
+import delivery
+import fanout
+import ledger
+import mailboxes
+import metrics
+import ratelimit
+import rules
+import spool
+import streaming
 
 # 🛠️ Setup Logging
 logging.basicConfig(level=logging.INFO)
@@ -18,16 +34,38 @@ logger = logging.getLogger(__name__)
 
 # Global variable to hold the DB client
 _db = None
+_db_lock = threading.Lock()
 
 def get_db():
     # The client automatically finds your credentials 
     # when running inside Google Cloud
     global _db
     if _db is None:
-        _db = firestore.Client()
+        with _db_lock:
+            if _db is None:
+                from google.cloud import firestore
+                _db = firestore.Client()
     return _db
 
-@firestore.transactional
+
+def _transactional(fn):
+    """
+        firestore.transactional, applied on the first call so that importing this
+        module doesn't import the Firestore library.
+    """
+    wrapped = None
+
+    @functools.wraps(fn)
+    def wrapper(transaction, *args, **kwargs):
+        nonlocal wrapped
+        if wrapped is None:
+            from google.cloud import firestore
+            wrapped = firestore.transactional(fn)
+        return wrapped(transaction, *args, **kwargs)
+    return wrapper
+
+
+@_transactional
 def update_in_transaction(transaction, doc_ref, new_id):
     """
         In a Cloud Function environment, things happen very fast and often in parallel.
@@ -40,44 +78,513 @@ def update_in_transaction(transaction, doc_ref, new_id):
     
     # 🏁 The "Moving Forward" Rule
     if new_id > current_id:
-        transaction.update(doc_ref, {'last_id': new_id})
+        # synced_at tells a backfill where to start if this historyId ever expires
+        transaction.update(doc_ref, {'last_id': new_id, 'synced_at': time.time()})
         print(f"Update successful: {new_id}")
     else:
         print(f"Update skipped: {new_id} is older than {current_id}")
 
 
-def get_gmail_service():
-    """Authorizes the Gmail API using Refresh Tokens from Secret Manager."""
-    creds = Credentials(
-        token=None,
-        refresh_token=os.environ.get('GMAIL_REFRESH_TOKEN'),
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.environ.get('GMAIL_CLIENT_ID'),
-        client_secret=os.environ.get('GMAIL_CLIENT_SECRET'),
+# 🔒 Single-flight sync lease
+# Gmail sends notifications in bursts. Only the invocation holding the lease syncs,
+# the others record the newest historyId they saw and exit. The holder keeps
+# syncing until it has caught up with the newest recorded historyId.
+# The lease expires on its own if its holder dies, it must outlive a function run.
+DEFAULT_SYNC_LEASE_TTL_SECONDS = 90
+
+
+def _sync_lease_ttl():
+    return int(os.environ.get('SYNC_LEASE_TTL_SECONDS', DEFAULT_SYNC_LEASE_TTL_SECONDS))
+
+
+@_transactional
+def acquire_sync_lease(transaction, lease_ref, owner, history_id):
+    """
+        Takes the lease when it is free or expired and returns True. Otherwise only
+        records `history_id` as the newest one seen, for the holder to pick up.
+    """
+    snapshot = lease_ref.get(transaction=transaction)
+    lease = snapshot.to_dict() if snapshot.exists else {}
+    latest_id = max(int(lease.get('latest_history_id') or 0), history_id)
+    now = time.time()
+
+    holder = lease.get('owner')
+    if holder and holder != owner and float(lease.get('expires_at') or 0) > now:
+        transaction.set(lease_ref, {'latest_history_id': latest_id}, merge=True)
+        return False
+
+    transaction.set(lease_ref, {
+        'owner': owner,
+        'expires_at': now + _sync_lease_ttl(),
+        'latest_history_id': latest_id,
+    })
+    return True
+
+
+@_transactional
+def renew_or_release_sync_lease(transaction, lease_ref, owner, synced_id, keep_going=True):
+    """
+        Called by the holder after syncing up to `synced_id`. Returns the next
+        historyId to sync to (and extends the lease) when newer notifications were
+        recorded meanwhile, or None after releasing the lease. With `keep_going`
+        False the lease is released either way, and the newer historyId is still
+        returned to tell the caller it left work behind.
+    """
+    snapshot = lease_ref.get(transaction=transaction)
+    lease = snapshot.to_dict() if snapshot.exists else {}
+    if lease.get('owner') not in (None, owner):
+        # Our lease expired and somebody else took over, they will catch up
+        return None
+
+    latest_id = int(lease.get('latest_history_id') or 0)
+    if keep_going and latest_id > synced_id:
+        transaction.set(lease_ref, {'owner': owner, 'expires_at': time.time() + _sync_lease_ttl()}, merge=True)
+        return latest_id
+
+    transaction.set(lease_ref, {'owner': None, 'expires_at': 0}, merge=True)
+    return latest_id if latest_id > synced_id else None
+
+
+def lease_owner(cloud_event):
+    """
+        Who holds the lease for this invocation: the CloudEvent id, which every
+        delivery of the event shares. When a holder is killed (timeout, OOM), the
+        Pub/Sub redelivery of its event takes its lease back instead of being
+        coalesced into a lease nobody works on anymore.
+    """
+    try:
+        event_id = cloud_event['id']
+    except (KeyError, TypeError):
+        event_id = None
+    return event_id or uuid.uuid4().hex
+
+
+@_transactional
+def extend_sync_lease(transaction, lease_ref, owner):
+    """Pushes the expiry of our lease back during long syncs, False when it isn't ours anymore."""
+    snapshot = lease_ref.get(transaction=transaction)
+    lease = snapshot.to_dict() if snapshot.exists else {}
+    if lease.get('owner') != owner:
+        return False
+    transaction.set(lease_ref, {'expires_at': time.time() + _sync_lease_ttl()}, merge=True)
+    return True
+
+
+# Gmail clients kept between warm invocations, one per mailbox:
+# {mailbox key: {'creds': Credentials, 'service': Resource}}
+_gmail_clients = {}
+_gmail_auth_request = None
+_gmail_lock = threading.Lock()
+
+# Refresh the access token this long before Google says it expires, so a
+# token never runs out in the middle of an invocation.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+def _token_is_fresh(creds):
+    """True when the cached access token is still good for a while."""
+    if creds is None or not creds.token or creds.expiry is None:
+        return False
+    # google-auth keeps `expiry` as a naive UTC datetime
+    return creds.expiry - TOKEN_REFRESH_MARGIN > datetime.utcnow()
+
+
+def get_gmail_service(mailbox=None):
+    """
+        Authorizes the Gmail API using Refresh Tokens from Secret Manager.
+
+        The credentials and the API client live as long as the instance does. Warm
+        invocations reuse them without any network call, and the token is only
+        refreshed when it is about to expire. The lock makes sure overlapping
+        calls refresh it once instead of each racing to oauth2.googleapis.com.
+        Each mailbox (see mailboxes.py) gets its own cached client.
+    """
+    global _gmail_auth_request
+    mailbox = mailbox or mailboxes.default_mailbox()
+
+    # ⚡ Fast path: no locking while the token is fresh
+    client = _gmail_clients.get(mailbox.key)
+    if client is not None and _token_is_fresh(client['creds']):
+        return client['service']
+
+    with _gmail_lock:
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from googleapiclient.discovery import build
+
+        client = _gmail_clients.get(mailbox.key)
+        if client is None:
+            creds = Credentials(
+                token=None,
+                refresh_token=mailbox.refresh_token,
+                token_uri="https://oauth2.googleapis.com/token",
+                client_id=mailbox.client_id,
+                client_secret=mailbox.client_secret,
+            )
+            client = {'creds': creds, 'service': None}
+        # Another caller may have refreshed while we were waiting on the lock
+        if not _token_is_fresh(client['creds']):
+            if _gmail_auth_request is None:
+                _gmail_auth_request = Request()
+            with metrics.span('gmail.token_refresh'):
+                client['creds'].refresh(_gmail_auth_request)
+        if client['service'] is None:
+            # static_discovery reads the Gmail discovery document bundled with
+            # google-api-python-client instead of downloading it.
+            client['service'] = build(
+                'gmail', 'v1',
+                credentials=client['creds'],
+                static_discovery=True,
+                cache_discovery=False,
+            )
+        _gmail_clients[mailbox.key] = client
+    return client['service']
+
+def gmail_limiter():
+    """
+        Quota, concurrency and retries of every Gmail API call of the instance (see
+        ratelimit.py). Shared by the mailboxes: Gmail's quota is per user, so this
+        errs on the safe side when an instance serves several of them.
+    """
+    return ratelimit.get_limiter(
+        'gmail', is_retryable_error,
+        units_per_second=float(os.environ.get('GMAIL_QUOTA_UNITS_PER_SECOND', ratelimit.DEFAULT_GMAIL_QUOTA_UNITS_PER_SECOND)),
+        max_concurrency=int(os.environ.get('GMAIL_MAX_CONCURRENCY', ratelimit.DEFAULT_GMAIL_MAX_CONCURRENCY)),
+        max_attempts=int(os.environ.get('GMAIL_MAX_ATTEMPTS', ratelimit.DEFAULT_GMAIL_MAX_ATTEMPTS)),
     )
-    if not creds.valid:
-        creds.refresh(Request())
-    return build('gmail', 'v1', credentials=creds)
 
-def get_label_id(service, label_list):
-    """Find label ID by name"""
-    results = service.users().labels().list(userId='me').execute()
-    labels = results.get('labels', [])
 
-    label_id_list = []
+def gmail_execute(request, method, deadline=None):
+    """request.execute() through the Gmail limiter, `method` tells its cost in quota units."""
+    return gmail_limiter().call(request.execute, ratelimit.GMAIL_QUOTA_UNITS[method], deadline)
 
-    for label_name in label_list:
-        for label in labels:
-            if label['name'] == label_name:
-                label_id_list.append(label['id'])
-    
-    return label_id_list
 
+def new_gmail_service(mailbox=None):
+    """
+        A Gmail client of its own for a worker thread (the cached one must not be
+        shared between threads), using the cached, refreshed credentials.
+    """
+    from googleapiclient.discovery import build
+
+    mailbox = mailbox or mailboxes.default_mailbox()
+    get_gmail_service(mailbox)
+    return build('gmail', 'v1', credentials=_gmail_clients[mailbox.key]['creds'],
+                 static_discovery=True, cache_discovery=False)
+
+
+def get_gmail_session(mailbox=None):
+    """An AuthorizedSession on the cached credentials, for the raw requests the API client can't stream."""
+    mailbox = mailbox or mailboxes.default_mailbox()
+    get_gmail_service(mailbox)
+    client = _gmail_clients[mailbox.key]
+    if client.get('session') is None:
+        from google.auth.transport.requests import AuthorizedSession
+        client['session'] = AuthorizedSession(client['creds'])
+    return client['session']
+
+
+def get_fetching_labels(mailbox=None):
+    """Label names to process, from the mailbox's labels or the comma separated EMAIL_FETCHING_LABELS."""
+    if mailbox is not None:
+        return mailbox.fetching_labels()
+    return mailboxes.parse_labels(os.environ.get('EMAIL_FETCHING_LABELS', ''))
+
+
+def fetch_label_map(service, deadline=None):
+    """Fetches every label of the mailbox as a {name: id} dict."""
+    with metrics.span('gmail.labels_list'):
+        results = gmail_execute(service.users().labels().list(userId='me'), 'labels.list', deadline)
+    return {label['name']: label['id'] for label in results.get('labels', [])}
+
+
+# Global cache of resolved labels, shared by warm invocations, one entry per mailbox key.
+# ids_by_name maps every label name of the mailbox to its ID, plus the names we were
+# asked about that don't exist (as None), so those don't trigger a refresh each time.
+_label_caches = {}
+_EMPTY_LABEL_CACHE = {'ids_by_name': {}, 'fetched_at': 0.0, 'names': None, 'label_ids': frozenset()}
+_label_lock = threading.Lock()
+
+# How long resolved label IDs are trusted before asking Gmail again
+DEFAULT_LABEL_CACHE_TTL_SECONDS = 6 * 60 * 60
+
+
+def _label_cache_ttl():
+    return int(os.environ.get('LABEL_CACHE_TTL_SECONDS', DEFAULT_LABEL_CACHE_TTL_SECONDS))
+
+
+def _labels_cover(ids_by_name, fetched_at, label_names, now):
+    """True when a cached mapping is fresh and knows about every wanted name."""
+    if now - fetched_at > _label_cache_ttl():
+        return False
+    return all(name in ids_by_name for name in label_names)
+
+
+def _remember_labels(ids_by_name, fetched_at, label_names, mailbox_key=None):
+    label_ids = frozenset(ids_by_name[name] for name in label_names if ids_by_name.get(name))
+    _label_caches[mailbox_key] = {
+        'ids_by_name': ids_by_name,
+        'fetched_at': fetched_at,
+        'names': label_names,
+        'label_ids': label_ids,
+    }
+    return label_ids
+
+
+def _resolve_labels(service, label_names, labels_doc_ref, now, mailbox_key=None, deadline=None):
+    """
+        Returns a (ids_by_name, fetched_at) mapping that knows every wanted name.
+        Must be called holding _label_lock.
+    """
+    cached = _label_caches.get(mailbox_key, _EMPTY_LABEL_CACHE)
+    if _labels_cover(cached['ids_by_name'], cached['fetched_at'], label_names, now):
+        return cached['ids_by_name'], cached['fetched_at']
+
+    if labels_doc_ref is not None:
+        snapshot = labels_doc_ref.get()
+        if snapshot.exists:
+            stored = snapshot.to_dict() or {}
+            stored_ids = stored.get('ids_by_name') or {}
+            stored_at = float(stored.get('fetched_at') or 0)
+            if _labels_cover(stored_ids, stored_at, label_names, now):
+                return stored_ids, stored_at
+
+    print(f"🏷️ Refreshing label IDs for {list(label_names)}")
+    mailbox_labels = fetch_label_map(service, deadline)
+    # Keep the whole mailbox map so other names resolve without another call,
+    # and remember the wanted names Gmail doesn't have as None.
+    ids_by_name = dict(mailbox_labels)
+    for name in label_names:
+        ids_by_name.setdefault(name, None)
+    if labels_doc_ref is not None:
+        labels_doc_ref.set({'ids_by_name': ids_by_name, 'fetched_at': now})
+    return ids_by_name, now
+
+
+def get_label_ids(service, label_names, labels_doc_ref=None, mailbox_key=None, deadline=None):
+    """
+        Resolves label names to a frozenset of label IDs.
+
+        Looks in the instance cache first, then in the copy persisted in Firestore
+        (`labels_doc_ref`), and only calls labels.list when both are expired or
+        don't know one of the names (a "miss", e.g. EMAIL_FETCHING_LABELS changed).
+    """
+    label_names = tuple(label_names)
+    now = time.time()
+
+    # ⚡ Same names as last time and still fresh: the frozenset is ready to use
+    cached = _label_caches.get(mailbox_key, _EMPTY_LABEL_CACHE)
+    if cached['names'] == label_names and now - cached['fetched_at'] <= _label_cache_ttl():
+        return cached['label_ids']
+
+    with _label_lock:
+        ids_by_name, fetched_at = _resolve_labels(service, label_names, labels_doc_ref, now, mailbox_key, deadline)
+        return _remember_labels(ids_by_name, fetched_at, label_names, mailbox_key)
+
+
+def resolve_label_names(service, label_names, labels_doc_ref=None, mailbox_key=None, deadline=None):
+    """{name: id} for other label names (e.g. the ones rules use), None when missing."""
+    with _label_lock:
+        ids_by_name, fetched_at = _resolve_labels(
+            service, tuple(label_names), labels_doc_ref, time.time(), mailbox_key, deadline,
+        )
+        cached = _label_caches.get(mailbox_key, _EMPTY_LABEL_CACHE)
+        if ids_by_name is not cached['ids_by_name']:
+            # Keep the fast path of get_label_ids() in line with the new mapping
+            _remember_labels(ids_by_name, fetched_at, cached['names'] or (), mailbox_key)
+    return {name: ids_by_name.get(name) for name in label_names}
+
+
+# history.list allows up to 500 records per page
+HISTORY_PAGE_SIZE = 500
+# Only ask Gmail for what the sync loop reads
+HISTORY_FIELDS = 'history(messagesAdded(message(id,labelIds))),nextPageToken,historyId'
+
+
+def iter_history_messages(service, start_history_id, label_id=None, page_size=None, cursor=None, deadline=None):
+    """
+        Walks every page of history.list from `start_history_id` and yields each
+        newly added message ({'id', 'labelIds'}) once.
+
+        This is a generator on purpose: the caller starts fetching and forwarding
+        the messages of the first page while the next ones haven't been requested.
+        A message can show up in several history records, only its first
+        appearance is yielded.
 
-def parse_message(service, msg_id):
-    """Retrieves and extracts specific fields from an email."""
-    msg = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    #print(msg)
+        When given, `cursor['history_id']` is set to the mailbox historyId Gmail
+        reports with each page, once the walk is done everything up to it was seen.
+    """
+    page_size = page_size or int(os.environ.get('HISTORY_PAGE_SIZE', HISTORY_PAGE_SIZE))
+    seen_ids = set()
+    page_token = None
+    page_number = 0
+
+    while True:
+        with metrics.span('gmail.history_page'):
+            try:
+                history_response = gmail_execute(service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded'],
+                    labelId=label_id,
+                    maxResults=page_size,
+                    fields=HISTORY_FIELDS,
+                    pageToken=page_token,
+                ), 'history.list', deadline)
+            except Exception as e:
+                if backfill.is_history_expired(e):
+                    raise backfill.HistoryExpired(f"No history since {start_history_id}") from e
+                raise
+        page_number += 1
+        if cursor is not None and history_response.get('historyId'):
+            cursor['history_id'] = int(history_response['historyId'])
+
+        history_records = history_response.get('history', [])
+        metrics.add('history.records', len(history_records))
+        print(f"history page {page_number}: {len(history_records)} records")
+        if metrics.log_payloads():
+            print(history_response)
+        for record in history_records:
+            for item in record.get('messagesAdded', []):
+                message = item.get('message', {})
+                msg_id = message.get('id')
+                if msg_id is None or msg_id in seen_ids:
+                    continue
+                seen_ids.add(msg_id)
+                yield message
+
+        page_token = history_response.get('nextPageToken')
+        if not page_token:
+            return
+
+
+# 📄 Body extraction
+# Instead of forwarding Gmail's whole payload tree (every part header plus base64 data),
+# only the decoded text/plain and text/html bodies are sent, attachments become stubs.
+DEFAULT_BODY_TEXT_MAX_BYTES = 256 * 1024
+TEXT_MIME_TYPES = ('text/plain', 'text/html')
+
+_charset_re = re.compile(r'charset="?([\w.:-]+)"?', re.IGNORECASE)
+_html_drop_re = re.compile(r'<(script|style|head)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_html_break_re = re.compile(r'<\s*(br|/p|/div|/tr|/li|/h[1-6])\b[^>]*>', re.IGNORECASE)
+_html_tag_re = re.compile(r'<[^>]+>')
+_blank_lines_re = re.compile(r'\n\s*\n+')
+_spaces_re = re.compile(r'[ \t\r\f\v\xa0]+')
+
+
+def get_body_format():
+    """'compact' (decoded text + attachment stubs) or 'payload' (Gmail's raw tree, as before)."""
+    return os.environ.get('EMAIL_BODY_FORMAT', 'compact').strip().lower()
+
+
+def decode_base64url(data, max_bytes=None):
+    """
+        Decodes Gmail's base64url data. With `max_bytes` only the needed prefix is
+        decoded, so a huge body never gets fully materialized.
+    """
+    if max_bytes is not None:
+        # Every 4 base64 characters carry 3 bytes
+        needed_chars = (max_bytes + 2) // 3 * 4
+        data = data[:needed_chars]
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def html_to_text(markup):
+    """A light HTML to text conversion: no scripts/styles, tags stripped, entities decoded."""
+    markup = _html_drop_re.sub('', markup)
+    markup = _html_break_re.sub('\n', markup)
+    text = html.unescape(_html_tag_re.sub('', markup))
+    text = _spaces_re.sub(' ', text)
+    return _blank_lines_re.sub('\n\n', text).strip()
+
+
+def _part_charset(part):
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = _charset_re.search(header['value'])
+            if match:
+                return match.group(1)
+    return 'utf-8'
+
+
+def _decode_text(part, max_bytes):
+    raw = decode_base64url(part['body']['data'], max_bytes + 1)
+    truncated = len(raw) > max_bytes
+    try:
+        text = raw[:max_bytes].decode(_part_charset(part), errors='ignore' if truncated else 'replace')
+    except LookupError:
+        text = raw[:max_bytes].decode('utf-8', errors='replace')
+    return text, truncated
+
+
+def _attachment_stub(part):
+    body = part.get('body', {})
+    return {
+        "part_id": part.get('partId'),
+        "filename": part.get('filename') or None,
+        "mime_type": part.get('mimeType'),
+        "size": body.get('size', 0),
+        "attachment_id": body.get('attachmentId'),
+    }
+
+
+def extract_body(payload, max_text_bytes=None, html_as_text=None):
+    """
+        Walks the MIME tree without recursion and returns
+        {'text', 'html', 'attachments', 'truncated'}.
+
+        Only text/plain and text/html leaves are decoded, each kind capped at
+        `max_text_bytes`. Attachments, inline images and bodies Gmail only serves
+        by attachmentId are replaced by metadata stubs. With `html_as_text` the
+        HTML is converted to text (used when there is no text/plain part) and dropped.
+    """
+    if max_text_bytes is None:
+        max_text_bytes = int(os.environ.get('EMAIL_BODY_MAX_BYTES', DEFAULT_BODY_TEXT_MAX_BYTES))
+    if html_as_text is None:
+        html_as_text = os.environ.get('EMAIL_HTML_TO_TEXT', 'false').lower() == 'true'
+
+    found = {'text/plain': [], 'text/html': []}
+    budget = {'text/plain': max_text_bytes, 'text/html': max_text_bytes}
+    attachments = []
+    truncated = False
+
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('parts'):
+            # Reversed so parts come off the stack in document order
+            stack.extend(reversed(part['parts']))
+            continue
+
+        mime_type = part.get('mimeType', '')
+        body = part.get('body', {})
+        if mime_type in TEXT_MIME_TYPES and not part.get('filename') and body.get('data'):
+            if budget[mime_type] <= 0:
+                truncated = True
+                continue
+            text, part_truncated = _decode_text(part, budget[mime_type])
+            found[mime_type].append(text)
+            budget[mime_type] -= len(text.encode('utf-8'))
+            truncated = truncated or part_truncated
+        elif body.get('attachmentId') or body.get('data') or part.get('filename'):
+            attachments.append(_attachment_stub(part))
+
+    text = '\n'.join(found['text/plain'])
+    html_body = '\n'.join(found['text/html'])
+    if html_as_text:
+        if not text and html_body:
+            text = html_to_text(html_body)
+        html_body = ''
+
+    return {
+        "text": text,
+        "html": html_body or None,
+        "attachments": attachments,
+        "truncated": truncated,
+    }
+
+
+def build_email_data(msg):
+    """Extracts the fields we forward from a `format='full'` message resource."""
     payload = msg.get('payload', {})
     headers = payload.get('headers', [])
     
@@ -88,41 +595,772 @@ def parse_message(service, msg_id):
     # 🕒 Convert internalDate (ms) to readable format
     timestamp = int(msg.get('internalDate')) / 1000
     date_str = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+    # 📄 Decoded bodies and attachment stubs, unless the backend still wants the raw tree
+    body = payload if get_body_format() == 'payload' else extract_body(payload)
     
     return {
-        "message_id": msg_id,
+        "message_id": msg['id'],
         "subject": subject,
         "from": sender,
         "date": date_str,
-        "body": payload
+        "body": body
     }
 
-def forward_to_backend(email_data):
+
+def is_message_gone(exception):
+    """
+        True for the 404 Gmail answers for a message (or one of its attachments)
+        deleted since the history listed it. There is nothing left to forward.
+    """
+    from googleapiclient.errors import HttpError
+    if isinstance(exception, HttpError):
+        return exception.resp.status == 404
+    response = getattr(exception, 'response', None)
+    return getattr(response, 'status_code', None) == 404
+
+
+def skip_gone_message(msg_id):
+    print(f"🗑️ Message {msg_id} was deleted since it was listed, skipping it")
+    metrics.add('messages.gone')
+
+
+def parse_message(service, msg_id, deadline=None):
+    """Retrieves and extracts specific fields from an email, None when it was deleted meanwhile."""
+    with metrics.span('gmail.message_get'):
+        try:
+            msg = gmail_execute(
+                service.users().messages().get(userId='me', id=msg_id, format='full'), 'messages.get', deadline,
+            )
+        except Exception as e:
+            if not is_message_gone(e):
+                raise
+            skip_gone_message(msg_id)
+            return None
+    metrics.add('messages.fetched')
+    metrics.add('gmail.bytes_fetched', msg.get('sizeEstimate', 0))
+    if metrics.log_payloads():
+        print(msg)
+    msg.setdefault('id', msg_id)
+    return build_email_data(msg)
+
+
+# Gmail accepts up to 100 calls per batch, but recommends staying around 50
+# because bigger batches are more likely to be rate limited.
+MAX_GMAIL_BATCH_SIZE = 100
+DEFAULT_FETCH_BATCH_SIZE = 50
+FETCH_MAX_ATTEMPTS = 3
+
+# Errors worth asking again for: throttling and transient server errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+
+
+def get_fetch_batch_size():
+    """Messages per batch request. 0 or 1 fetches them one by one like before."""
+    batch_size = int(os.environ.get('GMAIL_FETCH_BATCH_SIZE', DEFAULT_FETCH_BATCH_SIZE))
+    return max(0, min(batch_size, MAX_GMAIL_BATCH_SIZE))
+
+
+def is_retryable_error(exception):
+    """
+        True for Gmail errors that are likely to succeed when asked again, from the
+        API client or from the raw requests of get_gmail_session().
+    """
+    from googleapiclient.errors import HttpError
+    if not isinstance(exception, HttpError):
+        return _is_retryable_raw_error(exception)
+    if exception.resp.status in RETRYABLE_STATUSES:
+        return True
+    if exception.resp.status == 403:
+        reasons = {detail.get('reason') for detail in (exception.error_details or []) if isinstance(detail, dict)}
+        return bool(reasons & RETRYABLE_REASONS)
+    return False
+
+
+def _is_retryable_raw_error(exception):
+    import requests
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(exception, 'response', None)
+    if not isinstance(exception, requests.HTTPError) or response is None:
+        return False
+    if response.status_code in RETRYABLE_STATUSES:
+        return True
+    if response.status_code == 403:
+        try:
+            errors = response.json()['error'].get('errors', [])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return bool({error.get('reason') for error in errors if isinstance(error, dict)} & RETRYABLE_REASONS)
+    return False
+
+
+def batch_get_messages(service, msg_ids, batch_size=None, max_attempts=FETCH_MAX_ATTEMPTS,
+                       format='full', metadata_headers=None, deadline=None):
+    """
+        Gets message resources through the Gmail batch endpoint.
+
+        IDs are sent in chunks of `batch_size`, each chunk is a single HTTP round trip.
+        Sub-requests that fail with a retryable error are retried on their own, the
+        ones that succeeded are not asked again. Each batch goes through the Gmail
+        limiter and spends the quota units of all its sub-requests.
+
+        Returns (fetched, failed): `fetched` maps message IDs to the resources and
+        `failed` maps the IDs we gave up on to their error. Messages deleted since
+        they were listed are in neither.
+    """
+    batch_size = max(1, min(batch_size or get_fetch_batch_size() or 1, MAX_GMAIL_BATCH_SIZE))
+    fetched = {}
+    failed = {}
+    pending = list(dict.fromkeys(msg_ids))
+    extra = {'metadataHeaders': list(metadata_headers)} if metadata_headers else {}
+
+    limiter = gmail_limiter()
+
+    for attempt in range(1, max_attempts + 1):
+        retry = {}
+
+        def collect(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+                metrics.add('messages.fetched' if format == 'full' else f"messages.fetched_{format}")
+                metrics.add('gmail.bytes_fetched', response.get('sizeEstimate', 0) if format == 'full' else 0)
+            elif is_message_gone(exception):
+                skip_gone_message(request_id)
+            elif is_retryable_error(exception) and attempt < max_attempts:
+                retry[request_id] = exception
+            else:
+                failed[request_id] = exception
+
+        for start in range(0, len(pending), batch_size):
+            batch = service.new_batch_http_request(callback=collect)
+            chunk = pending[start:start + batch_size]
+            for msg_id in chunk:
+                batch.add(
+                    service.users().messages().get(userId='me', id=msg_id, format=format, **extra),
+                    request_id=msg_id,
+                )
+            with metrics.span(f"gmail.batch_{format}"):
+                limiter.call(batch.execute, ratelimit.GMAIL_QUOTA_UNITS['messages.get'] * len(chunk), deadline)
+
+        if not retry:
+            break
+        print(f"🔁 Retrying {len(retry)} of {len(pending)} messages (attempt {attempt + 1})")
+        metrics.add('messages.fetch_retries', len(retry))
+        # Throttled sub-requests slow the whole instance down, then wait for their
+        # Retry-After (the longest one) or a jittered backoff
+        worst = max(retry.values(), key=lambda e: ratelimit.retry_after_seconds(e) or 0)
+        if not limiter.throttled(worst, attempt, deadline):
+            # No time left to wait for another attempt
+            failed.update(retry)
+            break
+        pending = list(retry)
+
+    return fetched, failed
+
+
+def fetch_messages_batched(service, msg_ids, batch_size=None, max_attempts=FETCH_MAX_ATTEMPTS, deadline=None):
+    """
+        Fetches full messages through the Gmail batch endpoint.
+
+        Returns (emails, failed): `emails` are shaped like parse_message() results, in
+        the order of `msg_ids`, and `failed` maps the IDs we gave up on to their error.
+    """
+    fetched, failed = batch_get_messages(service, msg_ids, batch_size, max_attempts, deadline=deadline)
+    emails = [build_email_data(fetched[msg_id]) for msg_id in dict.fromkeys(msg_ids) if msg_id in fetched]
+    return emails, failed
+
+
+# 📏 Pre-filtering rules (see rules.py), compiled once and reused by warm invocations.
+# Rules name labels, and label IDs differ between mailboxes, so there is one entry per mailbox key.
+DEFAULT_RULES_CACHE_TTL_SECONDS = 5 * 60
+_rules_caches = {}
+
+
+def get_email_rules(service, db, labels_doc_ref=None, mailbox_key=None, deadline=None):
+    """
+        Returns the compiled rules from EMAIL_RULES (JSON), or from the Firestore
+        document at EMAIL_RULES_DOC (e.g. 'config/email_rules'), or None when no
+        rules are configured. They are recompiled when the configuration changes or
+        after RULES_CACHE_TTL_SECONDS, so Firestore edits are picked up.
+    """
+    env_rules = os.environ.get('EMAIL_RULES', '').strip()
+    rules_doc = os.environ.get('EMAIL_RULES_DOC', '').strip()
+    if not env_rules and not rules_doc:
+        return None
+
+    key = env_rules or f"doc:{rules_doc}"
+    ttl = int(os.environ.get('RULES_CACHE_TTL_SECONDS', DEFAULT_RULES_CACHE_TTL_SECONDS))
+    cached = _rules_caches.get(mailbox_key)
+    if cached is not None and cached['key'] == key and time.time() - cached['compiled_at'] <= ttl:
+        return cached['rules']
+
+    if env_rules:
+        config = json.loads(env_rules)
+    else:
+        snapshot = db.document(rules_doc).get()
+        if not snapshot.exists:
+            print(f"No rules document at {rules_doc}, accepting every email.")
+            return None
+        config = snapshot.to_dict()
+
+    label_ids_by_name = resolve_label_names(
+        service, rules.referenced_labels(config), labels_doc_ref, mailbox_key, deadline,
+    )
+    compiled = rules.compile_rules(config, label_ids_by_name)
+    _rules_caches[mailbox_key] = {'key': key, 'rules': compiled, 'compiled_at': time.time()}
+    print(f"📏 Compiled {len(compiled.rules)} email rules")
+    return compiled
+
+
+def filter_by_rules(service, msg_ids, email_rules, batch_size, deadline=None):
+    """
+        Fetches only the headers and labels of `msg_ids` (format='metadata') and
+        returns (accepted, failed) according to `email_rules`. `accepted` holds the
+        metadata resources of the accepted messages, their sizeEstimate included.
+    """
+    headers = email_rules.metadata_headers
+    if batch_size > 1:
+        fetched, failed = batch_get_messages(
+            service, msg_ids, batch_size, format='metadata', metadata_headers=headers, deadline=deadline,
+        )
+    else:
+        fetched, failed = {}, {}
+        for msg_id in msg_ids:
+            with metrics.span('gmail.message_get_metadata'):
+                try:
+                    fetched[msg_id] = gmail_execute(service.users().messages().get(
+                        userId='me', id=msg_id, format='metadata', metadataHeaders=list(headers),
+                    ), 'messages.get', deadline)
+                except Exception as e:
+                    if not is_message_gone(e):
+                        raise
+                    skip_gone_message(msg_id)
+
+    accepted = []
+    for msg_id in msg_ids:
+        if msg_id not in fetched:
+            continue
+        if email_rules.accepts(fetched[msg_id]):
+            accepted.append(fetched[msg_id])
+            fetched[msg_id].setdefault('id', msg_id)
+        else:
+            print(f"📏 Not Processing message {msg_id}, rejected by rules")
+    metrics.add('messages.rejected_by_rules', len(fetched) - len(accepted))
+    return accepted, failed
+
+
+# 🌊 Large messages (see streaming.py): sized with a metadata fetch, streamed raw to the backend
+GMAIL_MESSAGES_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/messages/'
+# Also always part of the rules' metadata fetch (rules.BASE_METADATA_HEADERS)
+STREAM_METADATA_HEADERS = ('Subject', 'From')
+# Longest wait for the next chunk of a raw message
+GMAIL_STREAM_TIMEOUT_SECONDS = 30
+
+
+def split_by_size(resources, threshold):
+    """
+        Sorts metadata resources by sizeEstimate. Returns (small_ids, large):
+        `large` holds the resources of the messages above `threshold`.
+    """
+    small_ids, large = [], []
+    for msg in resources:
+        if int(msg.get('sizeEstimate', 0)) > threshold:
+            large.append(msg)
+        else:
+            small_ids.append(msg['id'])
+    return small_ids, large
+
+
+def split_large_messages(service, msg_ids, threshold, batch_size=None, deadline=None):
+    """
+        Sizes `msg_ids` with a metadata fetch that doesn't download bodies, for
+        when no rules fetched their metadata already. Returns (small_ids, large, failed).
+    """
+    fetched, failed = batch_get_messages(
+        service, msg_ids, batch_size, format='metadata', metadata_headers=STREAM_METADATA_HEADERS, deadline=deadline,
+    )
+    resources = [dict(fetched[msg_id], id=msg_id) for msg_id in dict.fromkeys(msg_ids) if msg_id in fetched]
+    small_ids, large = split_by_size(resources, threshold)
+    return small_ids, large, failed
+
+
+def open_raw_message(mailbox, msg_id, deadline=None):
+    """
+        Opens messages.get(format='raw') for `msg_id` through the Gmail limiter,
+        retried on throttling and server errors like any Gmail call. Returns the
+        chunks of the JSON response, read off the wire as they are consumed, to be
+        closed when they aren't.
+    """
+    session = get_gmail_session(mailbox)
+
+    def get():
+        response = session.get(
+            GMAIL_MESSAGES_URL + msg_id,
+            params={'format': 'raw', 'fields': 'raw'},
+            stream=True,
+            timeout=GMAIL_STREAM_TIMEOUT_SECONDS,
+        )
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        return response
+
+    with metrics.span('gmail.message_get_raw'):
+        response = gmail_limiter().call(get, ratelimit.GMAIL_QUOTA_UNITS['messages.get'], deadline)
+    return streaming.ResponseChunks(response)
+
+
+def stream_metadata(mailbox, msg):
+    """What the backend is told of a streamed message, from its metadata resource `msg`."""
+    email_data = build_email_data(msg)
+    metadata = {key: email_data[key] for key in ('message_id', 'subject', 'from', 'date')}
+    metadata['size'] = int(msg.get('sizeEstimate', 0))
+    if mailbox.key is not None:
+        metadata['mailbox'] = mailbox.email_address
+    return metadata
+
+
+def stream_message(mailbox, metadata, deadline=None):
+    """
+        Sends a large message to the backend as its raw RFC 822 bytes, read from
+        Gmail and uploaded chunk by chunk. `metadata` comes from stream_metadata().
+        Returns False when the message was deleted meanwhile. Raises
+        streaming.UploadFailed when Gmail was read but the backend failed.
+    """
+    msg_id = metadata['message_id']
+    url = streaming.get_url()
+    headers = {'Content-Type': 'message/rfc822', 'X-Email-Metadata': json.dumps(metadata)}
+    sent = 0
+    opened = []
+
+    def open_body():
+        nonlocal sent
+        sent = 0
+        # The first attempt reads the response opened below, a backend retry asks Gmail again
+        raw = opened.pop() if opened else open_raw_message(mailbox, msg_id, deadline)
+        for data in streaming.decode_base64url_chunks(streaming.iter_json_string(raw, 'raw')):
+            sent += len(data)
+            yield data
+
+    # Only a few large messages in flight per instance, whatever their number
+    with streaming.get_budget().reserve(metadata['size']):
+        # Opened before the upload, so a Gmail error is retried and raised as one
+        try:
+            opened.append(open_raw_message(mailbox, msg_id, deadline))
+        except Exception as e:
+            if not is_message_gone(e):
+                raise
+            skip_gone_message(msg_id)
+            return False
+        try:
+            with metrics.span('backend.stream'):
+                response = delivery.post_stream(url, open_body, deadline, headers)
+            response.raise_for_status()
+        except Exception as e:
+            raise streaming.UploadFailed(f"{type(e).__name__}: {e}") from e
+        finally:
+            # Left unread when every attempt failed before the body was asked for
+            for raw in opened:
+                raw.close()
+    metrics.add('gmail.bytes_fetched', sent)
+    metrics.add('backend.bytes_sent', sent)
+    logger.info(f"✅ Streamed {msg_id} ({sent} bytes) to backend.")
+    return True
+
+
+def forward_to_backend(email_data, deadline=None):
     """POSTs the cleaned data to your backend."""
     url = os.environ.get('BACKEND_URL')
     api_key = os.environ.get('BACKEND_API_KEY')
     #headers = {"X-API-KEY": api_key}
-    print(email_data)
-    response = requests.post(url, json=email_data, timeout=10)
+    if metrics.log_payloads():
+        print(email_data)
+    # Pooled keep-alive session, the timeout shrinks when the function is running out of time
+    with metrics.span('backend.post'):
+        response = delivery.post_json(url, email_data, deadline)
+    metrics.add('backend.bytes_sent', len(response.request.body or b''))
     response.raise_for_status()
     logger.info(f"✅ Forwarded {email_data['message_id']} to backend.")
 
+
+def new_delivery(deadline):
+    """
+        Picks how this run sends emails to the backend: one request per email
+        (the default), or bulk requests when BACKEND_BATCH_MODE is set.
+    """
+    batch_mode = delivery.get_batch_mode()
+    if batch_mode:
+        url = os.environ.get('BACKEND_BATCH_URL') or os.environ.get('BACKEND_URL')
+        return delivery.BatchDelivery(url, deadline, mode=batch_mode)
+    return delivery.BackendDelivery(
+        lambda email_data, deadline: forward_to_backend(email_data, deadline), deadline,
+    )
+
+
+# Should match timeout_seconds of the function in terraform/main.tf
+DEFAULT_FUNCTION_TIMEOUT_SECONDS = 60
+# Kept aside at the end of the budget to save last_id in Firestore
+FUNCTION_TIMEOUT_MARGIN_SECONDS = 5
+
+
+def invocation_deadline():
+    """time.monotonic() value after which requests should not be started anymore."""
+    budget = int(os.environ.get('FUNCTION_TIMEOUT_SECONDS', DEFAULT_FUNCTION_TIMEOUT_SECONDS))
+    return time.monotonic() + budget - FUNCTION_TIMEOUT_MARGIN_SECONDS
+
+def forward_messages(db, service, msg_ids, deadline, mailbox=None):
+    """
+        Fetches, cleans and forwards `msg_ids`, an iterable consumed as it goes so
+        delivery starts before the history walk is over. Returns how many emails
+        were forwarded. Raises when some of them could not be fetched or delivered,
+        unless DELIVERY_SPOOL is set: emails the backend didn't take are spooled
+        for drain_delivery_spool then, and only fetch failures raise. Messages
+        above STREAM_MESSAGES_OVER_BYTES are streamed raw instead (see streaming.py),
+        and spooled as their metadata when the backend doesn't take them.
+    """
+    mailbox = mailbox or mailboxes.default_mailbox()
+    # Optional rules, checked on a cheap metadata fetch before downloading bodies
+    labels_doc_ref = mailbox.document(db, 'gmail_labels')
+    with metrics.span('rules'):
+        email_rules = get_email_rules(service, db, labels_doc_ref, mailbox.key, deadline)
+
+    # Wanted IDs are grouped into batches so a single round trip fetches many messages.
+    batch_size = get_fetch_batch_size()
+    pending_ids = []
+    failed = {}
+    processed = 0
+    # Emails are POSTed from a bounded thread pool while the sync keeps fetching
+    deliveries = new_delivery(deadline)
+
+    # Messages a previous attempt of this event already forwarded are skipped
+    delivery_ledger = ledger.get_ledger(db, mailbox.ledger_collection())
+    skipped = 0
+    delivery_spool = spool.get_spool(db, mailbox.spool_collection(), mailbox.dead_letter_collection())
+
+    # Attachment contents only go out once, the index learns them when their email is delivered
+    with_attachments = attachments.contents_enabled()
+    blob_index = attachments.get_index(db) if with_attachments else None
+    pending_blobs = {}
+    # Shared with the other invocations of the instance, held until the email is sent
+    contents_budget = attachments.get_inflight_budget() if with_attachments else None
+
+    def hold_contents(email_data):
+        held = attachments.content_bytes(email_data)
+        if not held:
+            return None
+        with metrics.span('attachments.budget_wait'):
+            reserved = contents_budget.acquire(held)
+
+        def release():
+            # A failed email is only kept for the spool, which drops its contents anyway
+            if email_data['message_id'] in deliveries.undelivered:
+                attachments.drop_contents(email_data)
+            contents_budget.release(reserved)
+        return release
+
+    def record_delivered():
+        if delivery_ledger is None and not pending_blobs:
+            return
+        delivered_ids = deliveries.pop_delivered()
+        if delivery_ledger is not None and delivered_ids:
+            with metrics.span('ledger.write'):
+                delivery_ledger.record_delivered(delivered_ids)
+        hashes = set()
+        for message_id in delivered_ids:
+            hashes.update(pending_blobs.pop(message_id, ()))
+        if blob_index is not None and hashes:
+            with metrics.span('attachments.index_write'):
+                blob_index.add(hashes)
+
+    # Messages above this size are streamed instead of fetched whole
+    stream_threshold = streaming.get_threshold()
+    streamed = 0
+    # Spooled as metadata only when the backend doesn't take them, the drain streams them again
+    unstreamed = []
+
+    def stream_large(large):
+        nonlocal streamed
+        for msg in large:
+            metadata = stream_metadata(mailbox, msg)
+            try:
+                if not stream_message(mailbox, metadata, deadline):
+                    continue
+            except streaming.UploadFailed as e:
+                logger.error(f"❌ Could not stream {msg['id']}: {e}")
+                if delivery_spool is None:
+                    failed[msg['id']] = e
+                else:
+                    unstreamed.append(spool.new_stream_entry(metadata, e))
+                continue
+            except Exception as e:
+                logger.error(f"❌ Could not stream {msg['id']}: {e}")
+                failed[msg['id']] = e
+                continue
+            streamed += 1
+            if delivery_ledger is not None:
+                delivery_ledger.record_delivered([msg['id']])
+        return len(large)
+
+    def fetch_attachment(msg_id, attachment_id):
+        request = service.users().messages().attachments().get(userId='me', messageId=msg_id, id=attachment_id)
+        try:
+            return gmail_execute(request, 'messages.attachments.get', deadline)['data']
+        except Exception as e:
+            # Deleted since the message was fetched, the attachment stays a stub
+            if not is_message_gone(e):
+                raise
+            return None
+
+    def fetch_and_forward(msg_ids):
+        nonlocal skipped
+        if delivery_ledger is not None:
+            with metrics.span('ledger.read'):
+                already_delivered = delivery_ledger.delivered_ids(msg_ids)
+            if already_delivered:
+                skipped += len(already_delivered)
+                msg_ids = [msg_id for msg_id in msg_ids if msg_id not in already_delivered]
+                print(f"⏭️ Skipping {len(already_delivered)} messages already forwarded")
+
+        large = []
+        if email_rules is not None:
+            accepted, rules_failed = filter_by_rules(service, msg_ids, email_rules, batch_size, deadline)
+            failed.update(rules_failed)
+            # The rules' metadata fetch tells the sizes as well
+            if stream_threshold:
+                msg_ids, large = split_by_size(accepted, stream_threshold)
+            else:
+                msg_ids = [msg['id'] for msg in accepted]
+        elif stream_threshold and msg_ids:
+            with metrics.span('gmail.sizes'):
+                msg_ids, large, size_failed = split_large_messages(
+                    service, msg_ids, stream_threshold, batch_size, deadline,
+                )
+            failed.update(size_failed)
+
+        # Clean and Forward
+        large_count = stream_large(large) if large else 0
+        if not msg_ids:
+            return large_count
+        if batch_size > 1:
+            emails, batch_failed = fetch_messages_batched(service, msg_ids, batch_size, deadline=deadline)
+            failed.update(batch_failed)
+        else:
+            emails = [parse_message(service, msg_id, deadline) for msg_id in msg_ids]
+            emails = [email for email in emails if email is not None]
+        for clean_email in emails:
+            if mailbox.key is not None:
+                # Tell the backend which of the watched mailboxes the email is from
+                clean_email['mailbox'] = mailbox.email_address
+            if with_attachments:
+                message_id = clean_email['message_id']
+                with metrics.span('attachments'):
+                    attachments.attach_contents(
+                        clean_email, functools.partial(fetch_attachment, message_id), blob_index,
+                    )
+                hashes = attachments.sent_hashes(clean_email)
+                if hashes:
+                    pending_blobs[message_id] = hashes
+                deliveries.submit(clean_email, on_done=hold_contents(clean_email))
+            else:
+                deliveries.submit(clean_email)
+        # Record what earlier chunks delivered, so a timeout doesn't lose it
+        record_delivered()
+        return len(emails) + large_count
+
+    for msg_id in msg_ids:
+        pending_ids.append(msg_id)
+        if len(pending_ids) >= max(batch_size, 1):
+            processed += fetch_and_forward(pending_ids)
+            pending_ids = []
+
+    if pending_ids:
+        processed += fetch_and_forward(pending_ids)
+
+    with metrics.span('backend.wait'):
+        undelivered = deliveries.wait()
+    record_delivered()
+    spooled = 0
+    if delivery_spool is not None and (undelivered or unstreamed):
+        # The spool owns them now: the sync moves on and the drain retries them.
+        # Without their attachment contents, which could push a document over 1 MiB.
+        entries = [
+            spool.new_entry(attachments.without_contents(deliveries.undelivered[message_id]), error)
+            for message_id, error in undelivered.items() if message_id in deliveries.undelivered
+        ] + unstreamed
+        with metrics.span('spool.write'):
+            delivery_spool.add(entries)
+        spooled_ids = [entry['message_id'] for entry in entries]
+        if delivery_ledger is not None:
+            # Recorded so a retry of the event doesn't fetch them again
+            delivery_ledger.record_delivered(spooled_ids)
+        for message_id in spooled_ids:
+            undelivered.pop(message_id, None)
+        spooled = len(spooled_ids)
+        print(f"📥 Spooled {spooled} emails the backend didn't take")
+    failed.update(undelivered)
+    forwarded = deliveries.delivered + streamed
+    print(f"messages processed: {processed}, forwarded: {forwarded}, already forwarded: {skipped}")
+    metrics.add('messages.forwarded', forwarded)
+    metrics.add('messages.streamed', streamed)
+    metrics.add('messages.already_forwarded', skipped)
+    metrics.add('messages.spooled', spooled)
+    metrics.add('messages.failed', len(failed))
+
+    if failed:
+        # Keep last_id where it is so Pub/Sub retries the event
+        raise RuntimeError(f"Could not process {len(failed)} messages: {sorted(failed)}")
+    return forwarded
+
+
+def sync_history_range(db, service, start_history_id, deadline, mailbox=None):
+    """
+        Forwards every wanted message added after `start_history_id`, or with
+        PIPELINE_MODE=fanout publishes their IDs for the workers (see fanout.py).
+        Returns the mailbox historyId the sync reached (0 if Gmail didn't say).
+        Raises when some of them could not be fetched, delivered or published.
+    """
+    # Get specific Labels you want to process
+    # Even though the watch() method in setup_watch.py has a labelIds parameter,
+    # Gmail often ignores it and sends a notification for every single change in
+    # the mailbox—including drafts, sent mail, and chats. It's frustrating, but it's consistent.
+    # This is a bug reported since 2015 apparently. thus you need to add this filtering logic here.
+    mailbox = mailbox or mailboxes.default_mailbox()
+    email_fetching_labels = get_fetching_labels(mailbox)
+
+    # Resolved IDs are cached in memory and next to the sync state in Firestore,
+    # so this is normally free. label_ids is a frozenset for cheap lookups below.
+    labels_doc_ref = mailbox.document(db, 'gmail_labels')
+    with metrics.span('labels'):
+        label_ids = get_label_ids(service, email_fetching_labels, labels_doc_ref, mailbox.key, deadline)
+
+    # Gmail can filter history server side, but only by a single label
+    history_label_id = next(iter(label_ids)) if len(label_ids) == 1 else None
+
+    cursor = {}
+
+    def wanted_message_ids():
+        # Process each new message found, page by page.
+        for message in iter_history_messages(
+            service, start_history_id, label_id=history_label_id, cursor=cursor, deadline=deadline,
+        ):
+            msg_id = message['id']
+
+            if label_ids.isdisjoint(message.get('labelIds', [])):
+                print(f"📧 Not Processing message {msg_id} as not present in {sorted(label_ids)}")
+                continue
+
+            print(f"📧 Processing message {msg_id}")
+            yield msg_id
+
+    dispatch_message_ids(db, service, wanted_message_ids(), deadline, mailbox, start_history_id)
+    return cursor.get('history_id', 0)
+
+
+def dispatch_message_ids(db, service, msg_ids, deadline, mailbox, history_id=None):
+    """
+        Forwards `msg_ids`, or with PIPELINE_MODE=fanout publishes them for the
+        workers (see fanout.py). Raises when some of them could not be handled.
+    """
+    if fanout.get_pipeline_mode() == 'fanout':
+        # Only hand the IDs over, the workers fetch and forward them in parallel
+        work = fanout.WorkPublisher(
+            fanout.get_worker_topic(), email_address=mailbox.email_address, history_id=history_id,
+        )
+        for msg_id in msg_ids:
+            work.add(msg_id)
+        with metrics.span('pubsub.publish_wait'):
+            failed = work.wait()
+        print(f"🧰 Published {work.published} message IDs in {work.messages_sent} work messages")
+        metrics.add('work.message_ids_published', work.published)
+        metrics.add('work.messages_published', work.messages_sent)
+        if failed:
+            raise RuntimeError(f"Could not publish {len(failed)} message IDs: {sorted(failed)}")
+    else:
+        forward_messages(db, service, msg_ids, deadline, mailbox)
+
+
+def backfill_mailbox(db, service, mailbox, deadline, synced_at=None, keep_alive=None):
+    """
+        Recovers from an expired historyId (see backfill.py): lists and forwards
+        everything received since `synced_at`, several time windows in parallel,
+        and returns the historyId to re-seed last_id with.
+        Raises when windows are left, the checkpoint lets the next attempt resume.
+        `keep_alive()` is called after every window, it returns False to stop.
+    """
+    checkpoint_ref = mailbox.document(db, 'gmail_backfill')
+    checkpoint, resumed = backfill.Checkpoint.load_or_start(
+        checkpoint_ref, synced_at,
+        lambda: gmail_execute(service.users().getProfile(userId='me'), 'getProfile', deadline)['historyId'],
+    )
+    windows = checkpoint.pending_windows()
+    print(f"🚑 {'Resuming' if resumed else 'Starting'} backfill from {checkpoint.after} to {checkpoint.before}: "
+          f"{len(windows)} windows left")
+    metrics.annotate(backfill_windows_left=len(windows))
+
+    labels_doc_ref = mailbox.document(db, 'gmail_labels')
+    with metrics.span('labels'):
+        label_ids = sorted(get_label_ids(service, get_fetching_labels(mailbox), labels_doc_ref, mailbox.key, deadline))
+    local = threading.local()
+
+    def run_window(window):
+        # Windows that can't finish in time are left for the next attempt
+        if deadline - time.monotonic() < FUNCTION_TIMEOUT_MARGIN_SECONDS * 2:
+            return False
+        if not hasattr(local, 'service'):
+            local.service = new_gmail_service(mailbox)
+        msg_ids = set()
+        with metrics.span('gmail.messages_list'):
+            # messages.list wants all of its labelIds, so each label is listed on its own
+            for label_id in label_ids:
+                msg_ids.update(backfill.iter_window_message_ids(
+                    local.service, window, label_id,
+                    execute=lambda request: gmail_execute(request, 'messages.list', deadline),
+                ))
+        metrics.add('backfill.messages', len(msg_ids))
+        dispatch_message_ids(db, local.service, sorted(msg_ids), deadline, mailbox, checkpoint.history_id)
+        checkpoint.mark_done(window)
+        return True
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=backfill.get_concurrency()) as pool:
+        futures = {metrics.submit_in_context(pool, run_window, window): window for window in windows}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                if future.result():
+                    metrics.add('backfill.windows')
+            except Exception as e:
+                logger.error(f"❌ Backfill window {futures[future]} failed: {e}")
+                failures.append(futures[future])
+            if keep_alive is not None and not keep_alive():
+                # Somebody else took over, let our remaining windows go
+                keep_alive = None
+                for other in futures:
+                    other.cancel()
+
+    left = checkpoint.pending_windows()
+    if left:
+        raise RuntimeError(f"Backfill paused with {len(left)} of {len(windows)} windows left "
+                           f"({len(failures)} failed), the next attempt resumes it")
+    checkpoint.clear()
+    print(f"🚑 Backfill done, re-seeding last_id with {checkpoint.history_id}")
+    return checkpoint.history_id
+
+
 @functions_framework.cloud_event
+@metrics.instrumented('process_gmail_notification')
 def process_gmail_notification(cloud_event):
     """Entry point triggered by Pub/Sub via Eventarc."""
+    deadline = invocation_deadline()
+    lease_ref = None
+    owner = lease_owner(cloud_event)
     try:
         db = get_db()
-        # finding Last History ID in Firestore
-        # Create a reference to the specific document
-        doc_ref = db.collection('state').document('gmail_sync')
-        # Get a "snapshot" of the document
-        doc = doc_ref.get()
-
-        if not doc.exists:
-            print("No state found. Please run the setup script to seed Firestore.")
-            return
-
-        last_processed_id = int(doc.to_dict().get('last_id', 0))
 
         print(f"Processing Pub/Sub event")
         print(f"sending it to {os.environ.get('BACKEND_URL')}")
@@ -133,20 +1371,33 @@ def process_gmail_notification(cloud_event):
         new_history_id = notification.get('historyId')
         
         print(f"🔔 Notification received. History ID: {new_history_id}")
-        
-        service = get_gmail_service()
+        metrics.annotate(notification_history_id=new_history_id)
 
-        # Get specific Labels you want to process
-        # Even though the watch() method in setup_watch.py has a labelIds parameter,
-        # Gmail often ignores it and sends a notification for every single change in
-        # the mailbox—including drafts, sent mail, and chats. It's frustrating, but it's consistent.
-        # This is a bug reported since 2015 apparently. thus you need to add this filtering logic here.
-        email_fetching_labels_raw = os.environ.get('EMAIL_FETCHING_LABELS', [])
-        email_fetching_labels = [label.strip() for label in email_fetching_labels_raw.split(",") if label]
+        # Every watched mailbox has its own state, credentials and caches
+        try:
+            mailbox = mailboxes.get_mailbox(notification.get('emailAddress'))
+        except mailboxes.UnknownMailboxError as e:
+            # Retrying won't help, acknowledge the event
+            print(f"⚠️ Ignoring notification: {e}")
+            metrics.annotate(result='unknown_mailbox')
+            return
+        if mailbox.key is not None:
+            metrics.annotate(mailbox=mailbox.key)
 
-        label_id_list = get_label_id(service, email_fetching_labels)
+        # finding Last History ID in Firestore
+        # Create a reference to the specific document
+        doc_ref = mailbox.document(db, 'gmail_sync')
+        # Get a "snapshot" of the document
+        with metrics.span('firestore.read'):
+            doc = doc_ref.get()
 
-        # 2. Get the list of changes since that historyId
+        if not doc.exists:
+            print("No state found. Please run the setup script to seed Firestore.")
+            metrics.annotate(result='no_state')
+            return
+
+        last_processed_id = int(doc.to_dict().get('last_id', 0))
+        synced_at = doc.to_dict().get('synced_at')
 
         # sometimes you need to convert to a valid int because
         # If the value is being passed through multiple layers of JSON encoding or terminal commands,
@@ -154,47 +1405,329 @@ def process_gmail_notification(cloud_event):
         # To fix this properly, we need to ensure the ID is treated as a number (integer)
         # by the time it reaches the Gmail API client.
         new_history_id = int(new_history_id)
+        # Notifications a sync that ran out of time left behind are picked up by the retry (see below)
+        new_history_id = max(new_history_id, int(doc.to_dict().get('left_history_id') or 0))
 
         if new_history_id <= last_processed_id:
             print(f"No new changes. Current ID {new_history_id} is not newer than {last_processed_id}")
+            metrics.annotate(result='stale')
             return
 
-        print(f"New activity detected! Syncing from {last_processed_id} to {new_history_id}")
+        # 2. Only one invocation syncs at a time, the others leave their historyId and exit
+        lease_ref = mailbox.document(db, 'gmail_sync_lease')
+        with metrics.span('firestore.lease'):
+            acquired = acquire_sync_lease(db.transaction(), lease_ref, owner, new_history_id)
+        if not acquired:
+            print(f"⏩ Another invocation is syncing, it will catch up to {new_history_id}")
+            metrics.annotate(result='coalesced')
+            lease_ref = None
+            return
 
-        history_response = service.users().history().list(
-            userId='me', 
-            startHistoryId=last_processed_id,
-            historyTypes=['messageAdded']
-        ).execute()
+        # The previous holder may have moved last_id while we were waiting
+        with metrics.span('firestore.read'):
+            last_processed_id = max(last_processed_id, int(doc_ref.get().to_dict().get('last_id', 0)))
+        with metrics.span('gmail.client'):
+            service = get_gmail_service(mailbox)
+        target_id = new_history_id
 
-        print(history_response)
+        while target_id is not None:
+            if target_id > last_processed_id:
+                print(f"New activity detected! Syncing from {last_processed_id} to {target_id}")
+                metrics.add('sync.rounds')
 
-        # 3. Process each new message found
-        history_records = history_response.get('history', [])
-        print(f"history records added processing: {len(history_records)}")
-        for record in history_records:
-            messages_added = record.get('messagesAdded', [])
-            print(f"messages added processing: {len(messages_added)}")
-            for item in messages_added:
-                labels_in_message = set(item.get('message', {}).get('labelIds', []))
-                common_labels = labels_in_message.intersection(set(label_id_list))
-                msg_id = item['message']['id']
-
-                if len(common_labels) == 0:
-                    print(f"📧 Not Processing message {msg_id} as not present in {label_id_list}")
-                else:
-                    # 4. Clean and Forward
-                    print(f"📧 Processing message {msg_id}")
-                    clean_email = parse_message(service, msg_id)
-                    forward_to_backend(clean_email)
-        
-        # 5. Update Firestore with the new "High Water Mark"
-        # doc_ref.update({'last_id': new_history_id})
-        transaction = db.transaction()
-        update_in_transaction(transaction, doc_ref, new_history_id)
-        print(f"Successfully updated last_id to {new_history_id}")
+                # 3. and 4. Fetch, clean and forward every new message.
+                # The walk goes to the end of the history, which can be past target_id.
+                try:
+                    synced_id = max(target_id, sync_history_range(db, service, last_processed_id, deadline, mailbox))
+                except backfill.HistoryExpired:
+                    # Gmail no longer has the history since last_id, list what was missed instead.
+                    # The history sync carries on from the historyId the backfill re-seeds.
+                    print(f"🚑 History since {last_processed_id} is gone, backfilling")
+                    metrics.annotate(backfill=True)
+                    with metrics.span('backfill'):
+                        synced_id = backfill_mailbox(
+                            db, service, mailbox, deadline, synced_at,
+                            keep_alive=lambda: extend_sync_lease(db.transaction(), lease_ref, owner),
+                        )
+
+                # 5. Update Firestore with the new "High Water Mark"
+                # doc_ref.update({'last_id': new_history_id})
+                transaction = db.transaction()
+                with metrics.span('firestore.transaction'):
+                    update_in_transaction(transaction, doc_ref, synced_id)
+                print(f"Successfully updated last_id to {synced_id}")
+                metrics.annotate(last_id=synced_id)
+                last_processed_id = synced_id
+
+            # Catch up with notifications recorded while we were syncing,
+            # unless the function budget is nearly spent
+            keep_going = deadline - time.monotonic() > FUNCTION_TIMEOUT_MARGIN_SECONDS * 2
+            with metrics.span('firestore.lease'):
+                target_id = renew_or_release_sync_lease(db.transaction(), lease_ref, owner, last_processed_id, keep_going)
+            if target_id is not None and not keep_going:
+                # The lease is released. The notifications up to target_id were acknowledged by the
+                # invocations that recorded them, so their work is left in the sync state and the
+                # event fails for Pub/Sub to redeliver it.
+                lease_ref = None
+                with metrics.span('firestore.write'):
+                    doc_ref.update({'left_history_id': target_id})
+                metrics.annotate(result='out_of_time')
+                raise RuntimeError(f"Out of time at {last_processed_id}, notifications up to {target_id} are left")
+        lease_ref = None
+        metrics.annotate(result='synced')
 
     except Exception as e:
         logger.error(f"❌ Error: {str(e)}")
+        if lease_ref is not None:
+            # Let the Pub/Sub retry (or the next notification) take over right away
+            try:
+                renew_or_release_sync_lease(db.transaction(), lease_ref, owner, 0, keep_going=False)
+            except Exception as release_error:
+                logger.error(f"❌ Could not release the sync lease: {release_error}")
         # Raising the error allows Pub/Sub to retry the delivery
-        raise e
\ No newline at end of file
+        raise e
+
+
+@functions_framework.cloud_event
+@metrics.instrumented('process_message_batch')
+def process_message_batch(cloud_event):
+    """
+        Fan-out worker triggered by the WORKER_TOPIC subscription: fetches, cleans
+        and forwards the message IDs published by process_gmail_notification.
+    """
+    deadline = invocation_deadline()
+    try:
+        work = fanout.decode_work(base64.b64decode(cloud_event.data["message"]["data"]))
+        msg_ids = work['message_ids']
+        print(f"🧰 Work received: {len(msg_ids)} messages (history {work.get('history_id')})")
+
+        mailbox = mailboxes.get_mailbox(work.get('email_address'))
+        with metrics.span('gmail.client'):
+            service = get_gmail_service(mailbox)
+        forward_messages(get_db(), service, msg_ids, deadline, mailbox)
+
+    except Exception as e:
+        logger.error(f"❌ Error: {str(e)}")
+        # Raising the error allows Pub/Sub to retry the work message,
+        # the delivery ledger makes the retry skip what was already forwarded
+        raise e
+
+
+# Spooled emails sent per round of the drain
+DEFAULT_SPOOL_DRAIN_BATCH_SIZE = 100
+
+
+def drain_spool(db, delivery_spool, mailbox, deadline):
+    """
+        Sends the due emails of `delivery_spool` to the backend, round after round
+        until none is due, the backend fails a whole round or time runs out.
+        Delivered emails leave the spool, failed ones are retried later with a
+        backoff or moved to the dead letters after DELIVERY_SPOOL_MAX_ATTEMPTS.
+        Returns {'delivered': n, 'retried': n, 'dead_lettered': n}.
+    """
+    batch_size = int(os.environ.get('DELIVERY_SPOOL_DRAIN_BATCH_SIZE', DEFAULT_SPOOL_DRAIN_BATCH_SIZE))
+    max_attempts = spool.get_max_attempts()
+    delivery_ledger = ledger.get_ledger(db, mailbox.ledger_collection())
+    blob_index = attachments.get_index(db) if attachments.contents_enabled() else None
+    counts = {'delivered': 0, 'retried': 0, 'dead_lettered': 0}
+
+    while time.monotonic() < deadline:
+        with metrics.span('spool.read'):
+            entries = delivery_spool.due(batch_size)
+        if not entries:
+            break
+        deliveries = new_delivery(deadline)
+        streams = []
+        for entry in entries:
+            if 'stream' in entry['email']:
+                streams.append(entry['email']['stream'])
+            else:
+                deliveries.submit(entry['email'])
+        with metrics.span('backend.wait'):
+            failed = deliveries.wait()
+        # Large messages go one by one, read from Gmail again
+        for metadata in streams:
+            try:
+                stream_message(mailbox, metadata, deadline)
+            except Exception as e:
+                logger.error(f"❌ Could not stream {metadata['message_id']}: {e}")
+                failed[metadata['message_id']] = e
+
+        delivered_ids = [entry['message_id'] for entry in entries if entry['message_id'] not in failed]
+        with metrics.span('spool.write'):
+            delivery_spool.remove(delivered_ids)
+            for entry in entries:
+                error = failed.get(entry['message_id'])
+                if error is None:
+                    continue
+                entry['attempts'] += 1
+                entry['last_error'] = str(error)
+                if entry['attempts'] >= max_attempts:
+                    logger.error(f"❌ Giving up on {entry['message_id']} after {entry['attempts']} attempts: {error}")
+                    delivery_spool.dead_letter(entry)
+                    counts['dead_lettered'] += 1
+                else:
+                    entry['next_attempt_at'] = spool.next_attempt_at(entry['attempts'])
+                    delivery_spool.reschedule(entry)
+                    counts['retried'] += 1
+        if delivery_ledger is not None and delivered_ids:
+            delivery_ledger.record_delivered(delivered_ids)
+        if blob_index is not None and delivered_ids:
+            delivered = set(delivered_ids)
+            hashes = set()
+            for entry in entries:
+                if entry['message_id'] in delivered:
+                    hashes.update(attachments.sent_hashes(entry['email']))
+            if hashes:
+                blob_index.add(hashes)
+        counts['delivered'] += len(delivered_ids)
+
+        if not delivered_ids:
+            # Still down, the next scheduled drain tries again
+            break
+
+    metrics.add('spool.delivered', counts['delivered'])
+    metrics.add('spool.retried', counts['retried'])
+    metrics.add('spool.dead_lettered', counts['dead_lettered'])
+    return counts
+
+
+@functions_framework.http
+@metrics.instrumented('drain_delivery_spool')
+def drain_delivery_spool(request):
+    """
+        Retries the emails spooled while the backend was slow or down (see
+        spool.py), for every watched mailbox. Called by Cloud Scheduler.
+    """
+    deadline = invocation_deadline()
+    db = get_db()
+    summary = {}
+    for mailbox in mailboxes.all_mailboxes():
+        delivery_spool = spool.get_spool(db, mailbox.spool_collection(), mailbox.dead_letter_collection())
+        if delivery_spool is None:
+            return "DELIVERY_SPOOL is off, nothing to drain", 200
+        counts = drain_spool(db, delivery_spool, mailbox, deadline)
+        summary[mailbox.email_address or 'default'] = counts
+        print(f"📤 Spool of {mailbox.email_address}: {counts}")
+    return json.dumps(summary), 200, {'Content-Type': 'application/json'}
+
+
+# 📡 Gmail stops notifying 7 days after watch(), renew_gmail_watch runs well before that
+DEFAULT_WATCH_TOPIC_NAME = 'gmail-notifications-topic'
+DEFAULT_WATCH_RENEW_BEFORE_HOURS = 48
+
+
+def watch_topic():
+    """Pub/Sub topic Gmail publishes to: GMAIL_WATCH_TOPIC, or the terraform one in PROJECT_ID."""
+    topic = os.environ.get('GMAIL_WATCH_TOPIC') or DEFAULT_WATCH_TOPIC_NAME
+    if topic.startswith('projects/'):
+        return topic
+    return f"projects/{os.environ.get('PROJECT_ID')}/topics/{topic}"
+
+
+def renew_watch(db, mailbox, force=False, service=None):
+    """
+        Calls watch() for `mailbox` unless the one recorded in its `gmail_watch`
+        document still has WATCH_RENEW_BEFORE_HOURS left with the same topic and
+        label names. Records the new expiration there, so gmail_sync only holds
+        the sync state. The document is checked first: a watch left alone costs
+        no Gmail call, not even for the client or the label IDs.
+
+        last_id is only seeded for a mailbox that has none yet. An existing one
+        is left alone: the next sync carries on from it, and if it expired the
+        backfill catches up from `synced_at` (see backfill.py) instead of
+        skipping the mail in between.
+
+        Returns the recorded watch state, or None when the watch was left alone.
+    """
+    label_names = sorted(mailbox.fetching_labels())
+    topic = watch_topic()
+
+    watch_ref = mailbox.document(db, 'gmail_watch')
+    with metrics.span('firestore.read'):
+        snapshot = watch_ref.get()
+    current = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    renew_before = float(os.environ.get('WATCH_RENEW_BEFORE_HOURS', DEFAULT_WATCH_RENEW_BEFORE_HOURS)) * 3600
+    expires_in = int(current.get('expiration') or 0) / 1000 - time.time()
+    if not force and expires_in > renew_before \
+            and current.get('topic') == topic and current.get('label_names') == label_names:
+        print(f"📡 Watch of {mailbox.email_address} still good for {expires_in / 3600:.0f} hours")
+        return None
+
+    if service is None:
+        with metrics.span('gmail.client'):
+            service = get_gmail_service(mailbox)
+    with metrics.span('labels'):
+        label_ids = get_label_ids(service, label_names, mailbox.document(db, 'gmail_labels'), mailbox.key)
+    watched_labels = sorted(label_ids) or ['INBOX']
+
+    with metrics.span('gmail.watch'):
+        response = gmail_execute(
+            service.users().watch(userId='me', body={'topicName': topic, 'labelIds': watched_labels}), 'watch',
+        )
+    state = {
+        'expiration': int(response['expiration']),
+        'history_id': int(response['historyId']),
+        'topic': topic,
+        'label_names': label_names,
+        'label_ids': watched_labels,
+        'renewed_at': time.time(),
+    }
+    watch_ref.set(state)
+    metrics.add('gmail.watch_renewed')
+    print(f"📡 Watching {watched_labels} of {mailbox.email_address} until {state['expiration']} (ms)")
+
+    sync_ref = mailbox.document(db, 'gmail_sync')
+    if not sync_ref.get().exists:
+        # A new mailbox: notifications start from here
+        sync_ref.set({'last_id': state['history_id'], 'synced_at': time.time()})
+        print(f"🌱 Seeded last_id {state['history_id']} for {mailbox.email_address}")
+    return state
+
+
+@functions_framework.http
+@metrics.instrumented('renew_gmail_watch')
+def renew_gmail_watch(request):
+    """
+        Renews the Gmail watch of every configured mailbox before it expires.
+        Called daily by Cloud Scheduler, `?force=true` renews them all anyway.
+        Answers 500 when a mailbox failed, so the scheduler tries again.
+    """
+    force = request is not None and request.args.get('force', '').lower() == 'true'
+    db = get_db()
+    summary = {}
+    failures = 0
+    for mailbox in mailboxes.all_mailboxes():
+        name = mailbox.email_address or 'default'
+        try:
+            state = renew_watch(db, mailbox, force)
+        except Exception as e:
+            logger.error(f"❌ Could not renew the watch of {name}: {e}")
+            summary[name] = {'error': str(e)}
+            failures += 1
+            continue
+        summary[name] = {'renewed': state is not None, **(state or {})}
+    return json.dumps(summary), 500 if failures else 200, {'Content-Type': 'application/json'}
+
+
+def _warm_up():
+    """
+        Imports the client libraries and creates the clients while the instance
+        starts, so the first event doesn't pay for it. Anything that fails here is
+        simply done again on first use.
+    """
+    start = time.monotonic()
+    try:
+        get_db()
+        import googleapiclient.discovery  # noqa: F401 (warms the import for get_gmail_service)
+        if not mailboxes.is_multi_mailbox() and os.environ.get('GMAIL_REFRESH_TOKEN'):
+            get_gmail_service()
+    except Exception as e:
+        print(f"⚠️ Warm-up failed, clients will be created on first use: {e}")
+        return
+    print(f"🔥 Clients ready in the background after {(time.monotonic() - start) * 1000:.0f} ms")
+
+
+# K_SERVICE is set on Cloud Functions (gen 2) and Cloud Run, WARM_UP_CLIENTS overrides it
+if os.environ.get('WARM_UP_CLIENTS', 'true' if os.environ.get('K_SERVICE') else 'false').lower() == 'true':
+    threading.Thread(target=_warm_up, name='warm-up', daemon=True).start()
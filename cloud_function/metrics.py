@@ -0,0 +1,160 @@
+"""
+Per-invocation timings and counters, logged as one structured JSON line.
+
+Entry points are wrapped with `@instrumented(...)`. Code anywhere below them
+records what it does with `span('stage')` (a timer) and `add('counter', n)`,
+without passing anything around: the metrics of the running invocation are kept
+in a context variable, and the delivery threads run in a copy of that context.
+When the invocation ends a single line like this is printed:
+
+    {"message": "invocation metrics", "entry_point": "process_gmail_notification",
+     "outcome": "ok", "duration_ms": 812.4,
+     "spans": {"gmail.history_page": {"count": 3, "total_ms": 240.1, "max_ms": 95.2}, ...},
+     "counters": {"messages.forwarded": 120, "backend.bytes_sent": 318440, ...}}
+
+Cloud Logging turns JSON printed on stdout into a structured entry, so these
+fields can be filtered and charted in Log Analytics.
+
+With PROFILE_INVOCATIONS=true each invocation also runs under cProfile. The
+stats are written to PROFILE_DIR (default /tmp) and the top functions are logged.
+"""
+
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Functions listed in the logged profile summary
+PROFILE_TOP_FUNCTIONS = 25
+
+
+class InvocationMetrics:
+    def __init__(self, entry_point):
+        self.entry_point = entry_point
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.counters = {}
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed_ms):
+        with self._lock:
+            stats = self.spans.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def annotate(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def summary(self, outcome):
+        with self._lock:
+            spans = {
+                name: {'count': stats['count'], 'total_ms': round(stats['total_ms'], 2), 'max_ms': round(stats['max_ms'], 2)}
+                for name, stats in sorted(self.spans.items())
+            }
+            return {
+                'message': 'invocation metrics',
+                'severity': 'INFO' if outcome == 'ok' else 'ERROR',
+                'entry_point': self.entry_point,
+                'outcome': outcome,
+                'duration_ms': round((time.perf_counter() - self.started) * 1000, 2),
+                **self.fields,
+                'spans': spans,
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+
+_current = contextvars.ContextVar('invocation_metrics', default=None)
+
+
+def current():
+    """Metrics of the running invocation, None outside of one."""
+    return _current.get()
+
+
+@contextmanager
+def span(name):
+    """Times the block as one occurrence of the stage `name`."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(name, (time.perf_counter() - start) * 1000)
+
+
+def add(name, value=1):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(name, value)
+
+
+def annotate(**fields):
+    """Extra top level fields for the invocation's log line (mailbox, history IDs...)."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.annotate(**fields)
+
+
+def submit_in_context(executor, fn, *args):
+    """executor.submit() that runs `fn` with the caller's metrics."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def log_payloads():
+    """Whether raw API responses and emails may be printed (LOG_PAYLOADS, off by default)."""
+    return os.environ.get('LOG_PAYLOADS', 'false').lower() == 'true'
+
+
+def _profiling_enabled():
+    return os.environ.get('PROFILE_INVOCATIONS', 'false').lower() == 'true'
+
+
+def _dump_profile(profiler, entry_point):
+    directory = os.environ.get('PROFILE_DIR', '/tmp')
+    path = os.path.join(directory, f"profile-{entry_point}-{int(time.time() * 1000)}.prof")
+    profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    print(f"🔬 Profile written to {path}\n{out.getvalue()}")
+    return path
+
+
+def instrumented(entry_point):
+    """Decorator for entry points: collects metrics and logs them once the invocation ends."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            metrics = InvocationMetrics(entry_point)
+            token = _current.set(metrics)
+            profiler = cProfile.Profile() if _profiling_enabled() else None
+            outcome = 'error'
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                result = fn(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    metrics.annotate(profile_path=_dump_profile(profiler, entry_point))
+                print(json.dumps(metrics.summary(outcome), default=str))
+                _current.reset(token)
+        return wrapper
+    return decorator
@@ -0,0 +1,252 @@
+"""
+Quota-aware rate limiting and retries for Gmail API calls and backend POSTs.
+
+Gmail bills every call in quota units (messages.get costs 5, history.list 2...)
+and starts answering 429 / 403 rateLimitExceeded when a user goes over about
+250 units per second. Instead of letting one throttled call fail the whole
+invocation (and Pub/Sub redeliver all of it), every call goes through a
+`RateLimiter`:
+
+    TokenBucket          spends the call's quota units, waiting when the bucket is empty
+    AdaptiveConcurrency  caps the calls in flight, AIMD: +1 per `limit` successes,
+                         halved when a call is throttled
+    retries              a throttled or transiently failed call is retried on its own,
+                         after its Retry-After or a jittered exponential backoff
+
+A Retry-After also empties the bucket, so every thread of the instance holds off,
+not only the one that was told to. It is capped at MAX_RETRY_AFTER_SECONDS, and
+a call whose wait (for its units or before a retry) would run past the
+invocation deadline fails right away instead of sleeping into the function
+timeout. The limiters are shared by all the invocations an instance serves: one
+for Gmail and one for the backend.
+
+GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_MAX_CONCURRENCY and GMAIL_MAX_ATTEMPTS tune
+the Gmail limiter (0 units per second turns the quota bucket off, e.g. against a
+fake Gmail), BACKEND_RATE_LIMIT (requests per second, 0 for no limit, the
+default) and BACKEND_MAX_ATTEMPTS the backend one.
+"""
+
+import email.utils
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+# Quota units per method: https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_UNITS = {
+    'getProfile': 1,
+    'labels.list': 1,
+    'history.list': 2,
+    'messages.get': 5,
+    'messages.list': 5,
+    'messages.attachments.get': 5,
+    'watch': 100,
+}
+# Gmail allows 250 quota units per user per second
+DEFAULT_GMAIL_QUOTA_UNITS_PER_SECOND = 250
+DEFAULT_GMAIL_MAX_CONCURRENCY = 10
+DEFAULT_GMAIL_MAX_ATTEMPTS = 5
+DEFAULT_BACKEND_MAX_ATTEMPTS = 3
+
+DEFAULT_BACKOFF_BASE_SECONDS = 0.5
+DEFAULT_BACKOFF_MAX_SECONDS = 32
+# A burst of throttled calls only halves the concurrency once
+DECREASE_COOLDOWN_SECONDS = 1.0
+# Longest Retry-After we wait for, or make the other calls of the instance wait for
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+class DeadlineExceeded(Exception):
+    """A call would have to wait past the invocation deadline to go out."""
+
+
+def retry_after_seconds(exception):
+    """Seconds from the Retry-After header of a failed Gmail or backend call, None without one."""
+    response = getattr(exception, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is None:
+        # googleapiclient's HttpError keeps the httplib2 response (a dict of lowercase headers)
+        headers = getattr(exception, 'resp', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF_BASE_SECONDS, cap=DEFAULT_BACKOFF_MAX_SECONDS):
+    """Full jitter exponential backoff before retry number `attempt` (1 for the first retry)."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+    """
+        `rate` units per second, up to `capacity` saved up. acquire() reserves the
+        units right away and sleeps until they are earned, so waiting callers are
+        served in order.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, units=1, deadline=None):
+        """
+            Takes `units`, returns the seconds waited for them. Raises DeadlineExceeded,
+            without taking them, when they would only be earned after `deadline`.
+        """
+        with self._lock:
+            self._refill()
+            tokens = self._tokens - units
+            wait = -tokens / self.rate if tokens < 0 else 0.0
+            if deadline is not None and wait and self._clock() + wait >= deadline:
+                raise DeadlineExceeded(f"{units} quota units would take {wait:.1f}s, past the deadline")
+            self._tokens = tokens
+        if wait > 0:
+            (self._sleep or time.sleep)(wait)
+        return wait
+
+    def hold_off(self, seconds):
+        """Empties the bucket so nothing goes out for `seconds` (a Retry-After for everyone)."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class AdaptiveConcurrency:
+    """AIMD cap on calls in flight between `minimum` and `maximum`."""
+
+    def __init__(self, limit, minimum=1, maximum=None, clock=time.monotonic):
+        self.maximum = float(maximum or limit)
+        self.minimum = float(minimum)
+        self.limit = float(limit)
+        self._in_flight = 0
+        self._clock = clock
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            now = self._clock()
+            if self._last_decrease is not None and now - self._last_decrease < DECREASE_COOLDOWN_SECONDS:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+class RateLimiter:
+    """
+        Runs calls through a token bucket (when `units_per_second` is set) and an
+        AIMD concurrency cap, and retries the ones `is_retryable` accepts up to
+        `max_attempts` times. `name` prefixes the metrics counters.
+    """
+
+    def __init__(self, name, is_retryable, units_per_second=None, max_concurrency=DEFAULT_GMAIL_MAX_CONCURRENCY,
+                 max_attempts=DEFAULT_GMAIL_MAX_ATTEMPTS, sleep=None):
+        self.name = name
+        self.is_retryable = is_retryable
+        self.bucket = TokenBucket(units_per_second, sleep=sleep) if units_per_second else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.key = None
+        self._sleep = sleep
+
+    def acquire(self, units=1, deadline=None):
+        if self.bucket is not None:
+            waited = self.bucket.acquire(units, deadline)
+            if waited:
+                metrics.add(f"{self.name}.rate_wait_ms", round(waited * 1000))
+
+    def throttled(self, exception, attempt, deadline=None):
+        """
+            Records a throttled or failed attempt and sleeps before the next one.
+            Returns False instead when the backoff would run past `deadline`.
+        """
+        self.concurrency.on_throttle()
+        metrics.add(f"{self.name}.throttled")
+        retry_after = retry_after_seconds(exception)
+        if retry_after is not None:
+            retry_after = min(retry_after, MAX_RETRY_AFTER_SECONDS)
+        if retry_after is not None and self.bucket is not None:
+            self.bucket.hold_off(retry_after)
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return False
+        metrics.add(f"{self.name}.retries")
+        (self._sleep or time.sleep)(delay)
+        return True
+
+    def call(self, fn, units=1, deadline=None):
+        """fn() under the limits, retried on retryable errors. Raises the last error."""
+        attempt = 1
+        while True:
+            self.acquire(units, deadline)
+            try:
+                with self.concurrency.slot():
+                    result = fn()
+            except Exception as e:
+                if attempt >= self.max_attempts or not self.is_retryable(e):
+                    raise
+                if not self.throttled(e, attempt, deadline):
+                    raise
+                attempt += 1
+                continue
+            self.concurrency.on_success()
+            return result
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name, is_retryable, **settings):
+    """The instance wide RateLimiter `name`, replaced when its settings change."""
+    key = (name, is_retryable, tuple(sorted(settings.items())))
+    limiter = _limiters.get(name)
+    if limiter is None or limiter.key != key:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None or limiter.key != key:
+                limiter = RateLimiter(name, is_retryable, **settings)
+                limiter.key = key
+                _limiters[name] = limiter
+    return limiter
@@ -0,0 +1,127 @@
+"""
+Declarative rules deciding which emails are worth a full download.
+
+Rules are evaluated on a cheap `format='metadata'` fetch (headers and labels
+only), so rejected emails never pay for their body. They come from the
+EMAIL_RULES environment variable or a Firestore document, as JSON:
+
+    {
+        "default": "accept",
+        "rules": [
+            {"action": "reject", "from": "no-?reply@", "subject": "(?i)newsletter"},
+            {"action": "accept", "headers": {"X-Bank-Alert": ".+"}, "labels": ["Banks"]}
+        ]
+    }
+
+A rule matches when all of its conditions match: `from` and `subject` are
+regular expressions searched in those headers, `headers` maps header names to
+regular expressions, and `labels` matches when the email has any of those labels
+(names or IDs). The first matching rule decides, `default` applies otherwise.
+A bare list of rules is also accepted.
+"""
+
+import re
+
+ACTIONS = ('accept', 'reject')
+# Headers the metadata fetch always asks for, rules can add their own
+BASE_METADATA_HEADERS = ('From', 'Subject')
+
+
+class RulesConfigError(ValueError):
+    """Raised when the rules configuration can't be compiled."""
+
+
+class CompiledRule:
+    def __init__(self, action, header_patterns, label_ids):
+        self.action = action
+        # [(lowercase header name, compiled pattern)]
+        self.header_patterns = header_patterns
+        self.label_ids = label_ids
+
+    def matches(self, headers, label_ids):
+        if self.label_ids and self.label_ids.isdisjoint(label_ids):
+            return False
+        for name, pattern in self.header_patterns:
+            value = headers.get(name)
+            if value is None or not pattern.search(value):
+                return False
+        return True
+
+
+class CompiledRules:
+    """Rules ready to evaluate, see compile_rules()."""
+
+    def __init__(self, rules, default_action, metadata_headers):
+        self.rules = rules
+        self.default_action = default_action
+        self.metadata_headers = metadata_headers
+
+    def decide(self, headers, label_ids=()):
+        """'accept' or 'reject' for an email with `headers` ({name: value}) and `label_ids`."""
+        headers = {name.lower(): value for name, value in headers.items()}
+        for rule in self.rules:
+            if rule.matches(headers, label_ids):
+                return rule.action
+        return self.default_action
+
+    def accepts(self, msg):
+        """Decides on a `format='metadata'` (or 'full') message resource."""
+        headers = {}
+        for header in msg.get('payload', {}).get('headers', []):
+            headers.setdefault(header['name'], header['value'])
+        return self.decide(headers, msg.get('labelIds', [])) == 'accept'
+
+
+def normalize_config(config):
+    """Returns (rules list, default action) for either accepted config shape."""
+    if isinstance(config, list):
+        return config, 'accept'
+    if not isinstance(config, dict):
+        raise RulesConfigError("Rules must be a JSON object or a list of rules")
+    return config.get('rules', []), config.get('default', 'accept')
+
+
+def referenced_labels(config):
+    """Every label mentioned by the rules, to resolve them to IDs before compiling."""
+    rules, _ = normalize_config(config)
+    return tuple(dict.fromkeys(label for rule in rules for label in rule.get('labels', [])))
+
+
+def _compile_pattern(pattern, where):
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise RulesConfigError(f"Invalid regular expression in {where}: {e}") from e
+
+
+def compile_rules(config, label_ids_by_name=None):
+    """
+        Compiles the rules configuration. `label_ids_by_name` turns label names
+        into IDs, labels that aren't in it are taken as IDs already.
+    """
+    rules, default_action = normalize_config(config)
+    label_ids_by_name = label_ids_by_name or {}
+    if default_action not in ACTIONS:
+        raise RulesConfigError(f"default must be one of {ACTIONS}, got {default_action!r}")
+
+    compiled = []
+    metadata_headers = list(BASE_METADATA_HEADERS)
+    for index, rule in enumerate(rules):
+        action = rule.get('action', 'accept')
+        if action not in ACTIONS:
+            raise RulesConfigError(f"rules[{index}].action must be one of {ACTIONS}, got {action!r}")
+
+        header_patterns = []
+        if 'from' in rule:
+            header_patterns.append(('from', _compile_pattern(rule['from'], f"rules[{index}].from")))
+        if 'subject' in rule:
+            header_patterns.append(('subject', _compile_pattern(rule['subject'], f"rules[{index}].subject")))
+        for name, pattern in rule.get('headers', {}).items():
+            header_patterns.append((name.lower(), _compile_pattern(pattern, f"rules[{index}].headers.{name}")))
+            if name.lower() not in (header.lower() for header in metadata_headers):
+                metadata_headers.append(name)
+
+        label_ids = frozenset(label_ids_by_name.get(label) or label for label in rule.get('labels', []))
+        compiled.append(CompiledRule(action, header_patterns, label_ids))
+
+    return CompiledRules(compiled, default_action, tuple(metadata_headers))
@@ -0,0 +1,198 @@
+"""
+Delivery spool: parsed emails the backend didn't take, kept until it does.
+
+Without it a slow or unavailable backend fails the sync, last_id stays behind
+and Pub/Sub redelivers the whole event, fetching from Gmail all over again. With
+DELIVERY_SPOOL set, emails that could not be delivered are written to the spool
+instead, the sync advances last_id right away, and `drain_delivery_spool` (run
+every few minutes by Cloud Scheduler) sends them again in batches.
+
+Each entry is retried with an exponential backoff (DELIVERY_SPOOL_BACKOFF_SECONDS,
+doubled per attempt up to an hour). After DELIVERY_SPOOL_MAX_ATTEMPTS failed
+attempts it is moved to the dead letters, where it stays for somebody to look at.
+
+DELIVERY_SPOOL selects the backend (see backends.py):
+    off (default)   undelivered emails fail the sync, as before
+    firestore       one document per email in `delivery_spool`, dead letters in `dead_letters`
+    sqlite:<path>   a local SQLite file, for tests and local runs
+    memory          in-memory, lost when the instance goes away
+
+Large messages the backend didn't take while they were streamed (see
+streaming.py) are spooled as their metadata only, under `email.stream`: the
+drain reads them from Gmail and streams them again.
+
+Like the ledger, each watched mailbox gets its own spool: collections under its
+Firestore document, or a prefix on its rows in SQLite.
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import backends
+
+DEFAULT_SPOOL_COLLECTION = 'delivery_spool'
+DEFAULT_DEAD_LETTER_COLLECTION = 'dead_letters'
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF_SECONDS = 60
+MAX_BACKOFF_SECONDS = 60 * 60
+
+
+def get_max_attempts():
+    return max(1, int(os.environ.get('DELIVERY_SPOOL_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)))
+
+
+def next_attempt_at(attempts, now=None):
+    """When an entry that failed `attempts` times is tried again: jittered exponential backoff."""
+    base = float(os.environ.get('DELIVERY_SPOOL_BACKOFF_SECONDS', DEFAULT_BACKOFF_SECONDS))
+    delay = min(MAX_BACKOFF_SECONDS, base * 2 ** max(0, attempts - 1))
+    return (now or time.time()) + delay * random.uniform(0.5, 1.0)
+
+
+def new_entry(email_data, error, now=None):
+    now = now or time.time()
+    return {
+        'message_id': email_data['message_id'],
+        'email': email_data,
+        'attempts': 0,
+        'spooled_at': now,
+        'next_attempt_at': now,
+        'last_error': str(error),
+    }
+
+
+def new_stream_entry(metadata, error, now=None):
+    """An entry for a streamed message, from main.stream_metadata(): it is read from Gmail again."""
+    return new_entry({'message_id': metadata['message_id'], 'stream': metadata}, error, now)
+
+
+class MemorySpool:
+    def __init__(self):
+        self.entries = {}
+        self.dead_letters = {}
+        self._lock = threading.Lock()
+
+    def add(self, entries):
+        with self._lock:
+            for entry in entries:
+                self.entries[entry['message_id']] = dict(entry)
+
+    def due(self, limit, now=None):
+        now = now or time.time()
+        with self._lock:
+            ready = [dict(entry) for entry in self.entries.values() if entry['next_attempt_at'] <= now]
+        ready.sort(key=lambda entry: entry['next_attempt_at'])
+        return ready[:limit]
+
+    def reschedule(self, entry):
+        with self._lock:
+            self.entries[entry['message_id']] = dict(entry)
+
+    def remove(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self.entries.pop(message_id, None)
+
+    def dead_letter(self, entry):
+        with self._lock:
+            self.entries.pop(entry['message_id'], None)
+            self.dead_letters[entry['message_id']] = dict(entry, dead_lettered_at=time.time())
+
+
+class SqliteSpool:
+    def __init__(self, path, namespace=None):
+        self.prefix = backends.sqlite_prefix(namespace)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        for table in ('spool', 'dead_letters'):
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (message_id TEXT PRIMARY KEY, "
+                f"next_attempt_at REAL NOT NULL, entry TEXT NOT NULL)"
+            )
+        self._conn.commit()
+
+    def _rows(self, entries):
+        return [(self.prefix + entry['message_id'], entry['next_attempt_at'], json.dumps(entry)) for entry in entries]
+
+    def add(self, entries):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO spool VALUES (?, ?, ?)", self._rows(entries))
+            self._conn.commit()
+
+    def due(self, limit, now=None):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entry FROM spool WHERE message_id LIKE ? AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (self.prefix + '%', now or time.time(), limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def reschedule(self, entry):
+        self.add([entry])
+
+    def remove(self, message_ids):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM spool WHERE message_id = ?", [(self.prefix + message_id,) for message_id in message_ids],
+            )
+            self._conn.commit()
+
+    def dead_letter(self, entry):
+        entry = dict(entry, dead_lettered_at=time.time())
+        with self._lock:
+            self._conn.execute("DELETE FROM spool WHERE message_id = ?", (self.prefix + entry['message_id'],))
+            self._conn.executemany("INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?)", self._rows([entry]))
+            self._conn.commit()
+
+
+class FirestoreSpool:
+    def __init__(self, db, collection=None, dead_letter_collection=None):
+        self.db = db
+        self.collection = db.collection(collection or DEFAULT_SPOOL_COLLECTION)
+        self.dead_letters = db.collection(dead_letter_collection or DEFAULT_DEAD_LETTER_COLLECTION)
+
+    def add(self, entries):
+        backends.write_in_batches(
+            self.db, entries, lambda batch, entry: batch.set(self.collection.document(entry['message_id']), entry),
+        )
+
+    def due(self, limit, now=None):
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        query = (
+            self.collection
+            .where(filter=FieldFilter('next_attempt_at', '<=', now or time.time()))
+            .order_by('next_attempt_at')
+            .limit(limit)
+        )
+        return [snapshot.to_dict() for snapshot in query.stream()]
+
+    def reschedule(self, entry):
+        self.collection.document(entry['message_id']).set(entry)
+
+    def remove(self, message_ids):
+        backends.write_in_batches(
+            self.db, message_ids, lambda batch, message_id: batch.delete(self.collection.document(message_id)),
+        )
+
+    def dead_letter(self, entry):
+        batch = self.db.batch()
+        batch.set(self.dead_letters.document(entry['message_id']), dict(entry, dead_lettered_at=time.time()))
+        batch.delete(self.collection.document(entry['message_id']))
+        batch.commit()
+
+
+_spools = backends.Backends('DELIVERY_SPOOL', 'off')
+
+
+def get_spool(db=None, collection=None, dead_letter_collection=None):
+    """Returns the spool selected by DELIVERY_SPOOL, or None when it is off."""
+    return _spools.get(
+        (id(db), collection),
+        memory=MemorySpool,
+        sqlite=lambda path: SqliteSpool(path, namespace=collection),
+        firestore=lambda: FirestoreSpool(db, collection, dead_letter_collection),
+    )
@@ -0,0 +1,175 @@
+"""
+Streaming of large emails, so memory stays flat whatever the message size.
+
+A normal fetch holds a message several times over: the `format='full'`
+response, the email_data dict, then the JSON body requests builds from it. For
+a 25 MB email that is enough to push a 256Mi function over its limit. With
+STREAM_MESSAGES_OVER_BYTES and BACKEND_STREAM_URL set, messages whose
+sizeEstimate (taken from a cheap metadata fetch, the rules' one when there are
+rules) is above it take another path:
+
+1. messages.get(format='raw', fields='raw') is read off the wire in chunks,
+   `iter_json_string` picks the base64url `raw` value out of the JSON as it comes.
+2. `decode_base64url_chunks` turns it back into the RFC 822 bytes, a few
+   kilobytes at a time.
+3. Those bytes are POSTed to the backend as they are decoded, with chunked
+   transfer encoding (`Content-Type: message/rfc822`, the subject, sender and date
+   in the `X-Email-Metadata` header).
+
+The `ByteBudget` shared by the instance caps the bytes of large messages in
+flight (STREAM_MAX_INFLIGHT_BYTES), so a burst of them is streamed a few at a time.
+
+When the backend doesn't take a message (`UploadFailed`) and DELIVERY_SPOOL is
+set, the spool keeps its metadata only, and the drain streams it from Gmail again.
+"""
+
+import base64
+import os
+import threading
+from contextlib import contextmanager
+
+# Bytes read from Gmail at a time
+STREAM_CHUNK_BYTES = 64 * 1024
+DEFAULT_STREAM_MAX_INFLIGHT_BYTES = 32 * 1024 * 1024
+
+
+def get_url():
+    """Where streamed emails are POSTed. Never BACKEND_URL, which expects the JSON emails."""
+    return os.environ.get('BACKEND_STREAM_URL', '').strip()
+
+
+def get_threshold():
+    """
+        sizeEstimate above which messages are streamed. 0 (the default) never
+        streams, and neither does a missing BACKEND_STREAM_URL.
+    """
+    threshold = int(os.environ.get('STREAM_MESSAGES_OVER_BYTES', 0))
+    if threshold and not get_url():
+        print("⚠️ STREAM_MESSAGES_OVER_BYTES is set without BACKEND_STREAM_URL, large emails are fetched whole")
+        return 0
+    return threshold
+
+
+def iter_json_string(chunks, field):
+    """
+        Yields the string value of `field` piece by piece from the bytes of a JSON
+        object read as `chunks`, without ever holding it whole. Only meant for
+        values without escape sequences, like base64url data.
+    """
+    marker = b'"' + field.encode('ascii') + b'"'
+    buffer = b''
+    state = 'field'
+    for chunk in chunks:
+        buffer += chunk
+        if state == 'field':
+            index = buffer.find(marker)
+            if index < 0:
+                # The marker may be split over two chunks
+                buffer = buffer[-len(marker):]
+                continue
+            buffer = buffer[index + len(marker):]
+            state = 'value'
+        if state == 'value':
+            quote = buffer.find(b'"')
+            if quote < 0:
+                # Only the colon and whitespace so far
+                buffer = b''
+                continue
+            buffer = buffer[quote + 1:]
+            state = 'string'
+        end = buffer.find(b'"')
+        if end >= 0:
+            if end:
+                yield buffer[:end]
+            return
+        if buffer:
+            yield buffer
+        buffer = b''
+    raise ValueError(f"The response ended before the end of {field!r}")
+
+
+def decode_base64url_chunks(pieces):
+    """Decodes base64url arriving in pieces of any length, yields the bytes as they come."""
+    carry = b''
+    for piece in pieces:
+        data = carry + piece
+        # Every 4 characters decode on their own, the rest waits for the next piece
+        usable = len(data) - len(data) % 4
+        carry = data[usable:]
+        if usable:
+            yield base64.urlsafe_b64decode(data[:usable])
+    if carry.rstrip(b'='):
+        yield base64.urlsafe_b64decode(carry + b'=' * (-len(carry) % 4))
+
+
+class UploadFailed(Exception):
+    """The backend didn't take a streamed message. Gmail was read fine, it can be streamed again later."""
+
+
+class ResponseChunks:
+    """
+        The chunks of a streamed response, which is closed once they are read, or
+        by close() when they never are.
+    """
+
+    def __init__(self, response, chunk_size=STREAM_CHUNK_BYTES):
+        self.response = response
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        try:
+            yield from self.response.iter_content(self.chunk_size)
+        finally:
+            self.response.close()
+
+    def close(self):
+        self.response.close()
+
+
+class ByteBudget:
+    """
+        Bytes of large messages allowed in flight at once. A message bigger than
+        the whole budget waits until it can go alone.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        """Waits until `size` bytes fit and takes them, returns what release() must give back."""
+        size = min(max(1, int(size)), self.limit)
+        with self._cond:
+            while self.in_use + size > self.limit:
+                self._cond.wait()
+            self.in_use += size
+        return size
+
+    def release(self, size):
+        with self._cond:
+            self.in_use -= size
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, size):
+        size = self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_budget():
+    """The instance wide budget of STREAM_MAX_INFLIGHT_BYTES, replaced when the setting changes."""
+    global _budget
+    limit = int(os.environ.get('STREAM_MAX_INFLIGHT_BYTES', DEFAULT_STREAM_MAX_INFLIGHT_BYTES))
+    if _budget is None or _budget.limit != max(1, limit):
+        with _budget_lock:
+            if _budget is None or _budget.limit != max(1, limit):
+                _budget = ByteBudget(limit)
+    return _budget
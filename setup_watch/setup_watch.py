@@ -1,81 +1,45 @@
 """
-Setup watch script. This only has to be run the first time.
-afterwards there will be a watch renewal logic inside the cloud function code.
-Pub/sub topics need to be renewed every 7 days to watch email events.
+Setup watch script. This only has to be run the first time: it calls watch()
+and seeds last_id for every mailbox, afterwards the `renew_gmail_watch` function
+(triggered daily by Cloud Scheduler) keeps the watches alive.
+Gmail stops sending notifications 7 days after the last watch() call.
+
+With GMAIL_ACCOUNTS set (see cloud_function/mailboxes.py) every account in it is
+watched and seeded in one run, otherwise the single GMAIL_* account is.
+
+Running it again renews the watches but leaves last_id alone, so nothing that
+arrived in between is skipped.
 """
 
 import os
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+import sys
 from dotenv import load_dotenv
 from google.cloud import firestore
 
-def get_label_id(service, label_list):
-    """Find label ID by name"""
-    results = service.users().labels().list(userId='me').execute()
-    labels = results.get('labels', [])
-
-    label_id_list = []
-
-    for label_name in label_list:
-        for label in labels:
-            if label['name'] == label_name:
-                label_id_list.append(label['id'])
-    
-    return label_id_list
-
-def setup_gmail_watch():
-    # 1. Prepare Credentials
-    load_dotenv()
-    email_fetching_labels_raw = os.getenv('EMAIL_FETCHING_LABELS', [])
-    email_fetching_labels = [label.strip() for label in email_fetching_labels_raw.split(",") if label]
-    print(os.environ.get('GMAIL_CLIENT_ID'))
-    creds = Credentials(
-        token=None,
-        refresh_token=os.environ.get('GMAIL_REFRESH_TOKEN'),
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.environ.get('GMAIL_CLIENT_ID'),
-        client_secret=os.environ.get('GMAIL_CLIENT_SECRET'),
-    )
-
-    # 2. Refresh the token
-    if not creds.valid:
-        creds.refresh(Request())
-
-    # 3. Build Gmail Service
-    service = build('gmail', 'v1', credentials=creds)
+# Reuse the cloud function's clients, label cache, account map and state layout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud_function'))
+import mailboxes
+import main
 
-    # 4. Define the Pub/Sub Topic
-    # Format: projects/{project_id}/topics/{topic_name}
-    topic_name = f"projects/{os.environ.get('PROJECT_ID')}/topics/gmail-notifications-topic"
-
-    label_id_list = get_label_id(service, email_fetching_labels)
-
-    labels_to_listen = ['INBOX'] if len(label_id_list) == 0 else label_id_list
-
-    print(labels_to_listen)
-
-    body = {
-        'topicName': topic_name,
-        'labelIds': labels_to_listen
-    }
-
-    # 5. Execute the Watch request
+def setup_mailbox_watch(mailbox, db):
+    print(f"📬 {mailbox.email_address or 'default mailbox'}")
     try:
-        response = service.users().watch(userId='me', body=body).execute()
-        initial_id = response.get('historyId')
+        state = main.renew_watch(db, mailbox, force=True)
         print("Successfully established watch!")
-        print(f"History ID: {initial_id}")
-        print(f"Expiration (ms): {response.get('expiration')}")
-        db = firestore.Client(project=os.environ.get('PROJECT_ID'))
-        db.collection('state').document('gmail_sync').set({
-            'last_id': int(initial_id)
-        })
-        print("Firestore seeded successfully. Ready for notifications! 🚀")
+        print(f"History ID: {state['history_id']}")
+        print(f"Expiration (ms): {state['expiration']}")
+        print("Ready for notifications! 🚀")
+        return True
 
     except Exception as e:
         print(f"An error occurred: {e}")
+        return False
+
+def setup_gmail_watch():
+    load_dotenv()
+    db = firestore.Client(project=os.environ.get('PROJECT_ID'))
+    watched = [mailbox for mailbox in mailboxes.all_mailboxes() if setup_mailbox_watch(mailbox, db)]
+    print(f"Watching {len(watched)} mailbox(es).")
 
 if __name__ == '__main__':
-    setup_gmail_watch()
\ No newline at end of file
+    setup_gmail_watch()
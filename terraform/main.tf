@@ -28,6 +28,7 @@ resource "google_project_service" "gcp_services" {
     "secretmanager.googleapis.com",
     "firestore.googleapis.com",
     "pubsub.googleapis.com",
+    "cloudscheduler.googleapis.com",
     "gmail.googleapis.com"
   ])
   service            = each.key
@@ -77,6 +78,32 @@ resource "google_secret_manager_secret" "gmail_secrets" {
   depends_on = [google_project_service.gcp_services]
 }
 
+# Optional map of every mailbox one deployment watches (multi-mailbox mode)
+resource "google_secret_manager_secret" "gmail_accounts" {
+  count     = var.gmail_accounts == "" ? 0 : 1
+  secret_id = "gmail-accounts"
+
+  replication {
+    auto {}
+  }
+
+  depends_on = [google_project_service.gcp_services]
+}
+
+resource "google_secret_manager_secret_version" "gmail_accounts_version" {
+  count       = var.gmail_accounts == "" ? 0 : 1
+  secret      = google_secret_manager_secret.gmail_accounts[0].id
+  secret_data = var.gmail_accounts
+}
+
+resource "google_secret_manager_secret_iam_member" "gmail_accounts_access" {
+  count     = var.gmail_accounts == "" ? 0 : 1
+  project   = var.project_id
+  secret_id = google_secret_manager_secret.gmail_accounts[0].secret_id
+  role      = "roles/secretmanager.secretAccessor"
+  member    = "serviceAccount:${google_service_account.function_account.email}"
+}
+
 # CREATE SECRETS: for the backend
 resource "google_secret_manager_secret" "backend_secrets" {
   for_each  = toset(["url"])
@@ -148,6 +175,17 @@ resource "google_firestore_database" "database" {
   depends_on = [google_project_service.gcp_services]
 }
 
+# Ledger of forwarded messages (cloud_function/ledger.py), entries delete themselves
+# once `expire_at` has passed so the collection doesn't grow forever
+resource "google_firestore_field" "delivered_messages_ttl" {
+  project    = data.google_project.project.project_id
+  database   = google_firestore_database.database.name
+  collection = "delivered_messages"
+  field      = "expire_at"
+
+  ttl_config {}
+}
+
 # Grant Firestore Permissions to your Service Account
 resource "google_project_iam_member" "sa_firestore_user" {
   project = data.google_project.project.project_id
@@ -167,6 +205,7 @@ resource "google_project_iam_member" "function_iam_roles" {
     "roles/artifactregistry.writer",     # Save Image
     "roles/storage.objectViewer",        # Read Source ZIP
     "roles/logging.logWriter",           # Write Logs
+    "roles/pubsub.publisher",            # Publish work for the workers (fanout mode)
     "roles/run.invoker"                  # Allow Triggering (Gen 2)
   ])
   project = var.project_id
@@ -208,6 +247,17 @@ resource "google_pubsub_topic_iam_member" "gmail_publisher" {
   member = "serviceAccount:gmail-api-push@system.gserviceaccount.com"
 }
 
+# WORK QUEUE (fanout mode): the sync stage publishes message IDs, the workers forward them
+resource "google_pubsub_topic" "gmail_work" {
+  count = var.pipeline_mode == "fanout" ? 1 : 0
+  name  = "gmail-work-topic"
+  depends_on = [google_project_service.gcp_services]
+}
+
+locals {
+  worker_topic = var.pipeline_mode == "fanout" ? google_pubsub_topic.gmail_work[0].id : ""
+}
+
 # THE CLOUD FUNCTION (GEN 2)
 resource "google_cloudfunctions2_function" "email_processor" {
   name     = "gmail-intel-processor-v5"
@@ -227,11 +277,21 @@ resource "google_cloudfunctions2_function" "email_processor" {
   }
 
   service_config {
-    max_instance_count    = 1
+    # Overlapping notifications are coalesced by the sync lease in Firestore,
+    # so more than one instance can run without syncing the same history twice
+    max_instance_count    = var.max_instance_count
     available_memory      = "256Mi"
     timeout_seconds       = 60
     service_account_email = google_service_account.function_account.email
     ingress_settings      = "ALLOW_ALL" # Fixes Eventarc 403
+
+    environment_variables = {
+      PIPELINE_MODE              = var.pipeline_mode
+      WORKER_TOPIC               = local.worker_topic
+      DELIVERY_SPOOL             = var.delivery_spool
+      STREAM_MESSAGES_OVER_BYTES = var.stream_messages_over_bytes
+      BACKEND_STREAM_URL         = var.backend_stream_url
+    }
     
     # Secrets from your specific configuration
     secret_environment_variables {
@@ -268,6 +328,16 @@ resource "google_cloudfunctions2_function" "email_processor" {
       secret     = google_secret_manager_secret.backend_secrets["url"].secret_id
       version    = "latest"
     }
+
+    dynamic "secret_environment_variables" {
+      for_each = google_secret_manager_secret.gmail_accounts
+      content {
+        key        = "GMAIL_ACCOUNTS"
+        project_id = var.project_id
+        secret     = secret_environment_variables.value.secret_id
+        version    = "latest"
+      }
+    }
   
     /*secret_environment_variables {
       key        = "BACKEND_API_KEY"
@@ -292,6 +362,268 @@ resource "google_cloudfunctions2_function" "email_processor" {
   ]
 }
 
+# THE WORKER FUNCTION (fanout mode): fetches, cleans and forwards the published message IDs
+resource "google_cloudfunctions2_function" "email_worker" {
+  count    = var.pipeline_mode == "fanout" ? 1 : 0
+  name     = "gmail-intel-worker"
+  location = var.region
+
+  build_config {
+    runtime     = "python310"
+    entry_point = "process_message_batch"
+    service_account = google_service_account.function_account.id
+
+    source {
+      storage_source {
+        bucket = google_storage_bucket.email_listener_code_bucket.name
+        object = google_storage_bucket_object.email_listener_function_zip_object.name
+      }
+    }
+  }
+
+  service_config {
+    # Work messages are independent, bursts scale out here
+    max_instance_count    = var.worker_max_instance_count
+    available_memory      = "256Mi"
+    timeout_seconds       = 60
+    service_account_email = google_service_account.function_account.email
+    ingress_settings      = "ALLOW_ALL"
+
+    environment_variables = {
+      DELIVERY_SPOOL             = var.delivery_spool
+      STREAM_MESSAGES_OVER_BYTES = var.stream_messages_over_bytes
+      BACKEND_STREAM_URL         = var.backend_stream_url
+    }
+
+    secret_environment_variables {
+      key        = "GMAIL_CLIENT_ID"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.gmail_secrets["client-id"].secret_id
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "GMAIL_CLIENT_SECRET"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.gmail_secrets["client-secret"].secret_id
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "GMAIL_REFRESH_TOKEN"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.gmail_secrets["refresh-token"].secret_id
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "BACKEND_URL"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.backend_secrets["url"].secret_id
+      version    = "latest"
+    }
+
+    dynamic "secret_environment_variables" {
+      for_each = google_secret_manager_secret.gmail_accounts
+      content {
+        key        = "GMAIL_ACCOUNTS"
+        project_id = var.project_id
+        secret     = secret_environment_variables.value.secret_id
+        version    = "latest"
+      }
+    }
+  }
+
+  event_trigger {
+    trigger_region        = var.region
+    event_type            = "google.cloud.pubsub.topic.v1.messagePublished"
+    pubsub_topic          = google_pubsub_topic.gmail_work[0].id
+    retry_policy          = "RETRY_POLICY_RETRY"
+    service_account_email = google_service_account.function_account.email
+  }
+
+  depends_on = [
+    google_project_service.gcp_services,
+    google_project_iam_member.function_iam_roles
+  ]
+}
+
+# THE SPOOL DRAIN (delivery_spool = firestore): retries the emails the backend didn't take
+resource "google_cloudfunctions2_function" "spool_drain" {
+  count    = var.delivery_spool == "off" ? 0 : 1
+  name     = "gmail-intel-spool-drain"
+  location = var.region
+
+  build_config {
+    runtime     = "python310"
+    entry_point = "drain_delivery_spool"
+    service_account = google_service_account.function_account.id
+
+    source {
+      storage_source {
+        bucket = google_storage_bucket.email_listener_code_bucket.name
+        object = google_storage_bucket_object.email_listener_function_zip_object.name
+      }
+    }
+  }
+
+  service_config {
+    # One drain at a time, overlapping runs would send the same emails twice
+    max_instance_count    = 1
+    available_memory      = "256Mi"
+    timeout_seconds       = 60
+    service_account_email = google_service_account.function_account.email
+    ingress_settings      = "ALLOW_ALL"
+
+    environment_variables = {
+      DELIVERY_SPOOL   = var.delivery_spool
+      GMAIL_USER_EMAIL = var.gmail_user_email
+    }
+
+    secret_environment_variables {
+      key        = "BACKEND_URL"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.backend_secrets["url"].secret_id
+      version    = "latest"
+    }
+
+    dynamic "secret_environment_variables" {
+      for_each = google_secret_manager_secret.gmail_accounts
+      content {
+        key        = "GMAIL_ACCOUNTS"
+        project_id = var.project_id
+        secret     = secret_environment_variables.value.secret_id
+        version    = "latest"
+      }
+    }
+  }
+
+  depends_on = [
+    google_project_service.gcp_services,
+    google_project_iam_member.function_iam_roles
+  ]
+}
+
+# Calls the drain every few minutes, authenticated as the function's service account
+resource "google_cloud_scheduler_job" "spool_drain" {
+  count     = var.delivery_spool == "off" ? 0 : 1
+  name      = "gmail-spool-drain"
+  region    = var.region
+  schedule  = var.delivery_spool_drain_schedule
+  time_zone = "Etc/UTC"
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions2_function.spool_drain[0].service_config[0].uri
+
+    oidc_token {
+      service_account_email = google_service_account.function_account.email
+      audience              = google_cloudfunctions2_function.spool_drain[0].service_config[0].uri
+    }
+  }
+
+  depends_on = [google_project_service.gcp_services]
+}
+
+# WATCH RENEWAL: Gmail stops notifying 7 days after watch(), this renews it for every mailbox
+resource "google_cloudfunctions2_function" "watch_renewal" {
+  name     = "gmail-watch-renewal"
+  location = var.region
+
+  build_config {
+    runtime     = "python310"
+    entry_point = "renew_gmail_watch"
+    service_account = google_service_account.function_account.id
+
+    source {
+      storage_source {
+        bucket = google_storage_bucket.email_listener_code_bucket.name
+        object = google_storage_bucket_object.email_listener_function_zip_object.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count    = 1
+    available_memory      = "256Mi"
+    timeout_seconds       = 60
+    service_account_email = google_service_account.function_account.email
+    ingress_settings      = "ALLOW_ALL"
+
+    environment_variables = {
+      GMAIL_WATCH_TOPIC = google_pubsub_topic.gmail_notifications.id
+      GMAIL_USER_EMAIL  = var.gmail_user_email
+    }
+
+    secret_environment_variables {
+      key        = "GMAIL_CLIENT_ID"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.gmail_secrets["client-id"].secret_id
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "GMAIL_CLIENT_SECRET"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.gmail_secrets["client-secret"].secret_id
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "GMAIL_REFRESH_TOKEN"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.gmail_secrets["refresh-token"].secret_id
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "EMAIL_FETCHING_LABELS"
+      project_id = var.project_id
+      secret     = google_secret_manager_secret.gmail_secrets["fetching-labels"].secret_id
+      version    = "latest"
+    }
+
+    dynamic "secret_environment_variables" {
+      for_each = google_secret_manager_secret.gmail_accounts
+      content {
+        key        = "GMAIL_ACCOUNTS"
+        project_id = var.project_id
+        secret     = secret_environment_variables.value.secret_id
+        version    = "latest"
+      }
+    }
+  }
+
+  depends_on = [
+    google_project_service.gcp_services,
+    google_project_iam_member.function_iam_roles
+  ]
+}
+
+# Once a day: a watch is only renewed when it has less than WATCH_RENEW_BEFORE_HOURS (48) left
+resource "google_cloud_scheduler_job" "watch_renewal" {
+  name      = "gmail-watch-renewal"
+  region    = var.region
+  schedule  = var.watch_renewal_schedule
+  time_zone = "Etc/UTC"
+
+  retry_config {
+    retry_count = 3
+  }
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions2_function.watch_renewal.service_config[0].uri
+
+    oidc_token {
+      service_account_email = google_service_account.function_account.email
+      audience              = google_cloudfunctions2_function.watch_renewal.service_config[0].uri
+    }
+  }
+
+  depends_on = [google_project_service.gcp_services]
+}
+
 # Zip the local source code
 data "archive_file" "email_listener_function_zip" {
   type        = "zip"
@@ -14,6 +14,29 @@ variable "region" {
   default     = "us-central1"
 }
 
+variable "max_instance_count" {
+  description = "Maximum number of function instances"
+  type        = number
+  default     = 3
+}
+
+variable "pipeline_mode" {
+  description = "inline: one invocation syncs and forwards. fanout: the sync publishes message IDs to worker functions"
+  type        = string
+  default     = "inline"
+
+  validation {
+    condition     = contains(["inline", "fanout"], var.pipeline_mode)
+    error_message = "pipeline_mode must be inline or fanout."
+  }
+}
+
+variable "worker_max_instance_count" {
+  description = "Maximum number of worker instances in fanout mode"
+  type        = number
+  default     = 20
+}
+
 variable "gmail_user_email" {
   description = "Gmail email address to monitor"
   type        = string
@@ -39,7 +62,48 @@ variable "gmail_fetching_labels" {
   sensitive = true
 }
 
+variable "gmail_accounts" {
+  description = "Optional JSON map of mailboxes to watch (see cloud_function/mailboxes.py). Empty watches the single gmail_* account"
+  type        = string
+  default     = ""
+  sensitive   = true
+}
+
 variable "backend_url" {
   type      = string
   sensitive = true
-}
\ No newline at end of file
+}
+variable "delivery_spool" {
+  description = "off: emails the backend doesn't take fail the sync. firestore: they are spooled and retried by the drain function (see cloud_function/spool.py)"
+  type        = string
+  default     = "off"
+
+  validation {
+    condition     = contains(["off", "firestore"], var.delivery_spool)
+    error_message = "delivery_spool must be off or firestore."
+  }
+}
+
+variable "delivery_spool_drain_schedule" {
+  description = "Cron schedule of the delivery spool drain"
+  type        = string
+  default     = "*/5 * * * *"
+}
+
+variable "stream_messages_over_bytes" {
+  description = "Emails bigger than this are streamed raw to backend_stream_url instead of fetched whole (see cloud_function/streaming.py). 0 never streams"
+  type        = number
+  default     = 0
+}
+
+variable "backend_stream_url" {
+  description = "Endpoint taking the raw message/rfc822 uploads of streamed emails. Streaming stays off without it"
+  type        = string
+  default     = ""
+}
+
+variable "watch_renewal_schedule" {
+  description = "Cron schedule of the Gmail watch renewal"
+  type        = string
+  default     = "0 6 * * *"
+}
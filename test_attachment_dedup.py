@@ -0,0 +1,163 @@
+import base64
+import hashlib
+import os
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import attachments
+import spool
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import recording_backend, reset_caches, run_notification
+
+LOGO = b'\x89PNG' + bytes(range(256)) * 8
+ENV = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0',
+       'EMAIL_ATTACHMENTS': 'content', 'ATTACHMENT_INDEX': 'firestore'}
+
+
+def setup_mailbox():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    return gmail, db
+
+
+def test_known_attachments_are_sent_as_a_hash_reference():
+    gmail, db = setup_mailbox()
+    logo_hash = hashlib.sha256(LOGO).hexdigest()
+    backend, forwarded = recording_backend()
+
+    first = gmail.add_message(label_names=('Banks',))
+    gmail.add_attachment(first, 'logo.png', LOGO, 'image/png')
+    gmail.add_attachment(first, 'statement.pdf', b'%PDF-1.7 march')
+    run_notification(gmail, db, backend, ENV)
+
+    stubs = forwarded[first]['body']['attachments']
+    assert [stub['sha256'] for stub in stubs] == [logo_hash, hashlib.sha256(b'%PDF-1.7 march').hexdigest()]
+    assert base64.urlsafe_b64decode(stubs[0]['content']) == LOGO
+    assert db.data(f"attachment_blobs/{logo_hash}") is not None
+
+    # The next newsletters only carry the logo's hash, their new PDFs in full
+    later = gmail.add_messages(3, label_names=('Banks',))
+    for index, msg_id in enumerate(later):
+        gmail.add_attachment(msg_id, 'logo.png', LOGO, 'image/png')
+        gmail.add_attachment(msg_id, 'report.pdf', f"%PDF-1.7 report {index}".encode())
+    run_notification(gmail, db, backend, ENV)
+
+    for msg_id in later:
+        logo, report = forwarded[msg_id]['body']['attachments']
+        assert logo['sha256'] == logo_hash and 'content' not in logo
+        assert base64.urlsafe_b64decode(report['content']).startswith(b'%PDF-1.7 report')
+    assert gmail.calls['messages.attachments.get'] == 2 + 6
+
+
+def test_a_blob_is_only_indexed_once_its_email_was_delivered():
+    gmail, db = setup_mailbox()
+    backend, forwarded = recording_backend()
+
+    first = gmail.add_message(label_names=('Banks',))
+    gmail.add_attachment(first, 'logo.png', LOGO, 'image/png')
+    failing_backend, _ = recording_backend(fail_ids=[first])
+    with pytest.raises(RuntimeError):
+        run_notification(gmail, db, failing_backend, ENV)
+    assert db.data(f"attachment_blobs/{hashlib.sha256(LOGO).hexdigest()}") is None
+
+    # The retry still sends the content, the backend never received it
+    run_notification(gmail, db, backend, ENV)
+    assert 'content' in forwarded[first]['body']['attachments'][0]
+
+
+def test_attachments_over_the_size_limit_stay_stubs():
+    gmail, db = setup_mailbox()
+    backend, forwarded = recording_backend()
+
+    msg_id = gmail.add_message(label_names=('Banks',))
+    gmail.add_attachment(msg_id, 'scan.tiff', b'x' * 4096, 'image/tiff')
+    run_notification(gmail, db, backend, dict(ENV, EMAIL_ATTACHMENT_MAX_BYTES='1024'))
+
+    stub = forwarded[msg_id]['body']['attachments'][0]
+    assert stub['size'] == 4096 and 'sha256' not in stub and 'content' not in stub
+    assert gmail.calls['messages.attachments.get'] == 0
+
+
+def test_new_contents_past_the_email_budget_stay_stubs():
+    gmail, db = setup_mailbox()
+    backend, forwarded = recording_backend()
+    first = gmail.add_message(label_names=('Banks',))
+    gmail.add_attachment(first, 'logo.png', LOGO, 'image/png')
+    run_notification(gmail, db, backend, ENV)
+
+    msg_id = gmail.add_message(label_names=('Banks',))
+    gmail.add_attachment(msg_id, 'logo.png', LOGO, 'image/png')
+    for index in range(3):
+        gmail.add_attachment(msg_id, f"scan-{index}.pdf", bytes([index]) * 4096)
+    run_notification(gmail, db, backend, dict(ENV, EMAIL_ATTACHMENT_BUDGET_BYTES='9000'))
+
+    logo, *scans = forwarded[msg_id]['body']['attachments']
+    # The known logo costs nothing, two new scans fit, the third doesn't
+    assert 'sha256' in logo and 'content' not in logo
+    assert ['content' in stub for stub in scans] == [True, True, False]
+    assert 'sha256' not in scans[2]
+    assert db.data(f"attachment_blobs/{hashlib.sha256(bytes([2]) * 4096).hexdigest()}") is None
+
+
+def test_spooled_emails_lose_their_attachment_contents():
+    gmail, db = setup_mailbox()
+    msg_id = gmail.add_message(label_names=('Banks',))
+    gmail.add_attachment(msg_id, 'logo.png', LOGO, 'image/png')
+    failing_backend, _ = recording_backend(fail_ids=[msg_id])
+
+    env = dict(ENV, DELIVERY_SPOOL='memory', BACKEND_MAX_ATTEMPTS='1')
+    run_notification(gmail, db, failing_backend, env)
+
+    with patch.dict(os.environ, env):
+        entry, = spool.get_spool(db).due(10)
+    stub, = entry['email']['body']['attachments']
+    # A plain stub: a hash alone would point the backend at a file it never got
+    assert stub['filename'] == 'logo.png' and 'content' not in stub and 'sha256' not in stub
+    assert db.data(f"attachment_blobs/{hashlib.sha256(LOGO).hexdigest()}") is None
+
+
+def test_contents_in_flight_across_emails_stay_within_the_budget():
+    gmail, db = setup_mailbox()
+    msg_ids = gmail.add_messages(6, label_names=('Banks',))
+    for index, msg_id in enumerate(msg_ids):
+        gmail.add_attachment(msg_id, 'scan.pdf', bytes([index]) * 4096)
+    # Each email holds 5464 bytes of base64, two of them fit
+    env = dict(ENV, EMAIL_ATTACHMENT_INFLIGHT_BYTES='12000', BACKEND_MAX_CONCURRENCY='8')
+    with patch.dict(os.environ, env):
+        budget = attachments.get_inflight_budget()
+
+    lock = threading.Lock()
+    in_flight = []
+    most_in_flight = []
+    backend, forwarded = recording_backend()
+
+    def slow_backend(email_data, deadline=None):
+        with lock:
+            in_flight.append(email_data['message_id'])
+            most_in_flight.append(len(in_flight))
+        assert budget.in_use <= budget.limit
+        time.sleep(0.02)
+        backend(email_data)
+        with lock:
+            in_flight.remove(email_data['message_id'])
+
+    run_notification(gmail, db, slow_backend, env)
+
+    assert set(forwarded) == set(msg_ids)
+    assert max(most_in_flight) == 2
+    assert budget.in_use == 0
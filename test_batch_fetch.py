@@ -0,0 +1,74 @@
+import os
+import sys
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_gmail import FakeGmail
+
+# The fake Gmail has no quota to protect, don't wait on the token bucket
+NO_QUOTA = {'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+
+
+def test_batched_results_match_parse_message():
+    gmail = FakeGmail()
+    ids = gmail.add_messages(120)
+
+    with patch.dict(os.environ, NO_QUOTA):
+        emails, failed = main.fetch_messages_batched(gmail, ids, batch_size=50)
+        single = [main.parse_message(gmail, msg_id) for msg_id in ids]
+
+    assert failed == {}
+    assert emails == single
+    # 120 messages in chunks of 50 -> 3 round trips
+    assert gmail.calls['batch'] == 3
+
+
+def test_only_failed_sub_requests_are_retried():
+    gmail = FakeGmail()
+    ids = gmail.add_messages(40)
+    gmail.inject_error(ids[3], status=429, times=1)
+    gmail.inject_error(ids[7], status=403, reason='userRateLimitExceeded', times=2)
+
+    with patch.dict(os.environ, NO_QUOTA), patch('main.time.sleep'):
+        emails, failed = main.fetch_messages_batched(gmail, ids, batch_size=50)
+
+    assert failed == {}
+    assert [email['message_id'] for email in emails] == ids
+    fetches = [kwargs['id'] for method, kwargs in gmail.call_log if method == 'messages.get']
+    # First pass fetches all 40, then ids[3] and ids[7] once more, then ids[7] again
+    assert len(fetches) == 43
+    assert fetches[40:] == [ids[3], ids[7], ids[7]]
+
+
+def test_non_retryable_errors_are_reported_not_retried():
+    gmail = FakeGmail()
+    ids = gmail.add_messages(5)
+    gmail.inject_error(ids[0], status=403, reason='forbidden')
+
+    with patch.dict(os.environ, NO_QUOTA):
+        emails, failed = main.fetch_messages_batched(gmail, ids, batch_size=50)
+
+    assert list(failed) == [ids[0]]
+    assert [email['message_id'] for email in emails] == ids[1:]
+    assert gmail.calls['messages.get'] == 5
+
+
+def test_messages_deleted_since_they_were_listed_are_skipped():
+    gmail = FakeGmail()
+    ids = gmail.add_messages(5)
+    del gmail.messages[ids[2]]
+
+    with patch.dict(os.environ, NO_QUOTA):
+        emails, failed = main.fetch_messages_batched(gmail, ids, batch_size=50)
+        assert main.parse_message(gmail, ids[2]) is None
+
+    # Neither fetched nor failed, so they don't hold the sync back
+    assert failed == {}
+    assert [email['message_id'] for email in emails] == ids[:2] + ids[3:]
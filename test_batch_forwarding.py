@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import delivery
+from backend_stub import BackendStub
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+
+def make_emails(count, body_size=512):
+    return [
+        {"message_id": f"msg_{i:05d}", "subject": f"Newsletter {i}", "from": "news@example.com",
+         "date": "2024-01-01 00:00:00", "body": {"text": "lorem ipsum " * (body_size // 12)}}
+        for i in range(count)
+    ]
+
+
+def test_ndjson_batches_arrive_in_order_exactly_once():
+    emails = make_emails(250)
+
+    with BackendStub() as backend:
+        batch = delivery.BatchDelivery(backend.url, mode='ndjson', max_messages=100)
+        for email_data in emails:
+            batch.submit(email_data)
+        failed = batch.wait()
+
+    assert failed == {}
+    assert batch.delivered == 250
+    assert backend.requests == 3
+    assert [email['message_id'] for email in backend.received] == [email['message_id'] for email in emails]
+    # Repetitive newsletters compress well
+    assert backend.bytes_on_wire * 5 < backend.bytes_received
+
+
+def test_json_array_batches_respect_the_byte_cap():
+    emails = make_emails(40, body_size=4096)
+    one_email = max(len(json.dumps(email_data, separators=(',', ':'))) for email_data in emails)
+
+    with BackendStub() as backend:
+        batch = delivery.BatchDelivery(backend.url, mode='json', max_messages=100, max_bytes=one_email * 10)
+        for email_data in emails:
+            batch.submit(email_data)
+        failed = batch.wait()
+
+    assert failed == {}
+    assert backend.requests == 4
+    assert backend.received == emails
+
+
+def test_emails_without_an_ok_acknowledgement_are_reported_failed():
+    emails = make_emails(30)
+    rejected = {'msg_00004', 'msg_00017'}
+
+    with BackendStub(reject_ids=rejected) as backend:
+        batch = delivery.BatchDelivery(backend.url, mode='ndjson', max_messages=10)
+        for email_data in emails:
+            batch.submit(email_data)
+        failed = batch.wait()
+
+    assert set(failed) == rejected
+    assert batch.delivered == 28
+    assert len(backend.received) == 28
+
+
+def test_notification_sends_one_request_in_batch_mode():
+    gmail = FakeGmail(labels=['Newsletters'])
+    last_id = gmail.history_id
+    wanted = gmail.add_messages(80, label_names=('Newsletters',))
+
+    mock_firestore = MagicMock()
+    mock_doc = mock_firestore.collection.return_value.document.return_value.get.return_value
+    mock_doc.exists = True
+    mock_doc.to_dict.return_value = {'last_id': last_id}
+
+    cloud_event = make_cloud_event(gmail.history_id)
+
+    with BackendStub() as backend:
+        env = {'EMAIL_FETCHING_LABELS': 'Newsletters', 'BACKEND_URL': backend.url, 'BACKEND_BATCH_MODE': 'ndjson'}
+        with patch.dict(os.environ, env), \
+             patch('main._db', mock_firestore), \
+             patch('main.get_gmail_service', return_value=gmail), \
+             patch('main.update_in_transaction') as update:
+            reset_caches()
+            main.process_gmail_notification(cloud_event)
+
+    assert backend.requests == 1
+    assert [email['message_id'] for email in backend.received] == wanted
+    assert update.called
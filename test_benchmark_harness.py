@@ -0,0 +1,33 @@
+import os
+import sys
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import benchmark
+
+
+def test_scenario_reports_every_figure():
+    result = benchmark.run_scenario(50, runs=2, gmail_latency=0, backend_latency=0, env={})
+
+    assert result['size'] == 50
+    assert result['throughput'] > 0
+    assert result['invocation_p50_ms'] <= result['invocation_p99_ms']
+    assert result['delivery_p50_ms'] <= result['delivery_p99_ms']
+    assert result['peak_rss_mb'] > 0
+
+
+def test_regressions_beyond_the_tolerance_are_reported():
+    baseline = [{'size': 100, 'throughput': 200.0, 'invocation_p99_ms': 500.0, 'delivery_p99_ms': 450.0,
+                 'peak_rss_mb': 80.0}]
+    slower = [dict(baseline[0], throughput=120.0, peak_rss_mb=85.0)]
+
+    assert benchmark.regressions(baseline, baseline, 0.2) == []
+    found = benchmark.regressions(slower, baseline, 0.2)
+    assert len(found) == 1 and 'throughput' in found[0]
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_firestore import FakeFirestore
+
+HEAVY_MODULES = ('google.cloud.firestore', 'googleapiclient.discovery', 'google.oauth2.credentials', 'requests')
+
+
+def test_importing_main_leaves_the_client_libraries_for_later():
+    # A fresh interpreter, this one has already imported everything
+    code = (
+        f"import sys; sys.path.append({os.path.join(current_dir, 'cloud_function')!r}); import main; "
+        f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    )
+    env = {**os.environ, 'WARM_UP_CLIENTS': 'false'}
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=True)
+    assert completed.stdout.strip() == ''
+
+
+def test_lazy_transactional_retries_when_the_document_changed_underneath():
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': 1000})
+    state_ref = db.collection('state').document('gmail_sync')
+    original_get = type(state_ref).get
+    interfered = []
+
+    def get_then_interfere(self, transaction=None, field_paths=None):
+        snapshot = original_get(self, transaction=transaction, field_paths=field_paths)
+        # Another instance writes between our read and our commit, once
+        if transaction is not None and not interfered:
+            interfered.append(True)
+            db.document('state/gmail_sync').set({'last_id': 1003})
+        return snapshot
+
+    with patch.object(type(state_ref), 'get', get_then_interfere):
+        main.update_in_transaction(db.transaction(), state_ref, 1005)
+
+    assert db.aborted_transactions == 1
+    assert db.documents['state/gmail_sync']['last_id'] == 1005
+    assert main.update_in_transaction.__name__ == 'update_in_transaction'
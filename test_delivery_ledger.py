@@ -0,0 +1,71 @@
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import ledger
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+
+def test_sqlite_ledger_remembers_delivered_ids(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    ledger.SqliteLedger(path).record_delivered(['a', 'b', 'c'])
+
+    # A new connection sees what the previous one wrote
+    assert ledger.SqliteLedger(path).delivered_ids(['a', 'c', 'd']) == {'a', 'c'}
+
+
+def test_retry_only_forwards_what_failed(tmp_path):
+    gmail = FakeGmail(labels=['Banks'])
+    last_id = gmail.history_id
+    ids = gmail.add_messages(120, label_names=('Banks',))
+    broken = set(ids[10:15])
+
+    mock_firestore = MagicMock()
+    mock_doc = mock_firestore.collection.return_value.document.return_value.get.return_value
+    mock_doc.exists = True
+    mock_doc.to_dict.return_value = {'last_id': last_id}
+    cloud_event = make_cloud_event(gmail.history_id)
+
+    forwarded = []
+
+    def flaky_backend(email_data, deadline=None):
+        if email_data['message_id'] in broken:
+            raise ConnectionError("backend hiccup")
+        forwarded.append(email_data['message_id'])
+
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': f"sqlite:{tmp_path / 'ledger.db'}"}
+    with patch.dict(os.environ, env), \
+         patch('main._db', mock_firestore), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=flaky_backend), \
+         patch('main.update_in_transaction') as update:
+        reset_caches()
+
+        # First delivery of the event: 5 messages fail, Pub/Sub will retry
+        try:
+            main.process_gmail_notification(cloud_event)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("the event should fail while the backend is broken")
+        assert not update.called
+        assert len(forwarded) == 115
+
+        # The retry only fetches and forwards the 5 that failed
+        broken.clear()
+        gmail.calls.clear()
+        main.process_gmail_notification(cloud_event)
+
+    assert sorted(forwarded[115:]) == sorted(ids[10:15])
+    assert len(forwarded) == len(set(forwarded)) == 120
+    assert gmail.calls['messages.get'] == 5
+    assert update.called
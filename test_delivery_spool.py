@@ -0,0 +1,118 @@
+import json
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import spool
+from backend_stub import BackendStub
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+ENV = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0',
+       'BACKEND_MAX_ATTEMPTS': '1'}
+
+
+class FlakyBackend:
+    """forward_to_backend stand-in that fails every email while `down` is set."""
+
+    def __init__(self):
+        self.down = True
+        self.calls = 0
+        self.forwarded = []
+        self._lock = threading.Lock()
+
+    def __call__(self, email_data, deadline=None):
+        with self._lock:
+            self.calls += 1
+            if self.down:
+                raise ConnectionError("backend unavailable")
+            self.forwarded.append(email_data['message_id'])
+
+
+def test_backend_outage_spools_emails_and_the_drain_delivers_them(tmp_path):
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    wanted = gmail.add_messages(40, label_names=('Banks',))
+    backend = FlakyBackend()
+
+    env = dict(ENV, DELIVERY_SPOOL=f"sqlite:{tmp_path / 'spool.db'}")
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=backend):
+        # The backend being down doesn't fail the sync anymore
+        main.process_gmail_notification(make_cloud_event(gmail.history_id))
+        assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+        delivery_spool = spool.get_spool(db)
+        assert sorted(entry['message_id'] for entry in delivery_spool.due(100)) == wanted
+        # Once it failed a few times in a row the rest of the run didn't wait on it
+        assert backend.calls < len(wanted)
+
+        backend.down = False
+        body, status, _ = main.drain_delivery_spool(None)
+
+    assert status == 200
+    assert json.loads(body)['default']['delivered'] == len(wanted)
+    assert sorted(backend.forwarded) == wanted
+    assert delivery_spool.due(100) == []
+
+
+def test_emails_failing_every_attempt_end_up_in_the_dead_letters():
+    reset_caches()
+    db = FakeFirestore()
+    backend = FlakyBackend()
+    emails = [{'message_id': f"m{index}", 'subject': 'Statement'} for index in range(3)]
+
+    env = dict(ENV, DELIVERY_SPOOL='firestore', DELIVERY_SPOOL_MAX_ATTEMPTS='2', DELIVERY_SPOOL_BACKOFF_SECONDS='0')
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.forward_to_backend', side_effect=backend):
+        delivery_spool = spool.get_spool(db)
+        delivery_spool.add([spool.new_entry(email_data, 'timeout', now=1) for email_data in emails])
+
+        first = json.loads(main.drain_delivery_spool(None)[0])['default']
+        assert first == {'delivered': 0, 'retried': 3, 'dead_lettered': 0}
+        assert db.data('delivery_spool/m0')['attempts'] == 1
+
+        second = json.loads(main.drain_delivery_spool(None)[0])['default']
+
+    assert second == {'delivered': 0, 'retried': 0, 'dead_lettered': 3}
+    assert delivery_spool.due(100, now=float('inf')) == []
+    dead_letter = db.data('dead_letters/m1')
+    assert dead_letter['email'] == emails[1]
+    assert dead_letter['attempts'] == 2 and 'backend unavailable' in dead_letter['last_error']
+
+
+def test_batch_mode_spools_the_emails_the_backend_rejected():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    wanted = gmail.add_messages(10, label_names=('Banks',))
+
+    with BackendStub(reject_ids=set(wanted[:2])) as backend:
+        env = dict(ENV, DELIVERY_SPOOL='memory', BACKEND_BATCH_MODE='ndjson', BACKEND_URL=backend.url)
+        with patch.dict(os.environ, env), \
+             patch('main._db', db), \
+             patch('main.get_gmail_service', return_value=gmail):
+            main.process_gmail_notification(make_cloud_event(gmail.history_id))
+            delivery_spool = spool.get_spool(db)
+
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert sorted(email['message_id'] for email in backend.received) == wanted[2:]
+    spooled = delivery_spool.due(100)
+    assert sorted(entry['message_id'] for entry in spooled) == wanted[:2]
+    # The whole parsed email is kept, ready to be sent again
+    assert all(entry['email']['subject'] for entry in spooled)
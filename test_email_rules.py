@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import rules
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+RULES = {
+    "default": "reject",
+    "rules": [
+        {"action": "reject", "from": "no-?reply@", "subject": "(?i)weekly digest"},
+        {"action": "accept", "from": "@mybank\\.com"},
+        {"action": "accept", "headers": {"X-Priority": "^1"}},
+        {"action": "accept", "labels": ["Receipts"]},
+    ],
+}
+
+
+def test_first_matching_rule_decides():
+    compiled = rules.compile_rules(RULES, {'Receipts': 'Label_9'})
+
+    assert compiled.decide({'From': 'alerts@mybank.com', 'Subject': 'Payment'}) == 'accept'
+    assert compiled.decide({'From': 'noreply@mybank.com', 'Subject': 'Your Weekly Digest'}) == 'reject'
+    assert compiled.decide({'From': 'x@y.com', 'Subject': 'hi', 'x-priority': '1 (Highest)'}) == 'accept'
+    assert compiled.decide({'From': 'x@y.com', 'Subject': 'hi'}, ['Label_9']) == 'accept'
+    assert compiled.decide({'From': 'x@y.com', 'Subject': 'hi'}, ['INBOX']) == 'reject'
+    assert compiled.metadata_headers == ('From', 'Subject', 'X-Priority')
+
+
+def test_invalid_rules_are_reported():
+    try:
+        rules.compile_rules([{"action": "accept", "subject": "("}])
+    except rules.RulesConfigError as e:
+        assert "rules[0].subject" in str(e)
+    else:
+        raise AssertionError("an invalid regular expression should not compile")
+
+
+def test_rejected_messages_are_never_fully_downloaded():
+    gmail = FakeGmail(labels=['Banks', 'Receipts'])
+    last_id = gmail.history_id
+    accepted = [gmail.add_message(('Banks',), sender='Alerts <alerts@mybank.com>') for _ in range(30)]
+    rejected = [gmail.add_message(('Banks',), sender='Promo <deals@shop.com>') for _ in range(70)]
+    accepted.append(gmail.add_message(('Banks', 'Receipts'), sender='shop <orders@shop.com>'))
+
+    mock_firestore = MagicMock()
+    mock_doc = mock_firestore.collection.return_value.document.return_value.get.return_value
+    mock_doc.exists = True
+    mock_doc.to_dict.return_value = {'last_id': last_id}
+    cloud_event = make_cloud_event(gmail.history_id)
+
+    forwarded = []
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'EMAIL_RULES': json.dumps(RULES)}
+    with patch.dict(os.environ, env), \
+         patch('main._db', mock_firestore), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=lambda email, deadline=None: forwarded.append(email)), \
+         patch('main.update_in_transaction'):
+        reset_caches()
+        main.process_gmail_notification(cloud_event)
+
+    assert sorted(email['message_id'] for email in forwarded) == sorted(accepted)
+    full_fetches = {kwargs['id'] for method, kwargs in gmail.call_log
+                    if method == 'messages.get' and kwargs['format'] == 'full'}
+    assert full_fetches == set(accepted)
+    assert full_fetches.isdisjoint(rejected)
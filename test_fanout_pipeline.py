@@ -0,0 +1,116 @@
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import fanout
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from fake_pubsub import FakePublisher
+from function_harness import make_cloud_event, reset_caches
+
+WORKER_TOPIC = 'projects/test/topics/gmail-work'
+
+
+def test_burst_is_published_then_forwarded_by_parallel_workers():
+    gmail = FakeGmail(labels=['Banks', 'Promotions'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    wanted = gmail.add_messages(1500, label_names=('Banks',))
+    gmail.add_messages(200, label_names=('Promotions',))
+    publisher = FakePublisher()
+
+    forwarded = []
+    lock = threading.Lock()
+
+    def backend(email_data, deadline=None):
+        with lock:
+            forwarded.append(email_data['message_id'])
+
+    # The fake Gmail has no quota to respect
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'PIPELINE_MODE': 'fanout', 'WORKER_TOPIC': WORKER_TOPIC,
+           'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=backend), \
+         patch('fanout._publisher', publisher):
+        # A fresh in-memory ledger, the fake mailboxes reuse message IDs
+        reset_caches()
+
+        # The sync stage only walks the history and publishes
+        main.process_gmail_notification(make_cloud_event(gmail.history_id))
+        assert gmail.calls['messages.get'] == 0
+        assert forwarded == []
+        assert publisher.pending(WORKER_TOPIC) == 15
+        assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+
+        dead = publisher.deliver(WORKER_TOPIC, main.process_message_batch, instances=6)
+
+    assert dead == []
+    assert sorted(forwarded) == sorted(wanted)
+    assert gmail.calls['messages.get'] == 1500
+
+
+def test_failed_work_message_is_retried_without_duplicates():
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    ids = gmail.add_messages(250, label_names=('Banks',))
+    publisher = FakePublisher()
+    for start in range(0, len(ids), 100):
+        publisher.publish(WORKER_TOPIC, fanout.encode_work(ids[start:start + 100]))
+
+    broken = {ids[120]}
+    forwarded = []
+    lock = threading.Lock()
+
+    def flaky_backend(email_data, deadline=None):
+        if email_data['message_id'] in broken:
+            broken.clear()
+            raise ConnectionError("backend hiccup")
+        with lock:
+            forwarded.append(email_data['message_id'])
+
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=flaky_backend):
+        reset_caches()
+        dead = publisher.deliver(WORKER_TOPIC, main.process_message_batch, instances=3)
+
+    assert dead == []
+    assert publisher.redeliveries == 1
+    assert sorted(forwarded) == sorted(ids)
+
+
+def test_last_id_stays_when_publishing_fails():
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    last_id = gmail.history_id
+    db.seed('state/gmail_sync', {'last_id': last_id})
+    gmail.add_messages(30, label_names=('Banks',))
+
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'PIPELINE_MODE': 'fanout', 'WORKER_TOPIC': WORKER_TOPIC}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('fanout._publisher', FakePublisher(fail_publishes=1)):
+        reset_caches()
+        try:
+            main.process_gmail_notification(make_cloud_event(gmail.history_id))
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("the event should fail when the IDs can't be published")
+
+    assert db.data('state/gmail_sync')['last_id'] == last_id
+    assert db.data('state/gmail_sync_lease')['owner'] is None
@@ -0,0 +1,81 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import mailboxes
+from google.oauth2.credentials import Credentials
+
+MAILBOX = mailboxes.Mailbox('user@example.com', '1//refresh', 'client-id', 'client-secret', key='user@example.com')
+
+
+def patched_refresh(refreshes, delay=0.0):
+    """Credentials.refresh handing out a one-hour token, counting its calls instead of asking Google."""
+
+    def refresh(creds, request):
+        refreshes.append(creds)
+        time.sleep(delay)
+        creds.token = f"token-{len(refreshes)}"
+        creds.expiry = datetime.utcnow() + timedelta(hours=1)
+    return patch.object(Credentials, 'refresh', autospec=True, side_effect=refresh)
+
+
+def setup_client():
+    main._gmail_clients.clear()
+    return patch('googleapiclient.discovery.build', side_effect=lambda *args, **kwargs: object())
+
+
+def test_overlapping_calls_refresh_the_token_once():
+    refreshes = []
+    start = threading.Barrier(8)
+    services = []
+
+    def call():
+        start.wait()
+        services.append(main.get_gmail_service(MAILBOX))
+
+    with setup_client(), patched_refresh(refreshes, delay=0.1):
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # The others waited on the lock and found the token fresh
+    assert len(refreshes) == 1
+    assert len(services) == 8 and len({id(service) for service in services}) == 1
+
+
+def test_a_token_about_to_expire_is_refreshed():
+    refreshes = []
+    with setup_client(), patched_refresh(refreshes):
+        service = main.get_gmail_service(MAILBOX)
+        creds = main._gmail_clients[MAILBOX.key]['creds']
+        creds.expiry = datetime.utcnow() + main.TOKEN_REFRESH_MARGIN - timedelta(seconds=30)
+
+        assert main.get_gmail_service(MAILBOX) is service
+        assert len(refreshes) == 2
+        assert creds.token == 'token-2'
+
+
+def test_a_fresh_token_is_used_without_a_refresh():
+    refreshes = []
+    with setup_client(), patched_refresh(refreshes):
+        service = main.get_gmail_service(MAILBOX)
+        creds = main._gmail_clients[MAILBOX.key]['creds']
+        creds.expiry = datetime.utcnow() + main.TOKEN_REFRESH_MARGIN + timedelta(minutes=10)
+
+        for _ in range(5):
+            assert main.get_gmail_service(MAILBOX) is service
+        assert len(refreshes) == 1
+        assert creds.token == 'token-1'
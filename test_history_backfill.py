@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+from unittest.mock import patch
+
+import pytest
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import recording_backend, reset_caches, run_notification
+
+DAY = 24 * 60 * 60
+ENV = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory',
+       'BACKFILL_WINDOW_HOURS': '6', 'BACKFILL_CONCURRENCY': '4'}
+
+
+def outage_mailbox(days=3):
+    """A mailbox whose last sync was `days` ago, with mail spread over the outage and the history expired."""
+    now = int(time.time())
+    gmail = FakeGmail(labels=['Banks', 'Other'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id, 'synced_at': now - days * DAY})
+
+    banks_ids = gmail.add_messages(60, label_names=('Banks',))
+    other_ids = gmail.add_messages(15, label_names=('Other',))
+    for index, msg_id in enumerate(banks_ids + other_ids):
+        gmail.messages[msg_id]['internalDate'] = str((now - days * DAY + 60 + index * 3000) * 1000)
+    gmail.expire_history()
+    return gmail, db, banks_ids
+
+
+def test_expired_history_is_backfilled_and_last_id_reseeded():
+    reset_caches()
+    gmail, db, banks_ids = outage_mailbox()
+    backend, forwarded = recording_backend()
+
+    run_notification(gmail, db, backend, ENV)
+
+    assert sorted(forwarded) == sorted(banks_ids)
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert db.data('state/gmail_backfill') is None
+    # One messages.list per 6 hour window of the 3 day outage (plus the overlap)
+    assert 12 <= gmail.calls['messages.list'] <= 14
+
+    # Back to the normal history sync from the re-seeded historyId
+    new_ids = gmail.add_messages(5, label_names=('Banks',))
+    run_notification(gmail, db, backend, ENV)
+    assert sorted(forwarded) == sorted(banks_ids + new_ids)
+    assert gmail.calls['messages.list'] <= 14
+
+
+def test_interrupted_backfill_resumes_from_its_checkpoint():
+    reset_caches()
+    gmail, db, banks_ids = outage_mailbox()
+    backend, forwarded = recording_backend(fail_ids=[banks_ids[30]])
+
+    # The window holding the failing message is left for the retry, the others are done
+    with pytest.raises(RuntimeError, match="Backfill paused"):
+        run_notification(gmail, db, backend, ENV)
+    checkpoint = db.data('state/gmail_backfill')
+    assert len(checkpoint['done']) >= 10
+    assert db.data('state/gmail_sync')['last_id'] < gmail.history_id
+    listed_first = gmail.calls['messages.list']
+
+    # The Pub/Sub retry only lists the window that was left
+    run_notification(gmail, db, backend, ENV)
+    assert gmail.calls['messages.list'] == listed_first + 1
+    assert sorted(forwarded) == sorted(banks_ids)
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert db.data('state/gmail_backfill') is None
+
+
+@pytest.mark.parametrize('batch_size', ['0', '50'])
+def test_a_deleted_message_is_skipped_without_a_backfill(batch_size):
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id, 'synced_at': time.time()})
+    ids = gmail.add_messages(3, label_names=('Banks',))
+    # Deleted between history.list and messages.get
+    del gmail.messages[ids[1]]
+    backend, forwarded = recording_backend()
+
+    run_notification(gmail, db, backend, dict(ENV, GMAIL_FETCH_BATCH_SIZE=batch_size))
+
+    assert sorted(forwarded) == [ids[0], ids[2]]
+    assert gmail.calls['messages.list'] == 0 and db.data('state/gmail_backfill') is None
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
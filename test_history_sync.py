@@ -0,0 +1,88 @@
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+
+def make_firestore(last_id):
+    mock_firestore = MagicMock()
+    mock_doc = MagicMock()
+    mock_doc.exists = True
+    mock_doc.to_dict.return_value = {'last_id': last_id}
+    mock_doc_ref = MagicMock()
+    mock_doc_ref.get.return_value = mock_doc
+    mock_firestore.collection.return_value.document.return_value = mock_doc_ref
+    return mock_firestore
+
+
+def test_walks_every_page_and_passes_server_side_filters():
+    gmail = FakeGmail(labels=['Banks'])
+    start = gmail.history_id
+    expected = gmail.add_messages(3000, label_names=('Banks',))
+    label_id = gmail.label_id('Banks')
+
+    messages = list(main.iter_history_messages(gmail, start, label_id=label_id, page_size=500))
+
+    assert [m['id'] for m in messages] == expected
+    assert gmail.calls['history.list'] == 6
+    for method, kwargs in gmail.call_log:
+        assert kwargs['labelId'] == label_id
+        assert kwargs['maxResults'] == 500
+        assert kwargs['fields'] == main.HISTORY_FIELDS
+
+
+def test_dedupes_messages_seen_in_several_records():
+    gmail = FakeGmail()
+    start = gmail.history_id
+    ids = gmail.add_messages(1200)
+    for msg_id in ids[::3]:
+        gmail.add_label_change(msg_id)
+
+    messages = list(main.iter_history_messages(gmail, start, page_size=250))
+
+    assert [m['id'] for m in messages] == ids
+
+
+def test_first_page_is_yielded_before_the_next_is_requested():
+    gmail = FakeGmail()
+    start = gmail.history_id
+    gmail.add_messages(2000)
+
+    messages = main.iter_history_messages(gmail, start, page_size=500)
+    next(messages)
+
+    assert gmail.calls['history.list'] == 1
+
+
+def test_notification_forwards_messages_past_the_first_page():
+    gmail = FakeGmail(labels=['Banks', 'Newsletters'])
+    last_id = gmail.history_id
+    wanted = gmail.add_messages(2500, label_names=('Banks',))
+    gmail.add_messages(500, label_names=('Newsletters',))
+    forwarded = []
+
+    # The fake Gmail has no quota to respect
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'HISTORY_PAGE_SIZE': '500', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', make_firestore(last_id)), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=lambda email, deadline=None: forwarded.append(email)), \
+         patch('main.update_in_transaction') as update:
+        # Don't reuse labels resolved by another test
+        reset_caches()
+        main.process_gmail_notification(make_cloud_event(gmail.history_id))
+
+    # Delivery is concurrent, so only the set of forwarded messages is stable
+    assert sorted(email['message_id'] for email in forwarded) == wanted
+    assert len(forwarded) == len(wanted)
+    assert update.call_args.args[2] == gmail.history_id
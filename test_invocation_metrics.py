@@ -0,0 +1,67 @@
+import json
+import os
+import sys
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from backend_stub import BackendStub
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+
+def run_notification(env, count=60):
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    gmail.add_messages(count, label_names=('Banks',))
+
+    with BackendStub() as backend:
+        env = {'EMAIL_FETCHING_LABELS': 'Banks', 'BACKEND_URL': backend.url, 'DELIVERY_LEDGER': 'off', **env}
+        with patch.dict(os.environ, env), \
+             patch('main._db', db), \
+             patch('main.get_gmail_service', return_value=gmail):
+            reset_caches()
+            main.process_gmail_notification(make_cloud_event(gmail.history_id))
+    return backend
+
+
+def metrics_lines(output):
+    lines = [json.loads(line) for line in output.splitlines() if line.startswith('{"message": "invocation metrics"')]
+    assert len(lines) == 1
+    return lines[0]
+
+
+def test_one_structured_line_per_invocation(capsys):
+    backend = run_notification({})
+    output = capsys.readouterr().out
+    line = metrics_lines(output)
+
+    assert line['entry_point'] == 'process_gmail_notification'
+    assert line['outcome'] == 'ok'
+    for stage in ('firestore.read', 'labels', 'gmail.history_page', 'gmail.batch_full',
+                  'backend.post', 'firestore.transaction', 'firestore.lease'):
+        assert line['spans'][stage]['count'] >= 1, stage
+    assert line['spans']['backend.post']['count'] == 60
+    assert line['counters']['messages.fetched'] == 60
+    assert line['counters']['messages.forwarded'] == 60
+    assert line['counters']['backend.bytes_sent'] == backend.bytes_received
+    # Email bodies stay out of the logs unless LOG_PAYLOADS is set
+    assert "'body':" not in output
+
+
+def test_payload_logging_and_profile_are_opt_in(capsys, tmp_path):
+    run_notification({'LOG_PAYLOADS': 'true', 'PROFILE_INVOCATIONS': 'true', 'PROFILE_DIR': str(tmp_path)}, count=3)
+    output = capsys.readouterr().out
+    line = metrics_lines(output)
+
+    assert "'body':" in output
+    assert os.path.exists(line['profile_path'])
+    assert 'cumulative' in output
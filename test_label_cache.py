@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+
+ENV = {'GMAIL_QUOTA_UNITS_PER_SECOND': '0', 'LABEL_CACHE_TTL_SECONDS': '3600'}
+
+
+def setup_mailbox():
+    main._label_caches.clear()
+    gmail = FakeGmail(labels=['Banks', 'Receipts', 'Travel'])
+    db = FakeFirestore()
+    return gmail, db, db.collection('state').document('gmail_labels')
+
+
+def test_labels_are_listed_again_once_the_ttl_expires():
+    gmail, db, labels_ref = setup_mailbox()
+    banks = frozenset([gmail.label_id('Banks')])
+
+    with patch.dict(os.environ, ENV):
+        assert main.get_label_ids(gmail, ['Banks'], labels_ref) == banks
+        assert main.get_label_ids(gmail, ['Banks'], labels_ref) == banks
+        assert gmail.calls['labels.list'] == 1
+
+        # An hour later both the instance cache and the stored copy are too old
+        later = time.time() + 3601
+        with patch('main.time.time', return_value=later):
+            assert main.get_label_ids(gmail, ['Banks'], labels_ref) == banks
+        assert gmail.calls['labels.list'] == 2
+        assert db.data('state/gmail_labels')['fetched_at'] == later
+
+
+def test_a_cold_instance_loads_the_labels_stored_in_firestore():
+    gmail, db, labels_ref = setup_mailbox()
+    ids_by_name = {'Banks': 'Label_B', 'Receipts': 'Label_R'}
+
+    with patch.dict(os.environ, ENV):
+        db.seed('state/gmail_labels', {'ids_by_name': ids_by_name, 'fetched_at': time.time() - 60})
+        assert main.get_label_ids(gmail, ['Banks', 'Receipts'], labels_ref) == frozenset(['Label_B', 'Label_R'])
+        assert gmail.calls['labels.list'] == 0
+
+        # A stored copy past the TTL is refreshed and rewritten
+        main._label_caches.clear()
+        db.seed('state/gmail_labels', {'ids_by_name': ids_by_name, 'fetched_at': time.time() - 7200})
+        assert main.get_label_ids(gmail, ['Banks'], labels_ref) == frozenset([gmail.label_id('Banks')])
+        assert gmail.calls['labels.list'] == 1
+        assert db.data('state/gmail_labels')['ids_by_name']['Banks'] == gmail.label_id('Banks')
+
+
+def test_an_unknown_name_refreshes_the_labels_once():
+    gmail, db, labels_ref = setup_mailbox()
+
+    with patch.dict(os.environ, ENV):
+        db.seed('state/gmail_labels', {'ids_by_name': {'Banks': gmail.label_id('Banks')}, 'fetched_at': time.time()})
+        main.get_label_ids(gmail, ['Banks'], labels_ref)
+        assert gmail.calls['labels.list'] == 0
+
+        # EMAIL_FETCHING_LABELS gained a label: one call, and the whole map is kept
+        expected = frozenset([gmail.label_id('Banks'), gmail.label_id('Receipts')])
+        assert main.get_label_ids(gmail, ['Banks', 'Receipts'], labels_ref) == expected
+        assert gmail.calls['labels.list'] == 1
+        assert main.resolve_label_names(gmail, ['Travel'], labels_ref) == {'Travel': gmail.label_id('Travel')}
+        assert gmail.calls['labels.list'] == 1
+
+        # A name Gmail doesn't have is remembered as missing, not asked for every time
+        assert main.resolve_label_names(gmail, ['Archive'], labels_ref) == {'Archive': None}
+        assert main.resolve_label_names(gmail, ['Archive'], labels_ref) == {'Archive': None}
+        assert gmail.calls['labels.list'] == 2
+        assert main.get_label_ids(gmail, ['Banks', 'Receipts'], labels_ref) == expected
+        assert gmail.calls['labels.list'] == 2
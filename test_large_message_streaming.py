@@ -0,0 +1,250 @@
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import tracemalloc
+from unittest.mock import patch
+
+import requests
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import spool
+import streaming
+from backend_stub import BackendStub
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+MB = 1024 * 1024
+
+
+class FakeSession:
+    """Stands in for the AuthorizedSession of get_gmail_session(), answers with the queued responses."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, params=None, stream=False, timeout=None):
+        self.requests.append({'url': url, 'params': params, 'stream': stream})
+        return self.responses.pop(0)
+
+
+def raw_response(status, body=b'', headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response.raw = io.BytesIO(body)
+    response.url = main.GMAIL_MESSAGES_URL
+    return response
+
+
+def test_large_messages_are_streamed_with_flat_memory():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    small_ids = gmail.add_messages(3, label_names=('Banks',))
+    large_id = gmail.add_large_message(24 * MB, label_names=('Banks',), subject='Scanned statements')
+
+    expected = hashlib.sha256()
+    for data in gmail.iter_raw_bytes(large_id):
+        expected.update(data)
+
+    with BackendStub() as backend:
+        env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0',
+               'STREAM_MESSAGES_OVER_BYTES': str(MB), 'BACKEND_URL': backend.url,
+               'BACKEND_STREAM_URL': backend.url}
+        with patch.dict(os.environ, env), \
+             patch('main._db', db), \
+             patch('main.get_gmail_service', return_value=gmail), \
+             patch('main.open_raw_message', side_effect=lambda mailbox, msg_id, deadline=None:
+                   gmail.iter_raw_response(msg_id)):
+            tracemalloc.start()
+            try:
+                main.process_gmail_notification(make_cloud_event(gmail.history_id))
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+    received = {email['message_id']: email for email in backend.received}
+    assert sorted(received) == sorted(small_ids + [large_id])
+    streamed = received[large_id]
+    assert streamed['subject'] == 'Scanned statements'
+    assert streamed['raw_sha256'] == expected.hexdigest()
+    assert streamed['raw_size'] >= 24 * MB
+    # Only the small ones were fetched whole
+    assert gmail.calls['messages.get_raw'] == 1
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    # A fraction of the message size, whatever it is
+    assert peak < 4 * MB
+
+
+def test_rules_metadata_fetch_also_sizes_the_messages():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    small_ids = gmail.add_messages(3, label_names=('Banks',))
+    promo_id = gmail.add_message(('Banks',), sender='Promo <deals@shop.com>')
+    large_id = gmail.add_large_message(2 * MB, label_names=('Banks',))
+    email_rules = {"default": "accept", "rules": [{"action": "reject", "from": "deals@shop\\.com"}]}
+
+    with BackendStub() as backend:
+        env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0',
+               'STREAM_MESSAGES_OVER_BYTES': str(MB), 'BACKEND_URL': backend.url,
+               'BACKEND_STREAM_URL': backend.url, 'EMAIL_RULES': json.dumps(email_rules)}
+        with patch.dict(os.environ, env), \
+             patch('main._db', db), \
+             patch('main.get_gmail_service', return_value=gmail), \
+             patch('main.open_raw_message', side_effect=lambda mailbox, msg_id, deadline=None:
+                   gmail.iter_raw_response(msg_id)):
+            main.process_gmail_notification(make_cloud_event(gmail.history_id))
+
+    assert sorted(email['message_id'] for email in backend.received) == sorted(small_ids + [large_id])
+    # One metadata fetch per message, shared by the rules and the sizing
+    metadata_ids = [kwargs['id'] for method, kwargs in gmail.call_log
+                    if method == 'messages.get' and kwargs.get('format') == 'metadata']
+    assert sorted(metadata_ids) == sorted(small_ids + [promo_id, large_id])
+    assert gmail.calls['messages.get_raw'] == 1
+
+
+def sync_with_session(gmail, db, session, backend):
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0',
+           'STREAM_MESSAGES_OVER_BYTES': str(MB), 'BACKEND_URL': backend.url, 'BACKEND_STREAM_URL': backend.url}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.get_gmail_session', return_value=session):
+        main.process_gmail_notification(make_cloud_event(gmail.history_id))
+
+
+def test_raw_fetch_is_throttled_and_retried_like_any_gmail_call():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    large_id = gmail.add_large_message(2 * MB, label_names=('Banks',))
+    expected = hashlib.sha256(b''.join(gmail.iter_raw_bytes(large_id))).hexdigest()
+    session = FakeSession([
+        raw_response(429, b'{"error": {"code": 429}}', {'Retry-After': '0'}),
+        raw_response(200, b''.join(gmail.iter_raw_response(large_id))),
+    ])
+
+    with BackendStub() as backend:
+        sync_with_session(gmail, db, session, backend)
+
+    assert len(session.requests) == 2
+    assert session.requests[-1] == {'url': main.GMAIL_MESSAGES_URL + large_id,
+                                    'params': {'format': 'raw', 'fields': 'raw'}, 'stream': True}
+    # Retried by the Gmail limiter before the upload started, one POST only
+    assert backend.requests == 1
+    assert [email['raw_sha256'] for email in backend.received] == [expected]
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+
+
+def test_raw_fetch_error_fails_the_message_before_any_upload():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    last_id = gmail.history_id
+    large_id = gmail.add_large_message(2 * MB, label_names=('Banks',))
+    session = FakeSession([raw_response(403, b'{"error": {"code": 403, "errors": [{"reason": "forbidden"}]}}')])
+
+    with BackendStub() as backend:
+        try:
+            sync_with_session(gmail, db, session, backend)
+        except RuntimeError as e:
+            assert large_id in str(e)
+        else:
+            raise AssertionError("a message that couldn't be read should fail the event")
+
+    # Not retried, and the backend never saw a request for it
+    assert len(session.requests) == 1
+    assert backend.requests == 0
+    assert db.data('state/gmail_sync')['last_id'] == last_id
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}/"
+
+
+def test_a_message_the_stream_backend_refused_is_spooled_and_streamed_by_the_drain():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    large_id = gmail.add_large_message(2 * MB, label_names=('Banks',), subject='Scanned statements')
+    raw = b''.join(gmail.iter_raw_response(large_id))
+    opened = raw_response(200, raw)
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'memory', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0',
+           'STREAM_MESSAGES_OVER_BYTES': str(MB), 'DELIVERY_SPOOL': 'memory', 'BACKEND_MAX_ATTEMPTS': '2'}
+
+    # The backend refuses the connection, every attempt fails before the body is read
+    with patch.dict(os.environ, dict(env, BACKEND_URL=closed_port_url(), BACKEND_STREAM_URL=closed_port_url())), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.get_gmail_session', return_value=FakeSession([opened])):
+        main.process_gmail_notification(make_cloud_event(gmail.history_id))
+        entry, = spool.get_spool(db).due(10)
+
+    # The sync moved on, the Gmail response didn't stay open
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert opened.raw.closed
+    assert entry['email']['stream']['subject'] == 'Scanned statements'
+    assert entry['email']['stream']['size'] >= 2 * MB
+
+    with BackendStub() as backend:
+        with patch.dict(os.environ, dict(env, BACKEND_URL=backend.url, BACKEND_STREAM_URL=backend.url)), \
+             patch('main._db', db), \
+             patch('main.get_gmail_session', return_value=FakeSession([raw_response(200, raw)])):
+            body, status, _ = main.drain_delivery_spool(None)
+            assert spool.get_spool(db).due(10) == []
+
+    assert json.loads(body)['default']['delivered'] == 1
+    streamed, = backend.received
+    assert streamed['message_id'] == large_id and streamed['subject'] == 'Scanned statements'
+    assert streamed['raw_sha256'] == hashlib.sha256(b''.join(gmail.iter_raw_bytes(large_id))).hexdigest()
+
+
+def test_byte_budget_holds_large_messages_back():
+    budget = streaming.ByteBudget(10 * MB)
+    entered = []
+    release = threading.Event()
+
+    def stream(name, size):
+        with budget.reserve(size):
+            entered.append(name)
+            release.wait()
+
+    first = threading.Thread(target=stream, args=('first', 6 * MB))
+    first.start()
+    while not entered:
+        pass
+    second = threading.Thread(target=stream, args=('second', 6 * MB))
+    second.start()
+    second.join(0.2)
+    # The second one waits for the budget the first one holds
+    assert entered == ['first']
+
+    release.set()
+    first.join()
+    second.join()
+    assert entered == ['first', 'second'] and budget.in_use == 0
+
+    # A message bigger than the whole budget still goes, alone
+    with budget.reserve(50 * MB):
+        assert budget.in_use == budget.limit
@@ -0,0 +1,99 @@
+import base64
+import json
+import os
+import sys
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_gmail import default_message_template
+
+
+def b64url(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def text_part(mime_type, raw, charset='UTF-8'):
+    return {
+        "mimeType": mime_type,
+        "filename": "",
+        "headers": [{"name": "Content-Type", "value": f'{mime_type}; charset="{charset}"'}],
+        "body": {"size": len(raw), "data": b64url(raw)},
+    }
+
+
+def mixed_payload():
+    """multipart/mixed > (multipart/alternative > plain + html) + a PDF + an inline logo"""
+    return {
+        "mimeType": "multipart/mixed",
+        "headers": [{"name": "Subject", "value": "Statement"}],
+        "body": {"size": 0},
+        "parts": [
+            {
+                "mimeType": "multipart/alternative",
+                "body": {"size": 0},
+                "parts": [
+                    text_part("text/plain", "Votre relevé est prêt".encode('latin-1'), charset='ISO-8859-1'),
+                    text_part("text/html", b"<html><head><style>p{}</style></head><body><p>Your&nbsp;statement</p><br>is ready</body></html>"),
+                ],
+            },
+            {
+                "partId": "1",
+                "mimeType": "application/pdf",
+                "filename": "statement.pdf",
+                "body": {"size": 482113, "attachmentId": "ANGjdJ8"},
+            },
+            {
+                "partId": "2",
+                "mimeType": "image/png",
+                "filename": "",
+                "body": {"size": 12, "data": b64url(b"\x89PNG fake...")},
+            },
+        ],
+    }
+
+
+def test_decodes_text_parts_and_stubs_attachments():
+    body = main.extract_body(mixed_payload(), html_as_text=False)
+
+    assert body['text'] == "Votre relevé est prêt"
+    assert body['html'].startswith("<html>")
+    assert body['truncated'] is False
+    assert body['attachments'] == [
+        {"part_id": "1", "filename": "statement.pdf", "mime_type": "application/pdf", "size": 482113, "attachment_id": "ANGjdJ8"},
+        {"part_id": "2", "filename": None, "mime_type": "image/png", "size": 12, "attachment_id": None},
+    ]
+    # No base64 data left in what we forward
+    assert 'data' not in json.dumps(body['attachments'])
+
+
+def test_html_is_converted_when_there_is_no_plain_text():
+    payload = {"mimeType": "multipart/alternative", "parts": [mixed_payload()['parts'][0]['parts'][1]]}
+
+    body = main.extract_body(payload, html_as_text=True)
+
+    assert body['text'] == "Your statement\n\nis ready"
+    assert body['html'] is None
+
+
+def test_text_is_capped():
+    payload = text_part("text/plain", b"a" * 10000)
+
+    body = main.extract_body(payload, max_text_bytes=1000)
+
+    assert body['text'] == "a" * 1000
+    assert body['truncated'] is True
+
+
+def test_payload_format_keeps_the_raw_tree():
+    msg = default_message_template()
+
+    with patch.dict(os.environ, {'EMAIL_BODY_FORMAT': 'payload'}):
+        assert main.build_email_data(msg)['body'] == msg['payload']
+    assert main.build_email_data(msg)['body']['text'] == "Hello from a test"
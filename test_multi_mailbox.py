@@ -0,0 +1,90 @@
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+ACCOUNTS = {
+    "alice@example.com": {"refresh_token": "alice-token", "labels": "Banks"},
+    "Bob@Example.com": {"refresh_token": "bob-token", "labels": ["Receipts"]},
+}
+
+
+def test_each_mailbox_syncs_with_its_own_state_and_labels():
+    # Both mailboxes start at the same historyId, so their message IDs collide
+    gmails = {
+        'alice@example.com': FakeGmail(labels=['Banks', 'Receipts']),
+        'bob@example.com': FakeGmail(labels=['Banks', 'Receipts']),
+    }
+    db = FakeFirestore()
+    for address, gmail in gmails.items():
+        db.seed(f'mailboxes/{address}/state/gmail_sync', {'last_id': gmail.history_id})
+    alice_ids = gmails['alice@example.com'].add_messages(40, label_names=('Banks',))
+    gmails['alice@example.com'].add_messages(10, label_names=('Receipts',))
+    bob_ids = gmails['bob@example.com'].add_messages(30, label_names=('Receipts',))
+    gmails['bob@example.com'].add_messages(10, label_names=('Banks',))
+
+    forwarded = []
+    lock = threading.Lock()
+
+    def backend(email_data, deadline=None):
+        with lock:
+            forwarded.append((email_data['mailbox'], email_data['message_id']))
+
+    env = {'GMAIL_ACCOUNTS': json.dumps(ACCOUNTS), 'DELIVERY_LEDGER': 'memory', 'EMAIL_FETCHING_LABELS': ''}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', side_effect=lambda mailbox: gmails[mailbox.key]), \
+         patch('main.forward_to_backend', side_effect=backend):
+        reset_caches()
+        main.process_gmail_notification(make_cloud_event(gmails['alice@example.com'].history_id, 'alice@example.com'))
+        main.process_gmail_notification(make_cloud_event(gmails['bob@example.com'].history_id, 'BOB@example.com'))
+        # Not one of ours: acknowledged without touching anything
+        main.process_gmail_notification(make_cloud_event(99999, 'mallory@example.com'))
+
+    assert sorted(forwarded) == sorted(
+        [('alice@example.com', msg_id) for msg_id in alice_ids] + [('Bob@Example.com', msg_id) for msg_id in bob_ids]
+    )
+    for address, gmail in gmails.items():
+        assert db.data(f'mailboxes/{address}/state/gmail_sync')['last_id'] == gmail.history_id
+    # No document is shared between the mailboxes
+    assert all(path.startswith('mailboxes/') for path in db.writes_by_path)
+    assert db.data('state/gmail_sync') is None
+
+
+def test_gmail_client_is_cached_per_mailbox():
+    built = []
+
+    def fake_refresh(creds, request):
+        creds.token = f"access-for-{creds.refresh_token}"
+        creds.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    def fake_build(*args, credentials=None, **kwargs):
+        built.append(credentials.refresh_token)
+        return object()
+
+    with patch.dict(os.environ, {'GMAIL_ACCOUNTS': json.dumps(ACCOUNTS)}), \
+         patch('google.oauth2.credentials.Credentials.refresh', fake_refresh), \
+         patch('googleapiclient.discovery.build', side_effect=fake_build):
+        main._gmail_clients.clear()
+        alice = main.mailboxes.get_mailbox('alice@example.com')
+        bob = main.mailboxes.get_mailbox('bob@example.com')
+        services = [main.get_gmail_service(mailbox) for mailbox in (alice, bob, alice, bob)]
+        main._gmail_clients.clear()
+
+    assert built == ['alice-token', 'bob-token']
+    assert services[0] is services[2] and services[1] is services[3]
+    assert services[0] is not services[1]
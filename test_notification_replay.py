@@ -0,0 +1,69 @@
+import base64
+import json
+import os
+import sys
+
+# Make the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+import replay_notifications as replay
+from backend_stub import BackendStub
+
+
+def encoded(history_id):
+    return base64.b64encode(json.dumps({"emailAddress": "user@example.com", "historyId": history_id}).encode()).decode()
+
+
+def test_every_supported_shape_is_loaded_in_publish_order(tmp_path):
+    records = [
+        {"emailAddress": "user@example.com", "historyId": "103", "publishTime": "2024-05-01T10:00:03Z"},
+        {"message": {"data": encoded(101), "messageId": "m-101", "publishTime": "2024-05-01T10:00:01Z"}},
+        {"timestamp": "2024-05-01T10:00:02Z", "jsonPayload": {"data": encoded(102), "messageId": "m-102"}},
+        {"textPayload": "Function started"},
+    ]
+    path = tmp_path / 'stream.jsonl'
+    path.write_text('\n'.join(json.dumps(record) for record in records))
+
+    notifications = replay.load_notifications(str(path))
+
+    assert [item['history_id'] for item in notifications] == [101, 102, 103]
+    assert notifications[0]['message_id'] == 'm-101'
+    assert notifications[2]['published_at'] - notifications[0]['published_at'] == 2
+
+
+def test_bursts_and_duplicates_are_planned():
+    notifications = replay.synthetic_notifications(100, 1000, 'user@example.com')
+
+    plan = replay.schedule(notifications, rate=50, burst=10, duplicates=0.2, seed=1)
+
+    originals = [item for item in plan if not item[2]]
+    duplicates = [item for item in plan if item[2]]
+    assert len(originals) == 100
+    assert 5 < len(duplicates) < 40
+    # Ten notifications leave together every 0.2 s
+    assert sorted({round(at, 6) for at, _, _ in originals}) == [round(i * 0.2, 6) for i in range(10)]
+    # A redelivery carries the messageId of its original
+    original_ids = {notification['message_id'] for _, notification, _ in originals}
+    assert all(notification['message_id'] in original_ids for _, notification, _ in duplicates)
+
+
+def test_replay_posts_cloud_events_and_reads_outcomes():
+    notifications = replay.synthetic_notifications(30, 1000, 'user@example.com')
+    plan = replay.schedule(notifications, rate=1000, burst=10, duplicates=0.5, seed=2)
+
+    with BackendStub() as target:
+        results = replay.replay(target.url, plan, concurrency=8)
+
+    assert len(results) == len(target.received) == len(plan)
+    assert all(status == 200 for _, status in results)
+    sent = sorted(json.loads(base64.b64decode(event['message']['data']))['historyId'] for event in target.received)
+    assert sent == sorted(notification['history_id'] for _, notification, _ in plan)
+
+    log_lines = [
+        json.dumps({"message": "invocation metrics", "outcome": "ok", "result": result, "duration_ms": 10})
+        for result in ('synced', 'coalesced', 'coalesced', 'stale')
+    ] + ["🔔 Notification received. History ID: 1001"]
+    outcomes, durations = replay.invocation_outcomes(log_lines)
+    assert outcomes == {'synced': 1, 'coalesced': 2, 'stale': 1}
+    assert len(durations) == 4
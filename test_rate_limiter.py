@@ -0,0 +1,193 @@
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+import pytest
+import requests
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import delivery
+import ratelimit
+from backend_stub import BackendStub
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail, make_http_error
+from function_harness import make_cloud_event, reset_caches
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_spends_quota_units_and_waits_for_them():
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(250, clock=clock, sleep=clock.sleep)
+
+    # A full second of quota goes out at once: 50 messages.get
+    waits = [bucket.acquire(ratelimit.GMAIL_QUOTA_UNITS['messages.get']) for _ in range(50)]
+    assert waits == [0.0] * 50
+    # Then it is earned back at 250 units per second
+    assert bucket.acquire(5) == 0.02
+    assert clock.now == 0.02
+
+    # A Retry-After holds everybody off
+    bucket.hold_off(2)
+    assert round(bucket.acquire(1), 3) == 2.004
+
+
+def test_waits_that_would_run_past_the_deadline_fail_right_away():
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(10, clock=clock, sleep=clock.sleep)
+    bucket.acquire(10)
+
+    # 50 units take 5 s to earn, only 1 s is left: nothing is taken and nobody sleeps
+    with pytest.raises(ratelimit.DeadlineExceeded):
+        bucket.acquire(50, deadline=clock.now + 1)
+    assert clock.now == 0 and bucket.acquire(5, deadline=clock.now + 1) == 0.5
+
+
+def test_a_huge_retry_after_is_capped_and_never_outlives_the_deadline():
+    slept = []
+    limiter = ratelimit.RateLimiter('probe', main.is_retryable_error, sleep=slept.append)
+    attempts = []
+
+    def throttled_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise make_http_error(429, retry_after=600)
+        return 'ok'
+
+    assert limiter.call(throttled_once, 5) == 'ok'
+    assert slept == [ratelimit.MAX_RETRY_AFTER_SECONDS]
+
+    # With 30 s of budget left the same answer fails the call instead of sleeping
+    attempts.clear()
+    with pytest.raises(Exception) as raised:
+        limiter.call(throttled_once, 5, deadline=ratelimit.time.monotonic() + 30)
+    assert raised.value.resp.status == 429
+    assert len(slept) == 1
+
+    # The rest of the instance is held off for the capped time too
+    limiter = ratelimit.RateLimiter('probe', main.is_retryable_error, units_per_second=250, sleep=slept.append)
+    limiter.throttled(make_http_error(429, retry_after=600), 1)
+    with pytest.raises(ratelimit.DeadlineExceeded):
+        limiter.acquire(1, deadline=ratelimit.time.monotonic() + 59)
+    limiter.acquire(1, deadline=ratelimit.time.monotonic() + 61)
+
+
+def test_concurrency_halves_on_throttling_and_grows_back_slowly():
+    clock = FakeClock()
+    concurrency = ratelimit.AdaptiveConcurrency(8, clock=clock)
+
+    concurrency.on_throttle()
+    # The same burst of throttled calls only counts once
+    concurrency.on_throttle()
+    assert concurrency.limit == 4
+    clock.sleep(5)
+    concurrency.on_throttle()
+    assert concurrency.limit == 2
+
+    for _ in range(10):
+        concurrency.on_success()
+    assert 4 < concurrency.limit < 8
+
+
+def test_throttled_gmail_calls_are_retried_on_their_own():
+    ratelimit._limiters.clear()
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    wanted = gmail.add_messages(120, label_names=('Banks',))
+    gmail.inject_throttling('history.list', times=2, retry_after=3)
+    gmail.inject_throttling('batch', times=1, status=403, reason='userRateLimitExceeded')
+    gmail.inject_error(wanted[5], status=429, times=1)
+
+    forwarded = []
+    lock = threading.Lock()
+
+    def backend(email_data, deadline=None):
+        with lock:
+            forwarded.append(email_data['message_id'])
+
+    sleeps = []
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'off', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=backend), \
+         patch('ratelimit.time.sleep', side_effect=sleeps.append):
+        main.process_gmail_notification(make_cloud_event(gmail.history_id))
+        # Throttling shrank the calls allowed in flight
+        assert main.gmail_limiter().concurrency.limit < ratelimit.DEFAULT_GMAIL_MAX_CONCURRENCY
+
+    # Nothing failed the invocation, every email went out once
+    assert sorted(forwarded) == wanted
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert gmail.calls['throttled'] == 2 + 1
+    # Retry-After is honored, the others get a jittered backoff
+    assert sleeps[:2] == [3.0, 3.0]
+    assert len(sleeps) == 4 and all(0 <= delay <= 32 for delay in sleeps[2:])
+
+
+def test_a_retry_after_past_the_function_timeout_fails_the_event_at_once():
+    ratelimit._limiters.clear()
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    last_id = gmail.history_id
+    gmail.add_messages(3, label_names=('Banks',))
+    gmail.inject_throttling('history.list', times=1, retry_after=600)
+
+    sleeps = []
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'off', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('ratelimit.time.sleep', side_effect=sleeps.append):
+        with pytest.raises(Exception):
+            main.process_gmail_notification(make_cloud_event(gmail.history_id))
+
+    # No sleep into the timeout: Pub/Sub retries, and the lease is free for it
+    assert sleeps == []
+    assert db.data('state/gmail_sync')['last_id'] == last_id
+    assert db.data('state/gmail_sync_lease')['owner'] is None
+
+
+def test_throttled_backend_posts_are_retried_after_retry_after():
+    ratelimit._limiters.clear()
+    sleeps = []
+    with BackendStub(throttle=2, retry_after=1) as backend, \
+         patch('ratelimit.time.sleep', side_effect=sleeps.append):
+        response = delivery.post_json(backend.url, {'message_id': 'm1'})
+
+    assert response.status_code == 200
+    assert backend.throttled == 2
+    assert [email['message_id'] for email in backend.received] == ['m1']
+    assert sleeps == [1.0, 1.0]
+
+
+def test_backend_throttling_beyond_the_attempts_fails_the_email():
+    ratelimit._limiters.clear()
+    with BackendStub(throttle=10, retry_after=0) as backend, \
+         patch.dict(os.environ, {'BACKEND_MAX_ATTEMPTS': '2'}), \
+         pytest.raises(requests.HTTPError):
+        delivery.post_json(backend.url, {'message_id': 'm1'})
+
+    assert backend.throttled == 2
+    assert backend.received == []
@@ -0,0 +1,166 @@
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import make_cloud_event, reset_caches
+
+
+def test_only_one_holder_and_newest_history_id_is_kept():
+    db = FakeFirestore()
+    lease_ref = db.collection('state').document('gmail_sync_lease')
+
+    assert main.acquire_sync_lease(db.transaction(), lease_ref, 'a', 100) is True
+    assert main.acquire_sync_lease(db.transaction(), lease_ref, 'b', 130) is False
+    assert main.acquire_sync_lease(db.transaction(), lease_ref, 'c', 120) is False
+
+    # The holder synced to 100 and is told to continue up to 130
+    assert main.renew_or_release_sync_lease(db.transaction(), lease_ref, 'a', 100) == 130
+    assert main.renew_or_release_sync_lease(db.transaction(), lease_ref, 'a', 130) is None
+    assert db.data('state/gmail_sync_lease')['owner'] is None
+    assert main.acquire_sync_lease(db.transaction(), lease_ref, 'b', 140) is True
+
+
+def test_expired_lease_can_be_taken_over():
+    db = FakeFirestore()
+    lease_ref = db.collection('state').document('gmail_sync_lease')
+    db.seed('state/gmail_sync_lease', {'owner': 'dead', 'expires_at': 0, 'latest_history_id': 90})
+
+    assert main.acquire_sync_lease(db.transaction(), lease_ref, 'a', 80) is True
+    assert db.data('state/gmail_sync_lease')['latest_history_id'] == 90
+
+
+def test_burst_of_notifications_is_coalesced():
+    gmail = FakeGmail(labels=['Banks'], latency=0.002)
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+
+    forwarded = []
+    lock = threading.Lock()
+
+    def backend(email_data, deadline=None):
+        with lock:
+            forwarded.append(email_data['message_id'])
+
+    # Mail keeps arriving while notifications for it fire concurrently
+    expected = []
+    events = []
+    for _ in range(12):
+        expected += gmail.add_messages(25, label_names=('Banks',))
+        events.append(make_cloud_event(gmail.history_id))
+
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'off', 'HISTORY_PAGE_SIZE': '50',
+           'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=backend):
+        reset_caches()
+        threads = [threading.Thread(target=main.process_gmail_notification, args=(event,)) for event in events]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # Every message forwarded exactly once, even without the ledger
+    assert sorted(forwarded) == expected
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert db.data('state/gmail_sync_lease')['owner'] is None
+    # 12 uncoordinated syncs would each walk the 6 pages of history
+    assert gmail.calls['history.list'] < 12 * 6
+
+
+def test_sync_out_of_time_fails_the_event_and_the_retry_catches_up():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    lease_ref = db.collection('state').document('gmail_sync_lease')
+    expected = gmail.add_messages(5, label_names=('Banks',))
+    event = make_cloud_event(gmail.history_id)
+
+    forwarded = []
+    lock = threading.Lock()
+    late = []
+
+    def backend(email_data, deadline=None):
+        with lock:
+            forwarded.append(email_data['message_id'])
+            if not late:
+                # Mail arrives meanwhile, its notification is recorded for the lease holder and acknowledged
+                late.extend(gmail.add_messages(3, label_names=('Banks',)))
+                assert main.acquire_sync_lease(db.transaction(), lease_ref, 'other', gmail.history_id) is False
+
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'off', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=backend):
+        # Too little time left after the first round to catch up
+        with patch('main.invocation_deadline', side_effect=lambda: main.time.monotonic() + 5):
+            try:
+                main.process_gmail_notification(event)
+            except RuntimeError as e:
+                assert 'left' in str(e)
+            else:
+                raise AssertionError("a sync that left notifications behind should fail the event")
+        assert db.data('state/gmail_sync_lease')['owner'] is None
+        assert sorted(forwarded) == expected
+
+        # Pub/Sub redelivers the same event, which now syncs what was left
+        main.process_gmail_notification(event)
+
+    assert sorted(forwarded) == expected + late
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert db.data('state/gmail_sync_lease')['owner'] is None
+
+
+class IdentifiedCloudEvent:
+    """A CloudEvent with its id, like the ones Eventarc delivers (and redelivers)."""
+
+    def __init__(self, event_id, history_id):
+        self.attributes = {'id': event_id}
+        self.data = make_cloud_event(history_id).data
+
+    def __getitem__(self, key):
+        return self.attributes[key]
+
+
+def test_redelivery_takes_back_the_lease_of_its_killed_attempt():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+    expected = gmail.add_messages(3, label_names=('Banks',))
+    # The first attempt took the lease and was killed before releasing it
+    db.seed('state/gmail_sync_lease', {'owner': 'event-1', 'expires_at': main.time.time() + 90,
+                                       'latest_history_id': gmail.history_id})
+
+    forwarded = []
+
+    def backend(email_data, deadline=None):
+        forwarded.append(email_data['message_id'])
+
+    env = {'EMAIL_FETCHING_LABELS': 'Banks', 'DELIVERY_LEDGER': 'off', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=backend):
+        # Another event is still coalesced into the live lease
+        main.process_gmail_notification(IdentifiedCloudEvent('event-2', gmail.history_id))
+        assert forwarded == []
+        main.process_gmail_notification(IdentifiedCloudEvent('event-1', gmail.history_id))
+
+    assert sorted(forwarded) == expected
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+    assert db.data('state/gmail_sync_lease')['owner'] is None
@@ -0,0 +1,203 @@
+"""
+A local stand-in for the backend that receives forwarded emails.
+
+It answers on a random localhost port from its own threads, waits `latency`
+seconds before replying, and keeps every received email so tests and benchmarks
+can check what arrived.
+
+Besides one JSON email per request, it understands the bulk requests sent with
+BACKEND_BATCH_MODE (NDJSON or a JSON array, optionally gzip compressed) and
+acknowledges each email: {"results": [{"message_id": ..., "status": "ok"}]}.
+
+Large emails streamed raw (`Content-Type: message/rfc822`, usually with chunked
+transfer encoding) are read chunk by chunk and recorded as their
+X-Email-Metadata plus `raw_size` and `raw_sha256`, never held whole.
+
+    python test_utils/backend_stub.py --port 8000 --latency-ms 100
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BackendHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep the connection alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    # Don't let Nagle's algorithm add delay between the headers and the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _iter_body(self, chunk_size=64 * 1024):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # The blank line closing the (trailer-less) body
+                    self.rfile.readline()
+                    return
+                while size:
+                    data = self.rfile.read(min(size, chunk_size))
+                    size -= len(data)
+                    yield data
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            data = self.rfile.read(min(remaining, chunk_size))
+            remaining -= len(data)
+            yield data
+
+    def _receive_raw_email(self, backend):
+        digest = hashlib.sha256()
+        size = 0
+        for data in self._iter_body():
+            digest.update(data)
+            size += len(data)
+        backend.record_connection(self.client_address)
+        backend.record_request(size, size)
+        email_data = json.loads(self.headers.get('X-Email-Metadata') or '{}')
+        backend.record(dict(email_data, raw_size=size, raw_sha256=digest.hexdigest()))
+        self._reply(200, {'status': 'ok', 'message_id': email_data.get('message_id')})
+
+    def do_POST(self):
+        backend = self.server.backend
+        if self.headers.get('Content-Type', '').startswith('message/rfc822'):
+            self._receive_raw_email(backend)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length)
+        backend.record_connection(self.client_address)
+        if backend.latency:
+            time.sleep(backend.latency)
+
+        if backend.take_throttle():
+            self._reply(429, {'status': 'throttled'}, {'Retry-After': str(backend.retry_after)})
+            return
+
+        wire_size = len(raw)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        backend.record_request(wire_size, len(raw))
+
+        if self.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+            emails = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        else:
+            emails = json.loads(raw)
+            if isinstance(emails, dict):
+                backend.record(emails)
+                self._reply(200, {'status': 'ok', 'message_id': emails.get('message_id')})
+                return
+
+        results = []
+        for email_data in emails:
+            message_id = email_data.get('message_id')
+            if message_id in backend.reject_ids:
+                results.append({'message_id': message_id, 'status': 'error'})
+                continue
+            backend.record(email_data)
+            results.append({'message_id': message_id, 'status': 'ok'})
+        self._reply(200, {'results': results})
+
+
+class BackendStub:
+    """
+        Runs the stand-in backend in a background thread.
+
+        `received` keeps the emails in arrival order (`received_at` their
+        time.monotonic() arrival times), `connections` counts distinct
+        client sockets (a pooled client reuses a few, a naive one opens one per email).
+        `requests` counts requests, `bytes_on_wire` their body size as sent and
+        `bytes_received` the same bodies once decompressed.
+        Emails whose ID is in `reject_ids` get an "error" acknowledgement in bulk requests.
+        The first `throttle` requests are answered 429 with a `retry_after` Retry-After.
+    """
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, reject_ids=(), throttle=0, retry_after=1):
+        self.latency = latency
+        self.reject_ids = set(reject_ids)
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.throttled = 0
+        self.received = []
+        self.received_at = []
+        self.connections = set()
+        self.requests = 0
+        self.bytes_on_wire = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), BackendHandler)
+        self.server.daemon_threads = True
+        self.server.backend = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/emails"
+
+    def record(self, email_data):
+        with self._lock:
+            self.received.append(email_data)
+            self.received_at.append(time.monotonic())
+
+    def record_request(self, wire_size, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_on_wire += wire_size
+            self.bytes_received += size
+
+    def take_throttle(self):
+        with self._lock:
+            if self.throttled >= self.throttle:
+                return False
+            self.throttled += 1
+            return True
+
+    def record_connection(self, client_address):
+        with self._lock:
+            self.connections.add(client_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args()
+    backend = BackendStub(latency=args.latency_ms / 1000, port=args.port)
+    print(f"🛬 Stand-in backend listening on {backend.url} (latency {args.latency_ms} ms)")
+    try:
+        backend.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
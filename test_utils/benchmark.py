@@ -0,0 +1,209 @@
+"""
+Offline end-to-end benchmark of `process_gmail_notification`.
+
+Every scenario seeds a synthetic mailbox in the fake Gmail API (with
+`--gmail-latency-ms` per round trip, messages generated from sample_msg.json
+when it exists), a fake Firestore and the local stand-in backend, then delivers
+one notification for all of it. Each scenario runs in its own Python process, so
+the reported peak RSS is the scenario's own, and starts with one small untimed
+notification so the numbers are those of a warm instance.
+
+For every mailbox size it reports:
+    throughput   forwarded emails per second of invocation
+    invocation   p50 / p99 duration of the notification handler over --runs runs
+    delivery     p50 / p99 time from the notification to each email reaching the backend
+    peak RSS     maximum resident memory of the scenario process
+
+    python test_utils/benchmark.py --sizes 10 100 10000 --runs 3
+    python test_utils/benchmark.py --save baseline.json
+    python test_utils/benchmark.py --compare baseline.json --tolerance 0.2
+
+With --compare the exit status is 1 when a scenario's throughput dropped, or its
+p99 or peak RSS grew, by more than --tolerance compared to the baseline.
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..', 'cloud_function'))
+sys.path.append(current_dir)
+
+DEFAULT_SIZES = (10, 100, 10000)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def make_cloud_event(history_id):
+    pubsub_msg = {"emailAddress": "bench@example.com", "historyId": history_id}
+
+    class BenchCloudEvent:
+        data = {"message": {"data": base64.b64encode(json.dumps(pubsub_msg).encode('utf-8')).decode('utf-8')}}
+    return BenchCloudEvent()
+
+
+def run_scenario(size, runs, gmail_latency, backend_latency, env):
+    """Runs `runs` notifications of `size` new emails each, in this process."""
+    with patch('google.cloud.firestore.Client'):
+        import main
+    from backend_stub import BackendStub
+    from fake_firestore import FakeFirestore
+    from fake_gmail import FakeGmail
+
+    durations = []
+    delivery_latencies = []
+    forwarded = 0
+    gmail_calls = 0
+
+    # The first run pays for imports and connection setup, like a cold start
+    for run in range(runs + 1):
+        warm_up = run == 0
+        gmail = FakeGmail(labels=['Bench', 'Other'], latency=gmail_latency)
+        db = FakeFirestore()
+        db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+        count = min(size, 10) if warm_up else size
+        gmail.add_messages(count, label_names=('Bench',))
+        # Some noise the label filter has to skip
+        gmail.add_messages(max(1, count // 10), label_names=('Other',))
+
+        with BackendStub(latency=backend_latency) as backend:
+            # Gmail's quota would cap every size at 50 messages per second, --env
+            # GMAIL_QUOTA_UNITS_PER_SECOND=250 measures with it
+            run_env = {'EMAIL_FETCHING_LABELS': 'Bench', 'BACKEND_URL': backend.url, 'DELIVERY_LEDGER': 'memory',
+                       'FUNCTION_TIMEOUT_SECONDS': '3600', 'GMAIL_QUOTA_UNITS_PER_SECOND': '0', **env}
+            with patch.dict(os.environ, run_env), \
+                 patch('main._db', db), \
+                 patch('main.get_gmail_service', return_value=gmail), \
+                 contextlib.redirect_stdout(io.StringIO()):
+                main._label_caches.clear()
+                main.ledger._ledgers.clear()
+                start = time.monotonic()
+                main.process_gmail_notification(make_cloud_event(gmail.history_id))
+                elapsed = time.monotonic() - start
+            if len(backend.received) != count:
+                raise RuntimeError(f"Expected {count} emails at the backend, got {len(backend.received)}")
+            if warm_up:
+                continue
+            durations.append(elapsed)
+            delivery_latencies.extend(arrival - start for arrival in backend.received_at)
+            forwarded += len(backend.received)
+            gmail_calls += gmail.calls['http']
+
+    return {
+        'size': size,
+        'runs': runs,
+        'throughput': forwarded / sum(durations),
+        'invocation_p50_ms': percentile(durations, 0.5) * 1000,
+        'invocation_p99_ms': percentile(durations, 0.99) * 1000,
+        'delivery_p50_ms': percentile(delivery_latencies, 0.5) * 1000,
+        'delivery_p99_ms': percentile(delivery_latencies, 0.99) * 1000,
+        'gmail_round_trips': gmail_calls / runs,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_in_subprocess(size, args):
+    command = [
+        sys.executable, os.path.abspath(__file__), '--scenario', str(size),
+        '--runs', str(args.runs),
+        '--gmail-latency-ms', str(args.gmail_latency_ms),
+        '--backend-latency-ms', str(args.backend_latency_ms),
+    ]
+    for setting in args.env:
+        command += ['--env', setting]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Scenario {size} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def report(result):
+    print(f"{result['size']:>6} emails | {result['throughput']:8.1f} emails/s | "
+          f"invocation p50 {result['invocation_p50_ms']:9.1f} ms p99 {result['invocation_p99_ms']:9.1f} ms | "
+          f"delivery p50 {result['delivery_p50_ms']:9.1f} ms p99 {result['delivery_p99_ms']:9.1f} ms | "
+          f"{result['gmail_round_trips']:6.0f} Gmail round trips | peak RSS {result['peak_rss_mb']:7.1f} MB")
+
+
+def regressions(results, baseline, tolerance):
+    """Human readable list of what got worse than `baseline` by more than `tolerance`."""
+    previous = {entry['size']: entry for entry in baseline}
+    found = []
+    for result in results:
+        before = previous.get(result['size'])
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            found.append(f"{result['size']} emails: throughput {before['throughput']:.1f} -> {result['throughput']:.1f} emails/s")
+        for key in ('invocation_p99_ms', 'delivery_p99_ms', 'peak_rss_mb'):
+            if result[key] > before[key] * (1 + tolerance):
+                found.append(f"{result['size']} emails: {key} {before[key]:.1f} -> {result[key]:.1f}")
+    return found
+
+
+def parse_env(settings):
+    env = {}
+    for setting in settings:
+        name, _, value = setting.partition('=')
+        env[name] = value
+    return env
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--gmail-latency-ms', type=float, default=20)
+    parser.add_argument('--backend-latency-ms', type=float, default=5)
+    parser.add_argument('--env', action='append', default=[],
+                        help="NAME=value set for the function, e.g. --env BACKEND_BATCH_MODE=ndjson")
+    parser.add_argument('--save', help="Write the results as JSON, to compare later runs against")
+    parser.add_argument('--compare', help="Baseline JSON written by --save")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--scenario', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        result = run_scenario(args.scenario, args.runs, args.gmail_latency_ms / 1000,
+                              args.backend_latency_ms / 1000, parse_env(args.env))
+        print(json.dumps(result))
+        sys.exit(0)
+
+    print(f"📊 Gmail latency {args.gmail_latency_ms} ms, backend latency {args.backend_latency_ms} ms, "
+          f"{args.runs} runs per size {' '.join(args.env)}")
+    results = []
+    for size in args.sizes:
+        result = run_in_subprocess(size, args)
+        report(result)
+        results.append(result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"❌ Regression: {line}")
+        if found:
+            sys.exit(1)
+        print("✅ No regression")
@@ -0,0 +1,76 @@
+"""
+Measures backend delivery throughput against the local stand-in backend.
+
+"serial" is what `forward_to_backend()` used to do: one fresh `requests.post`
+per email, one after another. "pooled" goes through `delivery.BackendDelivery`,
+the keep-alive session and bounded thread pool the cloud function uses now.
+
+    python test_utils/benchmark_delivery.py --emails 200 --latency-ms 50 --concurrency 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..', 'cloud_function'))
+sys.path.append(current_dir)
+
+import requests
+
+import delivery
+from backend_stub import BackendStub
+
+
+def make_emails(count):
+    return [
+        {"message_id": f"msg_{i}", "subject": "Benchmark", "from": "bench@example.com",
+         "date": "2024-01-01 00:00:00", "body": {"text": "x" * 2048}}
+        for i in range(count)
+    ]
+
+
+def run_serial(url, emails):
+    for email_data in emails:
+        response = requests.post(url, json=email_data, timeout=10)
+        response.raise_for_status()
+
+
+def run_pooled(url, emails):
+    def send(email_data, deadline):
+        delivery.post_json(url, email_data, deadline).raise_for_status()
+
+    deliveries = delivery.BackendDelivery(send, deadline=time.monotonic() + 600)
+    for email_data in emails:
+        deliveries.submit(email_data)
+    failed = deliveries.wait()
+    if failed:
+        raise RuntimeError(f"{len(failed)} deliveries failed")
+
+
+def measure(name, fn, latency, emails):
+    with BackendStub(latency=latency) as backend:
+        start = time.perf_counter()
+        fn(backend.url, emails)
+        elapsed = time.perf_counter() - start
+        assert len(backend.received) == len(emails)
+        connections = len(backend.connections)
+    print(f"{name:<7} {elapsed:7.2f} s | {len(emails) / elapsed:8.1f} emails/s | {connections} connections")
+
+
+def run(count, latency_ms, concurrency):
+    os.environ['BACKEND_MAX_CONCURRENCY'] = str(concurrency)
+    emails = make_emails(count)
+    print(f"📊 {count} emails, backend latency {latency_ms} ms, concurrency {concurrency}")
+    measure('serial', run_serial, latency_ms / 1000, emails)
+    measure('pooled', run_pooled, latency_ms / 1000, emails)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--concurrency', type=int, default=delivery.DEFAULT_BACKEND_MAX_CONCURRENCY)
+    args = parser.parse_args()
+    run(args.emails, args.latency_ms, args.concurrency)
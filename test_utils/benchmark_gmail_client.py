@@ -0,0 +1,100 @@
+"""
+Measures the per-event overhead of getting an authorized Gmail client.
+
+"before" rebuilds the credentials, refreshes the token and builds the client on
+every event (what `get_gmail_service()` used to do). "after" is the cached
+client in `cloud_function/main.py`.
+
+The token endpoint is simulated so this runs offline, use --token-latency-ms to
+match what you see in production (a refresh is usually 100-300 ms from Cloud Run).
+
+    python test_utils/benchmark_gmail_client.py --events 200 --token-latency-ms 150
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..', 'cloud_function'))
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+import main
+
+# build() logs a line per call about oauth2client, which drowns the report
+logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+
+
+def fake_refresh_factory(latency_s):
+    """Stands in for the oauth2.googleapis.com round trip."""
+    def fake_refresh(self, request):
+        time.sleep(latency_s)
+        self.token = 'mock_access_token'
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+    return fake_refresh
+
+
+def legacy_get_gmail_service():
+    """The uncached implementation, kept here for comparison."""
+    creds = Credentials(
+        token=None,
+        refresh_token=os.environ.get('GMAIL_REFRESH_TOKEN'),
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=os.environ.get('GMAIL_CLIENT_ID'),
+        client_secret=os.environ.get('GMAIL_CLIENT_SECRET'),
+    )
+    if not creds.valid:
+        creds.refresh(Request())
+    return build('gmail', 'v1', credentials=creds)
+
+
+def time_calls(fn, events):
+    samples = []
+    for _ in range(events):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<8} mean {statistics.mean(samples):8.2f} ms | "
+          f"p50 {statistics.median(samples):8.2f} ms | p99 {p99:8.2f} ms | "
+          f"total {sum(samples):9.1f} ms")
+
+
+def run(events, token_latency_ms):
+    os.environ.setdefault('GMAIL_REFRESH_TOKEN', 'mock_refresh_token')
+    os.environ.setdefault('GMAIL_CLIENT_ID', 'mock_client_id')
+    os.environ.setdefault('GMAIL_CLIENT_SECRET', 'mock_client_secret')
+
+    fake_refresh = fake_refresh_factory(token_latency_ms / 1000)
+    with patch.object(Credentials, 'refresh', fake_refresh):
+        before = time_calls(legacy_get_gmail_service, events)
+
+        main._gmail_clients.clear()
+        # The first call of a cold instance still pays for the refresh
+        after = time_calls(main.get_gmail_service, events)
+
+    print(f"📊 {events} events, simulated token refresh {token_latency_ms} ms")
+    report('before', before)
+    report('after', after)
+    print(f"cold call after cache: {after[0]:.2f} ms, warm mean: {statistics.mean(after[1:] or after):.4f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=100)
+    parser.add_argument('--token-latency-ms', type=float, default=150)
+    args = parser.parse_args()
+    run(args.events, args.token_latency_ms)
@@ -0,0 +1,254 @@
+"""
+In-process stand-in for the `google.cloud.firestore.Client` the cloud function uses.
+
+Documents live in a dict keyed by path. Transactions are optimistic like the real
+ones: reads remember the version of each document, writes are buffered, and the
+commit raises `Aborted` when somebody else changed a document that was read, so
+`@firestore.transactional` retries the function exactly as it does in production.
+
+`reads` and `writes` count document operations, `writes_by_path` shows which
+documents are hot.
+"""
+
+import copy
+import itertools
+import threading
+from collections import Counter
+
+from google.api_core.exceptions import Aborted, NotFound
+
+
+def _merge(target, changes):
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        value = self._data
+        for part in field.split('.'):
+            value = value[part]
+        return copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction=None, field_paths=None):
+        return self._db._read(self, transaction)
+
+    def set(self, data, merge=False):
+        self._db._apply([('set', self.path, data, merge)])
+
+    def update(self, data):
+        self._db._apply([('update', self.path, data, False)])
+
+    def delete(self):
+        self._db._apply([('delete', self.path, None, False)])
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class FakeQuery:
+    """Supports the where/order_by/limit chains used on queue-like collections."""
+
+    _OPERATORS = {
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        'in': lambda a, b: a in b,
+    }
+
+    def __init__(self, collection, filters=(), order=None, limit_to=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._order = order
+        self._limit = limit_to
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return FakeQuery(self._collection, self._filters + [(field_path, op_string, value)], self._order, self._limit)
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return FakeQuery(self._collection, self._filters, (field_path, direction), self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._filters, self._order, count)
+
+    def stream(self, transaction=None):
+        snapshots = []
+        for snapshot in self._collection._all_snapshots():
+            data = snapshot._data
+            if all(field in data and self._OPERATORS[op](data[field], value) for field, op, value in self._filters):
+                snapshots.append(snapshot)
+        if self._order:
+            field, direction = self._order
+            snapshots.sort(key=lambda snap: snap._data.get(field), reverse=direction == 'DESCENDING')
+        if self._limit is not None:
+            snapshots = snapshots[:self._limit]
+        return iter(snapshots)
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(self)
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        document_id = document_id or f"auto{next(self._db._auto_ids):012d}"
+        return FakeDocumentReference(self._db, f"{self.path}/{document_id}")
+
+    def _all_snapshots(self):
+        prefix = self.path + '/'
+        with self._db._lock:
+            paths = [path for path in self._db.documents if path.startswith(prefix) and '/' not in path[len(prefix):]]
+        return [self._db._read(FakeDocumentReference(self._db, path), None) for path in sorted(paths)]
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(('set', reference.path, data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(('update', reference.path, data, False))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference.path, None, False))
+
+    def commit(self):
+        self._db.batch_commits += 1
+        self._db._apply(self._writes)
+        self._writes = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Implements the private hooks `@firestore.transactional` drives."""
+
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+        self._read_versions = {}
+
+    def _clean_up(self):
+        self._writes = []
+        self._read_versions = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = next(self._db._auto_ids)
+
+    def _commit(self):
+        self._db._commit_transaction(self._read_versions, self._writes)
+        self._clean_up()
+        return []
+
+    def _rollback(self):
+        self._clean_up()
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.documents = {}
+        self.versions = Counter()
+        self.reads = 0
+        self.writes = 0
+        self.batch_commits = 0
+        self.aborted_transactions = 0
+        self.writes_by_path = Counter()
+        self._lock = threading.RLock()
+        self._auto_ids = itertools.count(1)
+
+    # 🔌 Client surface
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def get_all(self, references, transaction=None):
+        return [self._read(reference, transaction) for reference in references]
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    # 🗂️ Storage
+
+    def _read(self, reference, transaction):
+        with self._lock:
+            self.reads += 1
+            data = self.documents.get(reference.path)
+            if transaction is not None:
+                transaction._read_versions.setdefault(reference.path, self.versions[reference.path])
+            return FakeSnapshot(reference, copy.deepcopy(data))
+
+    def _apply(self, writes):
+        with self._lock:
+            for kind, path, data, merge in writes:
+                self.writes += 1
+                self.writes_by_path[path] += 1
+                self.versions[path] += 1
+                if kind == 'delete':
+                    self.documents.pop(path, None)
+                elif kind == 'update':
+                    if path not in self.documents:
+                        raise NotFound(f"No document to update: {path}")
+                    _merge(self.documents[path], data)
+                elif merge and path in self.documents:
+                    _merge(self.documents[path], data)
+                else:
+                    self.documents[path] = copy.deepcopy(data)
+
+    def _commit_transaction(self, read_versions, writes):
+        with self._lock:
+            for path, version in read_versions.items():
+                if self.versions[path] != version:
+                    self.aborted_transactions += 1
+                    raise Aborted(f"{path} changed during the transaction")
+            self._apply(writes)
+
+    # 🧪 Helpers for tests
+
+    def seed(self, path, data):
+        self.documents[path] = copy.deepcopy(data)
+
+    def data(self, path):
+        return copy.deepcopy(self.documents.get(path))
@@ -0,0 +1,407 @@
+"""
+In-process stand-in for the Gmail API client returned by `build('gmail', 'v1')`.
+
+It keeps a synthetic mailbox in memory and answers the same call chains the cloud
+function uses (`service.users().history().list(...).execute()` and friends), so the
+sync logic can be exercised offline with thousands of messages.
+
+Messages are generated from `test_utils/sample_msg.json` when you have fetched one
+with `get_email_sample.py`, otherwise from a small built-in template.
+"""
+
+import base64
+import copy
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_MSG_PATH = os.path.join(current_dir, 'sample_msg.json')
+
+# Gmail caps history.list pages at 500 records and batches at 100 calls
+MAX_HISTORY_PAGE_SIZE = 500
+DEFAULT_HISTORY_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 100
+MAX_MESSAGES_PAGE_SIZE = 500
+DEFAULT_MESSAGES_PAGE_SIZE = 100
+
+
+def make_http_error(status, reason=None, retry_after=None):
+    """Builds the HttpError googleapiclient raises for a failed call."""
+    headers = {'status': status}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    resp = httplib2.Response(headers)
+    resp.reason = reason or 'error'
+    errors = [{'reason': reason, 'message': reason}] if reason else []
+    content = json.dumps({'error': {'code': status, 'message': reason or 'error', 'errors': errors}})
+    return HttpError(resp, content.encode('utf-8'))
+
+
+def _b64url(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def default_message_template():
+    """A small multipart/alternative email, shaped like a `format='full'` response."""
+    return {
+        "id": "template",
+        "threadId": "template",
+        "labelIds": ["INBOX"],
+        "snippet": "Synthetic message",
+        "internalDate": "1700000000000",
+        "sizeEstimate": 2048,
+        "payload": {
+            "mimeType": "multipart/alternative",
+            "headers": [
+                {"name": "From", "value": "Sender <sender@example.com>"},
+                {"name": "To", "value": "user@example.com"},
+                {"name": "Subject", "value": "Synthetic message"},
+            ],
+            "body": {"size": 0},
+            "parts": [
+                {
+                    "partId": "0",
+                    "mimeType": "text/plain",
+                    "headers": [{"name": "Content-Type", "value": "text/plain; charset=UTF-8"}],
+                    "body": {"size": 17, "data": _b64url("Hello from a test")},
+                },
+                {
+                    "partId": "1",
+                    "mimeType": "text/html",
+                    "headers": [{"name": "Content-Type", "value": "text/html; charset=UTF-8"}],
+                    "body": {"size": 28, "data": _b64url("<p>Hello from a <b>test</b></p>")},
+                },
+            ],
+        },
+    }
+
+
+def load_message_template():
+    if os.path.exists(SAMPLE_MSG_PATH):
+        with open(SAMPLE_MSG_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return default_message_template()
+
+
+class FakeRequest:
+    """Mimics googleapiclient's HttpRequest: nothing happens until execute()."""
+
+    def __init__(self, gmail, method, handler, kwargs):
+        self.gmail = gmail
+        self.method = method
+        self.handler = handler
+        self.kwargs = kwargs
+
+    def execute(self, http=None, num_retries=0):
+        self.gmail.round_trip()
+        return self.run()
+
+    def run(self):
+        self.gmail.calls[self.method] += 1
+        self.gmail.call_log.append((self.method, dict(self.kwargs)))
+        self.gmail.raise_injected_error(self.method, self.kwargs)
+        return self.handler(**self.kwargs)
+
+
+class FakeBatch:
+    """Mimics BatchHttpRequest: all added calls cost a single round trip."""
+
+    def __init__(self, gmail, callback=None):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self.requests) >= MAX_BATCH_SIZE:
+            raise ValueError(f"Batches are limited to {MAX_BATCH_SIZE} calls")
+        request_id = request_id or str(len(self.requests) + 1)
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+        self.gmail.calls['batch'] += 1
+        self.gmail.round_trip()
+        self.gmail.raise_injected_error('batch', {})
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.run(), None
+            except HttpError as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class _Resource:
+    """Turns `resource.method(**kwargs)` into a FakeRequest."""
+
+    def __init__(self, gmail, prefix, handlers):
+        self._gmail = gmail
+        self._prefix = prefix
+        self._handlers = handlers
+
+    def __getattr__(self, name):
+        handler = self._handlers.get(name)
+        if handler is None:
+            raise AttributeError(f"FakeGmail has no {self._prefix}.{name}")
+        if isinstance(handler, _Resource):
+            return lambda: handler
+
+        def build_request(**kwargs):
+            return FakeRequest(self._gmail, f"{self._prefix}.{name}", handler, kwargs)
+        return build_request
+
+
+class FakeGmail:
+    """
+        A synthetic mailbox with the Gmail API surface the cloud function uses.
+
+        Every change goes through `add_message()` which appends a history record,
+        so history IDs grow the same way they do in Gmail. `calls` counts executed
+        requests by method name ('history.list', 'messages.get', ...).
+
+        `latency` (seconds) is slept once per HTTP round trip, a batch counts as one.
+        `inject_error()` makes the next calls for a message fail, `inject_throttling()`
+        the next calls of a method (or whole batches).
+        Message dates (internalDate) are `start_time` plus their history ID in seconds.
+        `expire_history()` makes history.list answer 404 for older start IDs, as
+        Gmail does once it dropped them. `add_attachment()` gives a message a file
+        that messages.attachments.get serves. `add_large_message()` adds one whose
+        raw form is generated on the fly by `iter_raw_response()`, so a test can
+        stream a huge email without the fake holding it.
+    """
+
+    def __init__(self, labels=None, start_history_id=1000, template=None, latency=0.0, start_time=1700000000):
+        self.labels = {'INBOX': 'INBOX'}
+        for name in labels or []:
+            self.labels[name] = f"Label_{len(self.labels)}"
+        self.messages = {}
+        self.attachments = {}
+        self.raw_sizes = {}
+        self.watches = []
+        self.history = []
+        self.history_id = start_history_id
+        self.template = template or load_message_template()
+        self.latency = latency
+        self.start_time = start_time
+        self.oldest_history_id = None
+        self.calls = Counter()
+        self.call_log = []
+        self.injected_errors = defaultdict(list)
+        self.throttles = defaultdict(list)
+
+        self._users = _Resource(self, 'users', {
+            'getProfile': self._get_profile,
+            'watch': self._watch,
+            'history': _Resource(self, 'history', {'list': self._history_list}),
+            'messages': _Resource(self, 'messages', {
+                'get': self._messages_get,
+                'list': self._messages_list,
+                'attachments': _Resource(self, 'messages.attachments', {'get': self._attachments_get}),
+            }),
+            'labels': _Resource(self, 'labels', {'list': self._labels_list}),
+        })
+
+    # 📬 Building the mailbox
+
+    def label_id(self, name):
+        return self.labels[name]
+
+    def add_message(self, label_names=('INBOX',), subject=None, sender=None):
+        """Adds a message and its messageAdded history record, returns the message ID."""
+        self.history_id += 1
+        msg_id = f"{self.history_id:016x}"
+        msg = copy.deepcopy(self.template)
+        msg['id'] = msg_id
+        msg['threadId'] = msg_id
+        msg['historyId'] = str(self.history_id)
+        msg['labelIds'] = [self.labels[name] for name in label_names]
+        msg['internalDate'] = str((self.start_time + self.history_id) * 1000)
+        headers = msg.setdefault('payload', {}).setdefault('headers', [])
+        for header in headers:
+            if header['name'] == 'Subject' and subject is not None:
+                header['value'] = subject
+            if header['name'] == 'From' and sender is not None:
+                header['value'] = sender
+        self.messages[msg_id] = msg
+        self.history.append({
+            'id': str(self.history_id),
+            'messages': [{'id': msg_id, 'threadId': msg_id}],
+            'messagesAdded': [{'message': {'id': msg_id, 'threadId': msg_id, 'labelIds': list(msg['labelIds'])}}],
+        })
+        return msg_id
+
+    def add_messages(self, count, label_names=('INBOX',)):
+        return [self.add_message(label_names) for _ in range(count)]
+
+    def add_attachment(self, msg_id, filename, content, mime_type='application/pdf'):
+        """Attaches `content` (bytes) to a message, served by attachmentId like Gmail does."""
+        msg = self.messages[msg_id]
+        parts = msg['payload'].setdefault('parts', [])
+        attachment_id = f"att-{msg_id}-{len(parts)}"
+        self.attachments[attachment_id] = base64.urlsafe_b64encode(content).decode('ascii')
+        parts.append({
+            "partId": str(len(parts)),
+            "mimeType": mime_type,
+            "filename": filename,
+            "headers": [{"name": "Content-Type", "value": mime_type}],
+            "body": {"size": len(content), "attachmentId": attachment_id},
+        })
+        return attachment_id
+
+    def add_large_message(self, size, label_names=('INBOX',), subject=None):
+        """A message of about `size` bytes, only served raw (see iter_raw_bytes)."""
+        msg_id = self.add_message(label_names, subject=subject)
+        self.messages[msg_id]['sizeEstimate'] = size
+        self.raw_sizes[msg_id] = size
+        return msg_id
+
+    def iter_raw_bytes(self, msg_id, chunk_size=48 * 1024):
+        """The RFC 822 bytes of a large message, `chunk_size` at a time."""
+        msg = self.messages[msg_id]
+        headers = ''.join(f"{h['name']}: {h['value']}\r\n" for h in msg['payload'].get('headers', []))
+        yield (headers + 'Content-Type: text/plain\r\n\r\n').encode('utf-8')
+        line = f"{msg_id} lorem ipsum dolor sit amet\r\n".encode('ascii')
+        remaining = self.raw_sizes[msg_id]
+        chunk = line * (chunk_size // len(line))
+        while remaining > 0:
+            yield chunk[:remaining]
+            remaining -= len(chunk)
+
+    def iter_raw_response(self, msg_id, chunk_size=48 * 1024):
+        """What messages.get(format='raw', fields='raw') sends on the wire for a large message, in chunks."""
+        self.calls['messages.get_raw'] += 1
+        yield b'{\n  "raw": "'
+        carry = b''
+        for data in self.iter_raw_bytes(msg_id, chunk_size):
+            # Whole groups of 3 bytes, so there is no padding before the end
+            data = carry + data
+            usable = len(data) - len(data) % 3
+            carry = data[usable:]
+            yield base64.urlsafe_b64encode(data[:usable])
+        yield base64.urlsafe_b64encode(carry) + b'"\n}\n'
+
+    def add_label_change(self, msg_id):
+        """A history record that mentions an existing message again (e.g. a label was added)."""
+        self.history_id += 1
+        msg = self.messages[msg_id]
+        self.history.append({
+            'id': str(self.history_id),
+            'messages': [{'id': msg_id, 'threadId': msg_id}],
+            'messagesAdded': [{'message': {'id': msg_id, 'threadId': msg_id, 'labelIds': list(msg['labelIds'])}}],
+        })
+
+    def expire_history(self):
+        """Drops the history recorded so far, like Gmail does after about a week."""
+        self.oldest_history_id = self.history_id
+
+    def inject_error(self, msg_id, status=429, reason='rateLimitExceeded', times=1):
+        """The next `times` messages.get calls for `msg_id` fail with this error."""
+        self.injected_errors[msg_id].extend([(status, reason)] * times)
+
+    def inject_throttling(self, method, times=1, status=429, reason='rateLimitExceeded', retry_after=None):
+        """The next `times` calls of `method` ('history.list', 'messages.get', 'batch'...) are throttled."""
+        self.throttles[method].extend([(status, reason, retry_after)] * times)
+
+    def raise_injected_error(self, method, kwargs):
+        throttles = self.throttles.get(method)
+        if throttles:
+            status, reason, retry_after = throttles.pop(0)
+            self.calls['throttled'] += 1
+            raise make_http_error(status, reason, retry_after)
+        errors = self.injected_errors.get(kwargs.get('id'))
+        if method == 'messages.get' and errors:
+            status, reason = errors.pop(0)
+            raise make_http_error(status, reason)
+
+    def round_trip(self):
+        self.calls['http'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # 🔌 Client surface
+
+    def users(self):
+        return self._users
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    # 🗂️ Handlers
+
+    def _history_list(self, userId, startHistoryId, historyTypes=None, labelId=None,
+                      maxResults=None, pageToken=None, fields=None):
+        start = int(startHistoryId)
+        if self.oldest_history_id is not None and start < self.oldest_history_id:
+            raise make_http_error(404, 'notFound')
+        page_size = min(int(maxResults or DEFAULT_HISTORY_PAGE_SIZE), MAX_HISTORY_PAGE_SIZE)
+        records = [r for r in self.history if int(r['id']) > start]
+        if labelId is not None:
+            records = [
+                r for r in records
+                if any(labelId in item['message'].get('labelIds', []) for item in r['messagesAdded'])
+            ]
+        offset = int(pageToken or 0)
+        page = records[offset:offset + page_size]
+        response = {'history': copy.deepcopy(page), 'historyId': str(self.history_id)}
+        if offset + page_size < len(records):
+            response['nextPageToken'] = str(offset + page_size)
+        return response
+
+    def _messages_get(self, userId, id, format='full', metadataHeaders=None, fields=None):
+        if id not in self.messages:
+            raise make_http_error(404, 'notFound')
+        msg = self.messages[id]
+        if format == 'metadata':
+            # Only the requested headers, no body parts
+            wanted = {name.lower() for name in metadataHeaders or []}
+            headers = [h for h in msg['payload'].get('headers', []) if not wanted or h['name'].lower() in wanted]
+            result = {key: copy.deepcopy(value) for key, value in msg.items() if key != 'payload'}
+            result['payload'] = {'mimeType': msg['payload'].get('mimeType'), 'headers': copy.deepcopy(headers)}
+            return result
+        return copy.deepcopy(msg)
+
+    def _attachments_get(self, userId, messageId, id):
+        if id not in self.attachments or not id.startswith(f"att-{messageId}-"):
+            raise make_http_error(404, 'notFound')
+        data = self.attachments[id]
+        return {'size': len(base64.urlsafe_b64decode(data)), 'data': data}
+
+    def _messages_list(self, userId, q=None, labelIds=None, maxResults=None, pageToken=None, fields=None):
+        # Only the `after:<epoch>` and `before:<epoch>` search terms are understood
+        terms = dict(term.split(':', 1) for term in (q or '').split())
+        after = int(terms.get('after', 0))
+        before = int(terms['before']) if 'before' in terms else None
+        page_size = min(int(maxResults or DEFAULT_MESSAGES_PAGE_SIZE), MAX_MESSAGES_PAGE_SIZE)
+        matches = [
+            msg for msg in self.messages.values()
+            if int(msg['internalDate']) // 1000 >= after
+            and (before is None or int(msg['internalDate']) // 1000 < before)
+            and all(label_id in msg['labelIds'] for label_id in labelIds or [])
+        ]
+        # Newest first, like Gmail
+        matches.sort(key=lambda msg: int(msg['internalDate']), reverse=True)
+        offset = int(pageToken or 0)
+        page = matches[offset:offset + page_size]
+        response = {
+            'messages': [{'id': msg['id'], 'threadId': msg['threadId']} for msg in page],
+            'resultSizeEstimate': len(matches),
+        }
+        if offset + page_size < len(matches):
+            response['nextPageToken'] = str(offset + page_size)
+        return response
+
+    def _get_profile(self, userId):
+        return {'emailAddress': 'user@example.com', 'messagesTotal': len(self.messages), 'historyId': str(self.history_id)}
+
+    def _watch(self, userId, body):
+        self.watches.append(copy.deepcopy(body))
+        # Gmail watches last 7 days
+        expiration = int((time.time() + 7 * 24 * 60 * 60) * 1000)
+        return {'historyId': str(self.history_id), 'expiration': str(expiration)}
+
+    def _labels_list(self, userId):
+        return {'labels': [{'id': label_id, 'name': name} for name, label_id in self.labels.items()]}
@@ -0,0 +1,78 @@
+"""
+In-process stand-in for Pub/Sub, to run the fan-out pipeline end to end offline.
+
+`FakePublisher` has the `publish(topic, data)` surface of
+`pubsub_v1.PublisherClient` and keeps a queue per topic. `deliver()` plays the
+subscription: it pushes every queued message to an entry point as a CloudEvent,
+from several threads like separate function instances, and redelivers the
+messages whose handler raised, as Pub/Sub does with RETRY_POLICY_RETRY.
+"""
+
+import base64
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class FakeCloudEvent:
+    def __init__(self, data, message_id):
+        self.data = {"message": {"data": base64.b64encode(data).decode('utf-8'), "messageId": message_id}}
+
+
+class FakePublisher:
+    def __init__(self, fail_publishes=0):
+        self.queues = defaultdict(deque)
+        self.published = 0
+        self.deliveries = 0
+        self.redeliveries = 0
+        # The next `fail_publishes` publish() calls fail, to exercise the sync stage errors
+        self.fail_publishes = fail_publishes
+        self._lock = threading.Lock()
+
+    def publish(self, topic, data, **attributes):
+        future = Future()
+        with self._lock:
+            if self.fail_publishes:
+                self.fail_publishes -= 1
+                future.set_exception(ConnectionError("publish failed"))
+                return future
+            self.published += 1
+            message_id = str(self.published)
+            self.queues[topic].append((data, message_id))
+        future.set_result(message_id)
+        return future
+
+    def pending(self, topic):
+        return len(self.queues[topic])
+
+    def deliver(self, topic, handler, instances=4, max_attempts=5):
+        """
+            Runs `handler(cloud_event)` for every message of `topic` until the queue
+            is empty. Returns the messages still failing after `max_attempts`.
+        """
+        attempts = defaultdict(int)
+        dead = []
+        queue = self.queues[topic]
+
+        def run(data, message_id):
+            with self._lock:
+                attempts[message_id] += 1
+                self.deliveries += 1
+            try:
+                handler(FakeCloudEvent(data, message_id))
+            except Exception:
+                with self._lock:
+                    if attempts[message_id] >= max_attempts:
+                        dead.append((data, message_id))
+                    else:
+                        self.redeliveries += 1
+                        queue.append((data, message_id))
+
+        with ThreadPoolExecutor(max_workers=instances) as pool:
+            while queue:
+                batch = []
+                while queue:
+                    batch.append(queue.popleft())
+                for future in [pool.submit(run, data, message_id) for data, message_id in batch]:
+                    future.result()
+        return dead
@@ -0,0 +1,69 @@
+"""
+Runs the function offline for the tests: the Pub/Sub CloudEvent of a Gmail
+notification, a stand-in for forward_to_backend that records what it got, one
+notification against the fake Gmail and Firestore, and the reset of what the
+instance caches between invocations.
+
+The tests import it once cloud_function/ is on sys.path.
+"""
+
+import base64
+import json
+import os
+import threading
+from unittest.mock import patch
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+import attachments
+import ledger
+import spool
+
+
+def make_cloud_event(history_id, email_address='user@example.com'):
+    pubsub_msg = {"emailAddress": email_address, "historyId": history_id}
+
+    class MockCloudEvent:
+        data = {"message": {"data": base64.b64encode(json.dumps(pubsub_msg).encode('utf-8')).decode('utf-8')}}
+    return MockCloudEvent()
+
+
+def recording_backend(fail_ids=()):
+    """
+        A forward_to_backend stand-in and the {message_id: email} it took, in
+        arrival order. The emails in `fail_ids` fail their first attempt, and an
+        email sent twice fails the test.
+    """
+    forwarded = {}
+    lock = threading.Lock()
+    fail_ids = set(fail_ids)
+
+    def backend(email_data, deadline=None):
+        message_id = email_data['message_id']
+        with lock:
+            if message_id in fail_ids:
+                fail_ids.discard(message_id)
+                raise RuntimeError("backend unavailable")
+            assert message_id not in forwarded, f"{message_id} was forwarded twice"
+            forwarded[message_id] = email_data
+    return backend, forwarded
+
+
+def run_notification(gmail, db, backend, env):
+    """process_gmail_notification for the latest historyId of `gmail`, with `env` set."""
+    with patch.dict(os.environ, env), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail), \
+         patch('main.new_gmail_service', return_value=gmail), \
+         patch('main.forward_to_backend', side_effect=backend):
+        main.process_gmail_notification(make_cloud_event(gmail.history_id))
+
+
+def reset_caches():
+    """Forgets the labels, rules, ledgers, spools and attachment indexes an earlier test left in the instance."""
+    main._label_caches.clear()
+    main._rules_caches.clear()
+    ledger._ledgers.clear()
+    spool._spools.clear()
+    attachments._indexes.clear()
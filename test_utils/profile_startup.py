@@ -0,0 +1,148 @@
+"""
+Measures what a cold instance pays before and during its first notification.
+
+Every run starts a fresh Python process and times, in the order a new instance
+goes through them:
+    import main           importing the function module (what runs before the first request)
+    firestore import      the Firestore library, imported by get_db() on first use
+    early exit event      first notification whose historyId was already processed
+    gmail client          Gmail API imports and the static discovery build (token refresh stubbed)
+    first sync event      first notification that forwards `--emails` new emails
+and reports the median over --runs runs, plus the process peak RSS.
+
+The events use the fake Gmail API, the fake Firestore and the local stand-in
+backend, so only the Python side of the cold start is measured. With --importtime
+the slowest imports of `import main` (python -X importtime) are listed as well.
+
+    python test_utils/profile_startup.py --runs 5
+    python test_utils/profile_startup.py --importtime 15
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+FUNCTION_DIR = os.path.join(current_dir, '..', 'cloud_function')
+
+STAGES = ('import main', 'firestore import', 'early exit event', 'gmail client', 'first sync event')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def make_cloud_event(history_id):
+    pubsub_msg = {"emailAddress": "startup@example.com", "historyId": history_id}
+
+    class StartupCloudEvent:
+        data = {"message": {"data": base64.b64encode(json.dumps(pubsub_msg).encode('utf-8')).decode('utf-8')}}
+    return StartupCloudEvent()
+
+
+def measure(emails):
+    """Runs the stages once in this (fresh) process, returns {stage: ms}."""
+    timings = {}
+
+    def timed(stage, fn):
+        start = time.perf_counter()
+        result = fn()
+        timings[stage] = (time.perf_counter() - start) * 1000
+        return result
+
+    sys.path.append(FUNCTION_DIR)
+    main = timed('import main', lambda: __import__('main'))
+    timed('firestore import', lambda: __import__('google.cloud.firestore'))
+
+    sys.path.append(current_dir)
+    from backend_stub import BackendStub
+    from fake_firestore import FakeFirestore
+    from fake_gmail import FakeGmail
+
+    gmail = FakeGmail(labels=['Startup'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id})
+
+    with BackendStub() as backend:
+        env = {'EMAIL_FETCHING_LABELS': 'Startup', 'BACKEND_URL': backend.url, 'DELIVERY_LEDGER': 'memory',
+               'GMAIL_REFRESH_TOKEN': 'startup-token', 'GMAIL_CLIENT_ID': 'id', 'GMAIL_CLIENT_SECRET': 'secret'}
+
+        def fake_refresh(creds, request):
+            creds.token = 'startup-access-token'
+
+        with patch.dict(os.environ, env), patch('main._db', db), \
+             patch('google.oauth2.credentials.Credentials.refresh', fake_refresh), \
+             contextlib.redirect_stdout(io.StringIO()):
+            timed('early exit event', lambda: main.process_gmail_notification(make_cloud_event(gmail.history_id)))
+            timed('gmail client', main.get_gmail_service)
+
+            gmail.add_messages(emails, label_names=('Startup',))
+            with patch('main.get_gmail_service', return_value=gmail):
+                timed('first sync event', lambda: main.process_gmail_notification(make_cloud_event(gmail.history_id)))
+
+        if len(backend.received) != emails:
+            raise RuntimeError(f"Expected {emails} emails at the backend, got {len(backend.received)}")
+
+    timings['peak_rss_mb'] = peak_rss_mb()
+    return timings
+
+
+def run_in_subprocess(emails):
+    command = [sys.executable, os.path.abspath(__file__), '--measure', '--emails', str(emails)]
+    # Warming up happens in the background on Cloud Functions, here we time the lazy path
+    env = {**os.environ, 'WARM_UP_CLIENTS': 'false'}
+    completed = subprocess.run(command, capture_output=True, text=True, env=env)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Startup measure failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(count):
+    """[(cumulative ms, module)] of the slowest imports of `import main`."""
+    command = [sys.executable, '-X', 'importtime', '-c', f"import sys; sys.path.append({FUNCTION_DIR!r}); import main"]
+    env = {**os.environ, 'WARM_UP_CLIENTS': 'false'}
+    completed = subprocess.run(command, capture_output=True, text=True, env=env)
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((int(cumulative) / 1000, module.rstrip()))
+    imports.sort(reverse=True)
+    return imports[:count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--emails', type=int, default=20, help="New emails in the first sync event")
+    parser.add_argument('--importtime', type=int, metavar='N', help="List the N slowest imports of main")
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.emails)))
+        sys.exit(0)
+
+    results = [run_in_subprocess(args.emails) for _ in range(args.runs)]
+    print(f"🧊 Cold start, median of {args.runs} fresh processes")
+    for stage in STAGES:
+        samples = [result[stage] for result in results]
+        print(f"{stage:>18} | {statistics.median(samples):8.1f} ms (min {min(samples):.1f}, max {max(samples):.1f})")
+    print(f"{'peak RSS':>18} | {statistics.median(result['peak_rss_mb'] for result in results):8.1f} MB")
+
+    if args.importtime:
+        print("\n🐢 Slowest imports of main (cumulative)")
+        for elapsed_ms, module in slowest_imports(args.importtime):
+            print(f"{elapsed_ms:8.1f} ms {module}")
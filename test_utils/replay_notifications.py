@@ -0,0 +1,320 @@
+"""
+Replays Gmail notification streams against a local function, to size instance
+counts and timeouts against real bursts.
+
+Notifications are read from a file, in any of these shapes (one per line as JSON
+Lines, or a JSON array):
+    {"emailAddress": "...", "historyId": 123, "publishTime": "2024-05-01T10:00:00.123Z"}
+    {"message": {"data": "<base64 notification>", "messageId": "...", "publishTime": "..."}}
+    Cloud Logging exports whose jsonPayload / textPayload holds one of the above
+or generated with --synthetic N (increasing historyIds).
+
+They are POSTed as Pub/Sub CloudEvents to --url, either at a fixed --rate per
+second or, with --speed, following their original publishTime spacing (2 replays
+twice as fast). --burst K sends them K at a time, and --duplicates P redelivers
+a fraction P of them a second time with the same messageId, as Pub/Sub's
+at-least-once delivery does.
+
+The client side latency of every request goes into a histogram. With --serve the
+tool starts the function itself (functions-framework on --port), reads the
+"invocation metrics" line it logs for every invocation, and counts how many
+notifications synced, were coalesced by the sync lease, or were skipped as stale
+(`new_history_id <= last_processed_id`).
+
+    python test_utils/replay_notifications.py notifications.jsonl --rate 20 --duplicates 0.1
+    python test_utils/replay_notifications.py --synthetic 500 --burst 50 --serve
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+FUNCTION_SOURCE = os.path.join(current_dir, '..', 'cloud_function', 'main.py')
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+HISTOGRAM_WIDTH = 40
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def parse_record(record):
+    """
+        One notification {'email_address', 'history_id', 'published_at', 'message_id'}
+        from any supported shape, or None when the record isn't a notification.
+    """
+    if 'jsonPayload' in record or 'textPayload' in record:
+        payload = record.get('jsonPayload') or record.get('textPayload')
+        if isinstance(payload, str):
+            try:
+                payload = json.loads(payload)
+            except ValueError:
+                return None
+        parsed = parse_record(payload) if isinstance(payload, dict) else None
+        if parsed is not None and parsed['published_at'] is None:
+            parsed['published_at'] = _parse_time(record.get('timestamp'))
+        return parsed
+
+    message = record.get('message', record)
+    if 'data' in message:
+        data = message['data']
+        notification = json.loads(base64.b64decode(data)) if isinstance(data, str) else data
+        published_at = message.get('publishTime') or message.get('publish_time')
+        message_id = message.get('messageId') or message.get('message_id')
+    else:
+        notification = record
+        published_at = record.get('publishTime')
+        message_id = record.get('messageId')
+
+    if not isinstance(notification, dict) or 'historyId' not in notification:
+        return None
+    return {
+        'email_address': notification.get('emailAddress'),
+        'history_id': int(notification['historyId']),
+        'published_at': _parse_time(published_at),
+        'message_id': message_id or uuid.uuid4().hex,
+    }
+
+
+def load_notifications(path):
+    with open(path) as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        records = json.loads(content)
+    else:
+        records = [json.loads(line) for line in content.splitlines() if line.strip()]
+    notifications = [parsed for parsed in map(parse_record, records) if parsed is not None]
+    notifications.sort(key=lambda item: (item['published_at'] or 0, item['history_id']))
+    return notifications
+
+
+def synthetic_notifications(count, start_history_id, email_address, step=1):
+    return [
+        {'email_address': email_address, 'history_id': start_history_id + (i + 1) * step,
+         'published_at': None, 'message_id': uuid.uuid4().hex}
+        for i in range(count)
+    ]
+
+
+def schedule(notifications, rate=None, speed=None, burst=1, duplicates=0.0, seed=0):
+    """
+        [(seconds from start, notification, is_duplicate)] sorted by send time.
+
+        With `speed` and publish times, the original spacing is kept (divided by
+        `speed`), otherwise notifications go out at `rate` per second. `burst`
+        groups them so K notifications leave at the same instant.
+        Duplicates are sent shortly after their original.
+    """
+    rng = random.Random(seed)
+    burst = max(1, burst)
+    plan = []
+    first_published = next((item['published_at'] for item in notifications if item['published_at']), None)
+    for index, notification in enumerate(notifications):
+        if speed and first_published is not None and notification['published_at'] is not None:
+            at = (notification['published_at'] - first_published) / speed
+        elif rate:
+            at = (index // burst) * burst / rate
+        else:
+            at = 0.0
+        plan.append((at, notification, False))
+        if duplicates and rng.random() < duplicates:
+            plan.append((at + rng.uniform(0, 1), notification, True))
+    plan.sort(key=lambda item: item[0])
+    return plan
+
+
+def cloud_event_request(notification):
+    """(body, headers) of the binary mode CloudEvent Eventarc sends for a Pub/Sub message."""
+    gmail_data = {'emailAddress': notification['email_address'], 'historyId': notification['history_id']}
+    body = {
+        'message': {
+            'data': base64.b64encode(json.dumps(gmail_data).encode('utf-8')).decode('utf-8'),
+            'messageId': notification['message_id'],
+        },
+    }
+    headers = {
+        'ce-id': notification['message_id'],
+        'ce-specversion': '1.0',
+        'ce-type': 'google.cloud.pubsub.topic.v1.messagePublished',
+        'ce-source': '//pubsub.googleapis.com/projects/replay/topics/gmail-notifications-topic',
+        'Content-Type': 'application/json',
+    }
+    return body, headers
+
+
+def replay(url, plan, concurrency=16, timeout=120):
+    """Sends the plan, returns [(latency seconds or None, status code or error name)]."""
+    session = requests.Session()
+    results = []
+    lock = threading.Lock()
+
+    def send(notification):
+        body, headers = cloud_event_request(notification)
+        start = time.monotonic()
+        try:
+            response = session.post(url, json=body, headers=headers, timeout=timeout)
+            outcome = (time.monotonic() - start, response.status_code)
+        except requests.RequestException as e:
+            outcome = (None, type(e).__name__)
+        with lock:
+            results.append(outcome)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for at, notification, _ in plan:
+            delay = started + at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, notification)
+    return results
+
+
+def histogram(latencies):
+    """Text histogram of latencies (seconds) over HISTOGRAM_BUCKETS_MS."""
+    counts = Counter()
+    for latency in latencies:
+        latency_ms = latency * 1000
+        bucket = next((limit for limit in HISTOGRAM_BUCKETS_MS if latency_ms <= limit), None)
+        counts[bucket] += 1
+    biggest = max(counts.values(), default=0)
+    lines = []
+    for limit in HISTOGRAM_BUCKETS_MS + (None,):
+        count = counts.get(limit, 0)
+        label = f"<= {limit} ms" if limit is not None else f"> {HISTOGRAM_BUCKETS_MS[-1]} ms"
+        bar = '█' * (round(count / biggest * HISTOGRAM_WIDTH) if biggest else 0)
+        lines.append(f"{label:>12} | {count:6d} {bar}")
+    return '\n'.join(lines)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+
+def invocation_outcomes(log_lines):
+    """Counts the `result` of the invocation metrics lines, plus their durations in ms."""
+    results = Counter()
+    durations = []
+    for line in log_lines:
+        line = line.strip()
+        if not line.startswith('{') or '"invocation metrics"' not in line:
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        results[entry.get('result') or entry.get('outcome')] += 1
+        durations.append(entry.get('duration_ms', 0))
+    return results, durations
+
+
+class FunctionServer:
+    """Runs process_gmail_notification under functions-framework and keeps its output."""
+
+    def __init__(self, port, env=None):
+        self.port = port
+        self.lines = []
+        self._env = {**os.environ, **(env or {})}
+        self._process = None
+        self._reader = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def _read(self):
+        for line in self._process.stdout:
+            self.lines.append(line)
+
+    def start(self, wait=15):
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'functions_framework', '--target', 'process_gmail_notification',
+             '--source', FUNCTION_SOURCE, '--signature-type', 'cloudevent', '--port', str(self.port)],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=self._env,
+        )
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            try:
+                requests.get(self.url, timeout=1)
+                return self
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("functions-framework did not start:\n" + ''.join(self.lines))
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait(timeout=10)
+            self._reader.join(timeout=5)
+
+
+def report(plan, results, log_lines=None):
+    latencies = [latency for latency, _ in results if latency is not None]
+    duplicates = sum(1 for _, _, is_duplicate in plan if is_duplicate)
+    print(f"📨 Sent {len(plan)} notifications ({duplicates} duplicates)")
+    print(f"Statuses: {dict(Counter(status for _, status in results))}")
+    print(f"Latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms | p90 {percentile(latencies, 0.9) * 1000:.1f} ms | "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms | max {max(latencies, default=0) * 1000:.1f} ms")
+    print(histogram(latencies))
+    if log_lines is not None:
+        outcomes, durations = invocation_outcomes(log_lines)
+        print(f"Invocations: synced {outcomes.get('synced', 0)} | coalesced by the lease {outcomes.get('coalesced', 0)} | "
+              f"skipped as stale {outcomes.get('stale', 0)} | errors {outcomes.get('error', 0)} | other {dict(outcomes)}")
+        if durations:
+            print(f"Function duration p50 {percentile(durations, 0.5):.1f} ms | p99 {percentile(durations, 0.99):.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', nargs='?', help="JSON Lines or JSON file with notifications")
+    parser.add_argument('--synthetic', type=int, help="Generate this many notifications instead of reading a file")
+    parser.add_argument('--start-history-id', type=int, default=1000)
+    parser.add_argument('--email', default='user@example.com')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--rate', type=float, default=10, help="Notifications per second")
+    parser.add_argument('--speed', type=float, help="Follow the original publishTime spacing, sped up by this factor")
+    parser.add_argument('--burst', type=int, default=1, help="Send notifications this many at a time")
+    parser.add_argument('--duplicates', type=float, default=0.0, help="Fraction of notifications delivered twice")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--serve', action='store_true', help="Start the function locally with functions-framework")
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        notifications = synthetic_notifications(args.synthetic, args.start_history_id, args.email)
+    elif args.source:
+        notifications = load_notifications(args.source)
+    else:
+        parser.error("Give a notifications file or --synthetic N")
+
+    plan = schedule(notifications, args.rate, args.speed, args.burst, args.duplicates, args.seed)
+    server = FunctionServer(args.port).start() if args.serve else None
+    try:
+        results = replay(server.url if server else args.url, plan, args.concurrency)
+    finally:
+        if server is not None:
+            server.stop()
+    report(plan, results, server.lines if server else None)
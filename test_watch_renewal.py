@@ -0,0 +1,108 @@
+import json
+import os
+import sys
+import time
+from unittest.mock import patch
+
+# Make the cloud function and the test utilities importable
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'cloud_function'))
+sys.path.append(os.path.join(current_dir, 'test_utils'))
+
+with patch('google.cloud.firestore.Client'):
+    import main
+
+from fake_firestore import FakeFirestore
+from fake_gmail import FakeGmail
+from function_harness import reset_caches
+
+ENV = {'EMAIL_FETCHING_LABELS': 'Banks,Receipts', 'GMAIL_WATCH_TOPIC': 'projects/demo/topics/gmail-notifications-topic',
+       'GMAIL_QUOTA_UNITS_PER_SECOND': '0'}
+
+
+class FakeRequest:
+    def __init__(self, **args):
+        self.args = args
+
+
+def renew(gmail, db, env=None, **args):
+    with patch.dict(os.environ, dict(ENV, **(env or {}))), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service', return_value=gmail):
+        body, status, _ = main.renew_gmail_watch(FakeRequest(**args))
+    return json.loads(body)['default'], status
+
+
+def test_watch_is_recorded_and_only_renewed_near_its_expiration():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks', 'Receipts'])
+    db = FakeFirestore()
+
+    # A new mailbox is watched and seeded
+    result, status = renew(gmail, db)
+    assert status == 200 and result['renewed']
+    assert gmail.watches == [{
+        'topicName': 'projects/demo/topics/gmail-notifications-topic',
+        'labelIds': sorted([gmail.label_id('Banks'), gmail.label_id('Receipts')]),
+    }]
+    watch = db.data('state/gmail_watch')
+    assert watch['expiration'] / 1000 > time.time() + 6 * 24 * 3600
+    assert db.data('state/gmail_sync')['last_id'] == gmail.history_id
+
+    # The daily run leaves a fresh watch alone, labels come from the cache
+    result, _ = renew(gmail, db)
+    assert not result['renewed']
+    assert len(gmail.watches) == 1 and gmail.calls['labels.list'] == 1
+
+    # Close to the deadline it is renewed
+    db.seed('state/gmail_watch', dict(watch, expiration=int((time.time() + 3600) * 1000)))
+    result, _ = renew(gmail, db)
+    assert result['renewed'] and len(gmail.watches) == 2
+
+
+def test_renewal_leaves_an_existing_last_id_alone():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks', 'Receipts'])
+    db = FakeFirestore()
+    db.seed('state/gmail_sync', {'last_id': gmail.history_id, 'synced_at': 1700000000})
+    last_id = gmail.history_id
+    gmail.add_messages(5, label_names=('Banks',))
+
+    result, status = renew(gmail, db, force='true')
+
+    assert status == 200 and result['history_id'] == gmail.history_id
+    # The mail that arrived since the last sync is still ahead of last_id
+    assert db.data('state/gmail_sync') == {'last_id': last_id, 'synced_at': 1700000000}
+
+
+def test_failed_renewal_answers_500_for_the_scheduler_to_retry():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks', 'Receipts'])
+    gmail.inject_throttling('users.watch', times=10, status=403, reason='forbidden')
+
+    result, status = renew(gmail, FakeFirestore())
+
+    assert status == 500 and 'error' in result
+
+
+def test_a_cold_instance_with_nothing_to_renew_makes_no_gmail_call():
+    reset_caches()
+    gmail = FakeGmail(labels=['Banks', 'Receipts'])
+    db = FakeFirestore()
+    renew(gmail, db)
+    calls = dict(gmail.calls)
+
+    # The next day: a new instance, label IDs older than their TTL
+    reset_caches()
+    with patch.dict(os.environ, dict(ENV, LABEL_CACHE_TTL_SECONDS='0')), \
+         patch('main._db', db), \
+         patch('main.get_gmail_service') as get_gmail_service:
+        body, status, _ = main.renew_gmail_watch(FakeRequest())
+    assert status == 200 and not json.loads(body)['default']['renewed']
+    get_gmail_service.assert_not_called()
+    assert dict(gmail.calls) == calls
+
+    # Watching other labels renews right away
+    result, _ = renew(gmail, db, {'EMAIL_FETCHING_LABELS': 'Banks'})
+    assert result['renewed'] and result['label_names'] == ['Banks']
+    assert gmail.watches[-1]['labelIds'] == [gmail.label_id('Banks')]